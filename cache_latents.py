@@ -1,7 +1,13 @@
 import argparse
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
+import json
 import os
 import glob
-from typing import Optional, Union
+import queue
+import threading
+import time
+from typing import Iterator, Optional, Union
 
 import numpy as np
 import torch
@@ -13,10 +19,18 @@ from PIL import Image
 
 import logging
 
-from dataset.image_video_dataset import BaseDataset, ItemInfo, save_latent_cache, ARCHITECTURE_HUNYUAN_VIDEO
+from dataset.image_video_dataset import (
+    BaseDataset,
+    ItemInfo,
+    save_latent_cache,
+    ARCHITECTURE_HUNYUAN_VIDEO,
+    DECODE_BACKEND_PROCESS,
+    DECODE_BACKEND_THREAD,
+    resize_tensor_to_bucket,
+)
 from hunyuan_model.vae import load_vae
 from hunyuan_model.autoencoder_kl_causal_3d import AutoencoderKLCausal3D
-from utils.model_utils import str_to_dtype
+from utils.model_utils import get_model_identity, str_to_dtype
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
@@ -120,14 +134,142 @@ def show_datasets(
             batch_index += 1
 
 
-def encode_and_save_batch(vae: AutoencoderKLCausal3D, batch: list[ItemInfo]):
-    contents = torch.stack([torch.from_numpy(item.content) for item in batch])
-    if len(contents.shape) == 4:
-        contents = contents.unsqueeze(1)  # B, H, W, C -> B, F, H, W, C
+def get_batch_contents(batch: list[ItemInfo], device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    """
+    Returns the contents of the batch on the device, B, C, F, H, W, normalized to [-1, 1]. The contents which are not resized
+    to the bucket resolution (--gpu_resize) are uploaded as uint8 and resized on the device, the items with the same size are
+    resized together.
+    """
+    bucket_width, bucket_height = batch[0].bucket_size[:2]
+    contents = [torch.from_numpy(item.content) for item in batch]
+    contents = [content.unsqueeze(0) if content.ndim == 3 else content for content in contents]  # H, W, C -> F, H, W, C
+
+    if all(content.shape[1:3] == (bucket_height, bucket_width) for content in contents):
+        contents = torch.stack(contents)  # B, F, H, W, C
+        contents = contents.permute(0, 4, 1, 2, 3).contiguous()  # B, C, F, H, W
+        contents = contents.to(device, dtype=dtype)
+    else:
+        indices_for_size: dict[tuple[int, ...], list[int]] = {}
+        for i, content in enumerate(contents):
+            indices_for_size.setdefault(tuple(content.shape), []).append(i)
+
+        resized_contents = [None] * len(contents)
+        for (num_frames, _, _, _), indices in indices_for_size.items():
+            frames = torch.stack([contents[i] for i in indices]).to(device)  # N, F, H, W, C, uint8
+            frames = frames.flatten(0, 1).permute(0, 3, 1, 2)  # N*F, C, H, W
+            frames = resize_tensor_to_bucket(frames, (bucket_width, bucket_height))
+            frames = frames.unflatten(0, (len(indices), num_frames)).permute(0, 2, 1, 3, 4)  # N, C, F, H, W
+            for i, resized in zip(indices, frames):
+                resized_contents[i] = resized
+        contents = torch.stack(resized_contents).to(dtype=dtype)
 
-    contents = contents.permute(0, 4, 1, 2, 3).contiguous()  # B, C, F, H, W
-    contents = contents.to(vae.device, dtype=vae.dtype)
     contents = contents / 127.5 - 1.0  # normalize to [-1, 1]
+    return contents
+
+
+class AsyncCacheWriter:
+    """
+    Writes cache files in background threads, so the NaN check, the file writes and the CPU work overlap with the next encode.
+    submit() blocks while max_pending writes are waiting, to bound the memory of the tensors to be written. With num_workers
+    0, the writes are done synchronously in submit().
+    """
+
+    def __init__(self, num_workers: int, max_pending: Optional[int] = None):
+        self.num_workers = num_workers
+        self.executor = ThreadPoolExecutor(max_workers=num_workers) if num_workers > 0 else None
+        self.pending = threading.BoundedSemaphore(max_pending or max(1, num_workers) * 4)
+        self.futures: set[Future] = set()
+        self.lock = threading.Lock()
+
+        self.write_seconds = 0.0  # sum of the time of all writers
+        self.wait_seconds = 0.0  # time the encoder waited for the writers
+
+    def _write(self, fn: callable, args: tuple):
+        start_time = time.perf_counter()
+        try:
+            fn(*args)
+        finally:
+            with self.lock:
+                self.write_seconds += time.perf_counter() - start_time
+            self.pending.release()
+
+    def _raise_if_failed(self):
+        for future in [future for future in self.futures if future.done()]:
+            self.futures.remove(future)
+            future.result()  # raise the exception in the writer if any
+
+    def submit(self, fn: callable, *args):
+        start_time = time.perf_counter()
+        self.pending.acquire()
+        self.wait_seconds += time.perf_counter() - start_time
+
+        if self.executor is None:
+            self._write(fn, args)
+            return
+
+        self._raise_if_failed()
+        self.futures.add(self.executor.submit(self._write, fn, args))
+
+    def flush(self):
+        """
+        Wait for all writes to finish.
+        """
+        start_time = time.perf_counter()
+        for future in list(self.futures):
+            future.result()
+        self.futures.clear()
+        self.wait_seconds += time.perf_counter() - start_time
+
+    def close(self):
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def prefetch_batches(iterable, num_prefetch: int) -> Iterator:
+    """
+    Run the iterator in a background thread and prefetch up to num_prefetch items, so the work in the iterator (building
+    the batches, checking the existing caches) overlaps with the encoding.
+    """
+    if num_prefetch <= 0:
+        yield from iterable
+        return
+
+    item_queue = queue.Queue(maxsize=num_prefetch)
+    stop_event = threading.Event()
+    end_of_items = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop_event.is_set():
+                    try:
+                        item_queue.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop_event.is_set():
+                    return
+            item_queue.put((end_of_items, None))
+        except Exception as e:
+            item_queue.put((end_of_items, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, exception = item_queue.get()
+            if item is end_of_items:
+                if exception is not None:
+                    raise exception
+                return
+            yield item
+    finally:
+        stop_event.set()
+
+
+def encode_and_save_batch(vae: AutoencoderKLCausal3D, batch: list[ItemInfo], writer: Optional[AsyncCacheWriter] = None):
+    contents = get_batch_contents(batch, vae.device, vae.dtype)
 
     h, w = contents.shape[3], contents.shape[4]
     if h < 8 or w < 8:
@@ -153,28 +295,138 @@ def encode_and_save_batch(vae: AutoencoderKLCausal3D, batch: list[ItemInfo]):
     #             img = Image.fromarray(images[b, f])
     #             img.save(f"./logs/decode_{fln}_{b}_{f:03d}.jpg")
 
+    latent = latent.cpu()  # one transfer for the batch, the writers work on the CPU tensors
     for item, l in zip(batch, latent):
         # print(f"save latent cache: {item.latent_cache_path}, latent shape: {l.shape}")
-        save_latent_cache(item, l)
+        if writer is not None:
+            writer.submit(save_latent_cache, item, l)
+        else:
+            save_latent_cache(item, l)
 
 
-def encode_datasets(datasets: list[BaseDataset], encode: callable, args: argparse.Namespace):
+def get_latent_cache_key(source_identity: dict, encoder_identity: dict) -> str:
+    """
+    Returns the key of the latent cache, computed from the identity of the source (file, bucket resolution, crop window)
+    and the identity of the encoder (VAE checksum, dtype and other settings which change the latents).
+    """
+    key = json.dumps({"source": source_identity, "encoder": encoder_identity}, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def encode_datasets(
+    datasets: list[BaseDataset],
+    encode: callable,
+    args: argparse.Namespace,
+    encoder_identity: Optional[dict] = None,
+    writer: Optional[AsyncCacheWriter] = None,
+    share_window_prefix: bool = False,
+):
+    """
+    encoder_identity: identity of the encoder, stored with the source identity as the cache key in the latent cache. With
+    `--skip_existing`, the items with the cache of the different key are encoded again. The caches without the key (created
+    by an older version) are considered valid.
+    writer: the writer used in `encode`. It is flushed at the end of each dataset.
+    share_window_prefix: the video windows with the same start frame are encoded once, `encode` must save the caches of
+    `prefix_items` of each item from the leading latent frames. Only for causal VAEs.
+
+    The caching is pipelined: the decoding workers, the batch preparation (in a background thread), the encoding (in this
+    thread) and the writers run concurrently with bounded queues between them.
+    """
     num_workers = args.num_workers if args.num_workers is not None else max(1, os.cpu_count() - 1)
     for i, dataset in enumerate(datasets):
         logger.info(f"Encoding dataset [{i}]")
         all_latent_cache_paths = []
-        for _, batch in tqdm(dataset.retrieve_latent_cache_batches(num_workers)):
-            all_latent_cache_paths.extend([item.latent_cache_path for item in batch])
-
-            if args.skip_existing:
-                filtered_batch = [item for item in batch if not os.path.exists(item.latent_cache_path)]
-                if len(filtered_batch) == 0:
-                    continue
-                batch = filtered_batch
-
+        num_skipped = 0
+        num_changed = 0
+
+        # encode-side throughput. decode-side throughput is recorded by the dataset
+        num_encoded_items = 0
+        num_encoded_frames = 0
+        num_prefix_items = 0  # windows sliced from the latents of the longer windows, not encoded
+        encode_seconds = 0.0
+        wait_seconds = 0.0  # time waiting for the decoded batches
+        writer_wait_seconds = writer.wait_seconds if writer is not None else 0.0
+
+        def needs_encoding(item: ItemInfo) -> bool:
+            nonlocal num_skipped, num_changed
+            stored_cache_key = dataset.get_stored_latent_cache_key(item)
+            if stored_cache_key is None:
+                return True  # no cache
+            if stored_cache_key != "" and item.cache_key is not None and stored_cache_key != item.cache_key:
+                num_changed += 1
+                return True  # inputs are changed
+            num_skipped += 1
+            return False
+
+        # runs in the prefetching thread
+        def filter_batches():
+            for _, batch in dataset.retrieve_latent_cache_batches(
+                num_workers, args.decode_backend, args.gpu_resize, share_window_prefix
+            ):
+                for item in batch:
+                    all_latent_cache_paths.append(item.latent_cache_path)
+                    all_latent_cache_paths.extend([prefix_item.latent_cache_path for prefix_item in item.prefix_items])
+
+                if encoder_identity is not None:
+                    for item in batch:
+                        for target_item in [item] + item.prefix_items:
+                            if target_item.source_identity is not None:
+                                target_item.cache_key = get_latent_cache_key(target_item.source_identity, encoder_identity)
+
+                if args.skip_existing:
+                    filtered_batch = []
+                    for item in batch:
+                        # the longest window is encoded (and saved again) if any of the windows sharing it needs encoding
+                        item.prefix_items = [prefix_item for prefix_item in item.prefix_items if needs_encoding(prefix_item)]
+                        if needs_encoding(item) or len(item.prefix_items) > 0:
+                            filtered_batch.append(item)
+                    if len(filtered_batch) == 0:
+                        continue
+                    batch = filtered_batch
+
+                yield batch
+
+        progress = tqdm(prefetch_batches(filter_batches(), args.prefetch_batches))
+        wait_start_time = time.perf_counter()
+        for batch in progress:
+            wait_seconds += time.perf_counter() - wait_start_time
+
+            encode_start_time = time.perf_counter()
             bs = args.batch_size if args.batch_size is not None else len(batch)
             for i in range(0, len(batch), bs):
                 encode(batch[i : i + bs])
+            encode_seconds += time.perf_counter() - encode_start_time
+            num_encoded_items += len(batch)
+            num_encoded_frames += sum(item.frame_count or 1 for item in batch)
+            num_prefix_items += sum(len(item.prefix_items) for item in batch)
+
+            # show the time of each stage to find the bottleneck: waiting for decoding, encoding, waiting for writing
+            # (the wait for writing is included in the encoding time)
+            postfix = {"decode_wait": f"{wait_seconds:.0f}s", "encode": f"{encode_seconds:.0f}s"}
+            if writer is not None:
+                postfix["write_wait"] = f"{writer.wait_seconds - writer_wait_seconds:.0f}s"
+            progress.set_postfix(postfix, refresh=False)
+            wait_start_time = time.perf_counter()
+
+        if writer is not None:
+            writer.flush()
+
+        if args.skip_existing:
+            logger.info(f"Skipped {num_skipped} items with valid cache, encoded {num_changed} items with changed inputs")
+
+        if dataset.decode_stats is not None:
+            logger.info(dataset.decode_stats.summary())
+        logger.info(
+            f"encode: {num_encoded_items} items, {num_encoded_frames} frames in {encode_seconds:.1f}s,"
+            f" {num_encoded_frames / max(encode_seconds, 1e-6):.1f} frames/s, waited {wait_seconds:.1f}s for decoding"
+        )
+        if share_window_prefix:
+            logger.info(f"shared window prefix: {num_prefix_items} windows are cached from the latents of longer windows")
+        if writer is not None:
+            logger.info(
+                f"write: {writer.write_seconds:.1f}s in {writer.num_workers} writers,"
+                f" encoder waited {writer.wait_seconds - writer_wait_seconds:.1f}s for writing"
+            )
 
         # normalize paths
         all_latent_cache_paths = [os.path.normpath(p) for p in all_latent_cache_paths]
@@ -187,9 +439,12 @@ def encode_datasets(datasets: list[BaseDataset], encode: callable, args: argpars
                 if args.keep_cache:
                     logger.info(f"Keep cache file not in the dataset: {cache_file}")
                 else:
-                    os.remove(cache_file)
+                    dataset.remove_latent_cache_file(cache_file)
                     logger.info(f"Removed old cache file: {cache_file}")
 
+        dataset.close_latent_cache()
+        dataset.update_latent_cache_manifest()
+
 
 def main(args):
     device = args.device if args.device is not None else "cuda" if torch.cuda.is_available() else "cpu"
@@ -227,10 +482,21 @@ def main(args):
         vae.enable_spatial_tiling(True)
 
     # Encode images
+    writer = AsyncCacheWriter(args.num_cache_writers)
+
     def encode(one_batch: list[ItemInfo]):
-        encode_and_save_batch(vae, one_batch)
+        encode_and_save_batch(vae, one_batch, writer)
 
-    encode_datasets(datasets, encode, args)
+    encoder_identity = {
+        "vae": get_model_identity(args.vae),
+        "vae_dtype": str(vae_dtype),
+        "vae_chunk_size": args.vae_chunk_size,
+        "vae_spatial_tile_sample_min_size": args.vae_spatial_tile_sample_min_size,
+        "vae_tiling": args.vae_tiling,
+        "gpu_resize": args.gpu_resize,  # the device interpolation differs from the cv2 resize
+    }
+    encode_datasets(datasets, encode, args, encoder_identity, writer)
+    writer.close()
 
 
 def setup_parser_common() -> argparse.ArgumentParser:
@@ -244,7 +510,35 @@ def setup_parser_common() -> argparse.ArgumentParser:
         "--batch_size", type=int, default=None, help="batch size, override dataset config if dataset batch size > this"
     )
     parser.add_argument("--num_workers", type=int, default=None, help="number of workers for dataset. default is cpu count-1")
-    parser.add_argument("--skip_existing", action="store_true", help="skip existing cache files")
+    parser.add_argument(
+        "--decode_backend",
+        type=str,
+        default=DECODE_BACKEND_THREAD,
+        choices=[DECODE_BACKEND_THREAD, DECODE_BACKEND_PROCESS],
+        help="backend of the workers for loading and resizing images and videos, process is faster with many CPU cores",
+    )
+    parser.add_argument(
+        "--num_cache_writers",
+        type=int,
+        default=2,
+        help="number of threads to write the cache files in the background, 0 to write synchronously. default is 2",
+    )
+    parser.add_argument(
+        "--prefetch_batches",
+        type=int,
+        default=2,
+        help="number of batches prepared in the background while encoding, 0 to disable. default is 2",
+    )
+    parser.add_argument(
+        "--gpu_resize",
+        action="store_true",
+        help="resize and crop images and videos to the bucket resolution on the GPU instead of the CPU workers",
+    )
+    parser.add_argument(
+        "--skip_existing",
+        action="store_true",
+        help="skip existing cache files, unless the source, bucket, crop window or VAE is changed",
+    )
     parser.add_argument("--keep_cache", action="store_true", help="keep cache files not in dataset")
     parser.add_argument("--debug_mode", type=str, default=None, choices=["image", "console"], help="debug mode")
     parser.add_argument("--console_width", type=int, default=80, help="debug mode: console width")
@@ -1,6 +1,8 @@
 import argparse
+import hashlib
+import json
 import os
-from typing import Optional, Union
+from typing import Callable, Optional, Union
 
 import numpy as np
 import torch
@@ -10,7 +12,13 @@ from dataset import config_utils
 from dataset.config_utils import BlueprintGenerator, ConfigSanitizer
 import accelerate
 
-from dataset.image_video_dataset import ARCHITECTURE_HUNYUAN_VIDEO, BaseDataset, ItemInfo, save_text_encoder_output_cache
+from dataset.image_video_dataset import (
+    ARCHITECTURE_HUNYUAN_VIDEO,
+    BaseDataset,
+    ItemInfo,
+    get_shared_text_encoder_output_cache_path,
+    save_text_encoder_output_cache,
+)
 from hunyuan_model import text_encoder as text_encoder_module
 from hunyuan_model.text_encoder import TextEncoder
 
@@ -54,6 +62,45 @@ def encode_and_save_batch(
         save_text_encoder_output_cache(item, embed, mask, is_llm)
 
 
+class SharedCaptionCache:
+    """
+    Deduplicates the text encoder outputs by caption. The outputs of each distinct caption are encoded once and saved to
+    a shared cache, and the cache of each item is saved as a link to it.
+
+    The shared cache is named by the hash of the normalized caption and the identity of the text encoder (checksum,
+    dtype, tokenizer and so on), so the caches of the different encoders are not mixed.
+    """
+
+    def __init__(self, encoder_identity: dict, architecture: str, reuse_existing: bool):
+        self.encoder_identity = encoder_identity
+        self.architecture = architecture
+        self.reuse_existing = reuse_existing  # use the shared caches created by the previous run
+        self.saved_paths: set[str] = set()
+
+        self.num_items = 0
+        self.num_encoded = 0
+
+    def get_shared_cache_path(self, item: ItemInfo, normalized_caption: str) -> str:
+        key = json.dumps({"caption": normalized_caption, "encoder": self.encoder_identity}, sort_keys=True)
+        share_key = hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+        cache_directory = os.path.dirname(item.text_encoder_output_cache_path)
+        return get_shared_text_encoder_output_cache_path(cache_directory, share_key, self.architecture)
+
+    def is_saved(self, path: str) -> bool:
+        if path in self.saved_paths:
+            return True
+        if self.reuse_existing and os.path.exists(path):
+            self.saved_paths.add(path)
+            return True
+        return False
+
+    def add_saved(self, path: str):
+        self.saved_paths.add(path)
+
+    def summary(self) -> str:
+        return f"shared caption cache: {self.num_items} items, {self.num_encoded} distinct captions encoded"
+
+
 def prepare_cache_files_and_paths(datasets: list[BaseDataset]):
     all_cache_files_for_dataset = []  # exisiting cache files
     all_cache_paths_for_dataset = []  # all cache paths in the dataset
@@ -74,12 +121,20 @@ def process_text_encoder_batches(
     all_cache_files_for_dataset: list[set],
     all_cache_paths_for_dataset: list[set],
     encode: callable,
+    get_token_lengths: Optional[Callable[[list[str]], list[int]]] = None,
+    token_budget: Optional[int] = None,
 ):
+    """
+    If token_budget and get_token_lengths are specified, the items of each dataset are sorted by the token length of the
+    captions, and batched so that the number of padded tokens in a batch does not exceed token_budget. batch_size is the
+    maximum number of items in a batch in this case. The encoder should pad the captions to the longest one in the batch.
+    """
     num_workers = num_workers if num_workers is not None else max(1, os.cpu_count() - 1)
     for i, dataset in enumerate(datasets):
         logger.info(f"Encoding dataset [{i}]")
         all_cache_files = all_cache_files_for_dataset[i]
         all_cache_paths = all_cache_paths_for_dataset[i]
+        items_to_sort: list[ItemInfo] = []
         for batch in tqdm(dataset.retrieve_text_encoder_output_cache_batches(num_workers)):
             # update cache files (it's ok if we update it multiple times)
             all_cache_paths.update([os.path.normpath(item.text_encoder_output_cache_path) for item in batch])
@@ -94,25 +149,74 @@ def process_text_encoder_batches(
                     continue
                 batch = filtered_batch
 
+            if token_budget is not None and get_token_lengths is not None:
+                items_to_sort.extend(batch)  # encoded after all captions are collected
+                continue
+
             bs = batch_size if batch_size is not None else len(batch)
             for i in range(0, len(batch), bs):
                 encode(batch[i : i + bs])
 
+        if len(items_to_sort) > 0:
+            token_lengths = get_token_lengths([item.caption for item in items_to_sort])
+            batches = make_token_budget_batches(items_to_sort, token_lengths, token_budget, batch_size)
+
+            num_tokens = sum(token_lengths)
+            num_padded_tokens = sum(len(batch) * max(token_lengths[index] for index in batch) for batch in batches)
+            logger.info(
+                f"{len(items_to_sort)} captions in {len(batches)} batches, {num_tokens} tokens, {num_padded_tokens} with padding"
+            )
+            for batch in tqdm(batches):
+                encode([items_to_sort[index] for index in batch])
+
+
+def make_token_budget_batches(
+    items: list, token_lengths: list[int], token_budget: int, max_batch_size: Optional[int] = None
+) -> list[list[int]]:
+    """
+    Returns the batches of the indices of the items. The items are sorted by the token length in descending order (the
+    largest batch comes first, to find out-of-memory early), and each batch has up to token_budget tokens including the
+    padding to the longest item in it. An item longer than token_budget is in a batch by itself.
+    """
+    order = sorted(range(len(items)), key=lambda index: token_lengths[index], reverse=True)
+
+    batches = []
+    batch = []
+    for index in order:
+        padded_length = token_lengths[batch[0]] if len(batch) > 0 else token_lengths[index]  # the first one is the longest
+        is_full = max_batch_size is not None and len(batch) >= max_batch_size
+        if len(batch) > 0 and (is_full or (len(batch) + 1) * padded_length > token_budget):
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
 
 def post_process_cache_files(
-    datasets: list[BaseDataset], all_cache_files_for_dataset: list[set], all_cache_paths_for_dataset: list[set]
+    datasets: list[BaseDataset],
+    all_cache_files_for_dataset: list[set],
+    all_cache_paths_for_dataset: list[set],
+    keep_cache: bool = False,
 ):
     for i, dataset in enumerate(datasets):
         all_cache_files = all_cache_files_for_dataset[i]
         all_cache_paths = all_cache_paths_for_dataset[i]
         for cache_file in all_cache_files:
             if cache_file not in all_cache_paths:
-                if args.keep_cache:
+                if keep_cache:
                     logger.info(f"Keep cache file not in the dataset: {cache_file}")
                 else:
                     os.remove(cache_file)
                     logger.info(f"Removed old cache file: {cache_file}")
 
+        # write the manifest for quick loading in training
+        dataset.update_text_encoder_output_cache_manifest()
+
+        # remove the shared caches of the captions which are no longer in the dataset
+        dataset.remove_unused_shared_text_encoder_output_cache_files(keep_cache)
+
 
 def main(args):
     device = args.device if args.device is not None else "cuda" if torch.cuda.is_available() else "cpu"
@@ -181,7 +285,7 @@ def main(args):
     del text_encoder_2
 
     # remove cache files not in dataset
-    post_process_cache_files(datasets, all_cache_files_for_dataset, all_cache_paths_for_dataset)
+    post_process_cache_files(datasets, all_cache_files_for_dataset, all_cache_paths_for_dataset, args.keep_cache)
 
 
 def setup_parser_common():
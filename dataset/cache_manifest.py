@@ -0,0 +1,107 @@
+import json
+import os
+import struct
+from typing import Callable, Optional
+
+import logging
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+# Cache manifest
+#
+# A JSON file in the cache directory, written by the caching scripts, with one entry per cache file (or per item in the
+# packed cache). Training loads it in one read instead of globbing the cache directory and parsing every file name.
+#   {
+#     "format_version": 1,
+#     "items": {
+#       "<cache file name>": {
+#         "source": [data file name, offset, size, mtime_ns],  # to detect changed files when updating the manifest
+#         "tensors": {"<key>": ["<dtype>", [shape]], ...},
+#         "cache_key": "...",  # if the cache has a key for incremental caching
+#         "shared_cache": "...",  # if the text encoder output cache is a link to the shared cache of the same caption
+#         ...  # item info for latent caches: item_key, original_size, frame_pos, frame_count
+#       },
+#     }
+#   }
+
+MANIFEST_SUFFIX = ".manifest.json"
+MANIFEST_FORMAT_VERSION = 1
+
+
+def read_safetensors_header(path: str, offset: int = 0) -> dict:
+    with open(path, "rb") as f:
+        f.seek(offset)
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        return json.loads(f.read(header_size).decode("utf-8"))
+
+
+class CacheManifest:
+    def __init__(self, directory: str, name: str):
+        self.path = os.path.join(directory, f"{name}{MANIFEST_SUFFIX}")
+        self.items: dict[str, dict] = {}
+        self.load()
+
+    def load(self):
+        self.items = {}
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f"failed to load cache manifest, ignored: {self.path}, {e}")
+            return
+
+        if manifest.get("format_version") != MANIFEST_FORMAT_VERSION:
+            logger.warning(f"unsupported cache manifest format version, ignored: {self.path}")
+            return
+        self.items = manifest["items"]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"format_version": MANIFEST_FORMAT_VERSION, "items": self.items}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        logger.info(f"saved cache manifest: {self.path}, {len(self.items)} items")
+
+    def update(
+        self,
+        sources: list[tuple[str, str, int, int, Optional[int]]],
+        get_item_info: Optional[Callable[[str], dict]] = None,
+    ):
+        """
+        Rebuild the entries from the current cache files. Entries of unchanged files are reused, and the header is read only
+        for new or changed files.
+
+        sources: list of (cache file name, data file path, offset, size, mtime_ns). offset is not zero for the packed cache.
+        get_item_info: function to get additional item info from the cache file name.
+        """
+        items = {}
+        num_updated = 0
+        for name, path, offset, size, mtime_ns in sources:
+            source = [os.path.basename(path), offset, size, mtime_ns]
+            entry = self.items.get(name)
+            if entry is not None and entry.get("source") == source:
+                items[name] = entry
+                continue
+
+            header = read_safetensors_header(path, offset)
+            entry = {
+                "source": source,
+                "tensors": {key: [value["dtype"], value["shape"]] for key, value in header.items() if key != "__metadata__"},
+            }
+            metadata = header.get("__metadata__", {})
+            for key in ["cache_key", "shared_cache"]:
+                if key in metadata:
+                    entry[key] = metadata[key]
+            if get_item_info is not None:
+                entry.update(get_item_info(name))
+            items[name] = entry
+            num_updated += 1
+
+        logger.info(f"cache manifest: {len(items)} items, {num_updated} new or updated")
+        self.items = items
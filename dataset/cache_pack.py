@@ -0,0 +1,267 @@
+import json
+import os
+import threading
+from typing import Optional
+
+import torch
+import safetensors.torch
+
+import logging
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+# Packed cache format
+#
+# Instead of one small safetensors file per item, items are appended to large shard files and located by a compact index.
+# - shard files: `{name}_{shard_id:05d}.pack`, a concatenation of safetensors blobs. Each blob is exactly what the per-file
+#   format would write to `*.safetensors`, so the same tensors and metadata are stored.
+# - index file: `{name}.index.jsonl`, one JSON record per line:
+#   {"key": ..., "shard": 0, "offset": 0, "length": 1234, "bucket": [w, h, f], "frame_count": f, "original_size": [w, h],
+#    "cache_key": "..."}
+#   The key is the basename of the cache file in the per-file format. Later records override earlier records with the
+#   same key, and a record with `"removed": true` deletes the key. Both shards and index are append-only while caching,
+#   so an interrupted caching run leaves a consistent (prefix of the) index.
+
+PACK_SHARD_EXTENSION = ".pack"
+PACK_INDEX_SUFFIX = ".index.jsonl"
+DEFAULT_MAX_SHARD_SIZE = 2 * 1024**3  # 2GB
+
+
+class CachePack:
+    def __init__(self, directory: str, name: str, max_shard_size: int = DEFAULT_MAX_SHARD_SIZE):
+        self.directory = directory
+        self.name = name
+        self.max_shard_size = max_shard_size
+        self.index_path = os.path.join(directory, f"{name}{PACK_INDEX_SUFFIX}")
+
+        self.entries: dict[str, dict] = {}
+        self.num_index_records = 0
+
+        # file handles are opened lazily, and are not shared between processes (DataLoader workers)
+        self.lock = threading.Lock()
+        self.writer_shard_id: Optional[int] = None
+        self.writer = None
+        self.index_writer = None
+        self.readers: dict[int, int] = {}  # shard_id -> fd
+        self.readers_pid = os.getpid()
+
+        self.load_index()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["lock"] = None
+        state["writer_shard_id"] = None
+        state["writer"] = None
+        state["index_writer"] = None
+        state["readers"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.readers_pid = os.getpid()
+
+    @staticmethod
+    def exists(directory: str, name: str) -> bool:
+        return os.path.exists(os.path.join(directory, f"{name}{PACK_INDEX_SUFFIX}"))
+
+    def get_shard_path(self, shard_id: int) -> str:
+        return os.path.join(self.directory, f"{self.name}_{shard_id:05d}{PACK_SHARD_EXTENSION}")
+
+    def get_existing_shard_ids(self) -> list[int]:
+        if not os.path.isdir(self.directory):
+            return []
+        prefix = f"{self.name}_"
+        shard_ids = []
+        for file_name in os.listdir(self.directory):
+            if file_name.startswith(prefix) and file_name.endswith(PACK_SHARD_EXTENSION):
+                shard_id = file_name[len(prefix) : -len(PACK_SHARD_EXTENSION)]
+                if shard_id.isdigit():
+                    shard_ids.append(int(shard_id))
+        shard_ids.sort()
+        return shard_ids
+
+    def load_index(self):
+        self.entries = {}
+        self.num_index_records = 0
+        if not os.path.exists(self.index_path):
+            return
+
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line may be truncated if caching was interrupted
+                    logger.warning(f"broken record in pack index, ignored: {self.index_path}")
+                    continue
+
+                self.num_index_records += 1
+                if record.get("removed", False):
+                    self.entries.pop(record["key"], None)
+                else:
+                    self.entries[record["key"]] = record
+
+        logger.info(f"loaded pack index: {self.index_path}, {len(self.entries)} items")
+
+    def keys(self) -> list[str]:
+        return list(self.entries.keys())
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get_entry(self, key: str) -> Optional[dict]:
+        return self.entries.get(key)
+
+    # region writing
+
+    def _append_index_record(self, record: dict):
+        if self.index_writer is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self.index_writer = open(self.index_path, "a", encoding="utf-8")
+        self.index_writer.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.index_writer.flush()
+        self.num_index_records += 1
+
+    def _get_writer(self, length: int):
+        if self.writer is not None and self.writer.tell() + length > self.max_shard_size and self.writer.tell() > 0:
+            self.writer.close()
+            self.writer = None
+
+        if self.writer is None:
+            # always start a new shard, never append to a shard written by another run
+            existing_shard_ids = self.get_existing_shard_ids()
+            next_shard_id = max(existing_shard_ids) + 1 if existing_shard_ids else 0
+            if self.writer_shard_id is not None:
+                next_shard_id = max(next_shard_id, self.writer_shard_id + 1)
+            self.writer_shard_id = next_shard_id
+
+            os.makedirs(self.directory, exist_ok=True)
+            self.writer = open(self.get_shard_path(self.writer_shard_id), "ab")
+
+        return self.writer
+
+    def append(
+        self,
+        key: str,
+        sd: dict[str, torch.Tensor],
+        metadata: Optional[dict[str, str]] = None,
+        bucket: Optional[tuple[int, ...]] = None,
+        frame_count: Optional[int] = None,
+        original_size: Optional[tuple[int, int]] = None,
+        cache_key: Optional[str] = None,
+    ):
+        """
+        Append an item to the current shard. This method is thread safe.
+        """
+        data = safetensors.torch.save(sd, metadata=metadata)
+
+        with self.lock:
+            writer = self._get_writer(len(data))
+            offset = writer.tell()
+            writer.write(data)
+            writer.flush()
+
+            record = {"key": key, "shard": self.writer_shard_id, "offset": offset, "length": len(data)}
+            if bucket is not None:
+                record["bucket"] = list(bucket)
+            if frame_count is not None:
+                record["frame_count"] = frame_count
+            if original_size is not None:
+                record["original_size"] = list(original_size)
+            if cache_key is not None:
+                record["cache_key"] = cache_key
+
+            self._append_index_record(record)
+            self.entries[key] = record
+
+    def remove(self, key: str):
+        with self.lock:
+            if key not in self.entries:
+                return
+            self._append_index_record({"key": key, "removed": True})
+            del self.entries[key]
+
+    def close(self):
+        """
+        Close the writer, rewrite the index without overridden/removed records, and delete shards with no live items.
+        """
+        with self.lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            if self.index_writer is not None:
+                self.index_writer.close()
+                self.index_writer = None
+            self._close_readers()
+
+            if self.num_index_records > len(self.entries):
+                tmp_index_path = self.index_path + ".tmp"
+                with open(tmp_index_path, "w", encoding="utf-8") as f:
+                    for record in self.entries.values():
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                os.replace(tmp_index_path, self.index_path)
+                self.num_index_records = len(self.entries)
+
+            live_shard_ids = set(record["shard"] for record in self.entries.values())
+            for shard_id in self.get_existing_shard_ids():
+                if shard_id not in live_shard_ids:
+                    shard_path = self.get_shard_path(shard_id)
+                    os.remove(shard_path)
+                    logger.info(f"Removed pack shard with no items: {shard_path}")
+
+    # endregion
+
+    # region reading
+
+    def _close_readers(self):
+        if self.readers_pid == os.getpid():
+            for fd in self.readers.values():
+                os.close(fd)
+        self.readers = {}
+        self.readers_pid = os.getpid()
+
+    def _get_reader(self, shard_id: int) -> int:
+        if self.readers_pid != os.getpid():
+            # forked: do not share file offsets with the parent process
+            self.readers = {}
+            self.readers_pid = os.getpid()
+
+        fd = self.readers.get(shard_id)
+        if fd is None:
+            flags = os.O_RDONLY | getattr(os, "O_BINARY", 0)
+            fd = os.open(self.get_shard_path(shard_id), flags)
+            self.readers[shard_id] = fd
+        return fd
+
+    def get_location(self, key: str) -> tuple[str, int]:
+        """
+        Returns the shard path and the offset of the safetensors blob of the item.
+        """
+        entry = self.entries[key]
+        return self.get_shard_path(entry["shard"]), entry["offset"]
+
+    def read_bytes(self, key: str) -> bytes:
+        entry = self.entries[key]
+        fd = self._get_reader(entry["shard"])
+        if hasattr(os, "pread"):
+            data = os.pread(fd, entry["length"], entry["offset"])
+        else:
+            with self.lock:  # Windows: no pread
+                os.lseek(fd, entry["offset"], os.SEEK_SET)
+                data = os.read(fd, entry["length"])
+        assert len(data) == entry["length"], f"pack shard is truncated: {self.get_shard_path(entry['shard'])}, key: {key}"
+        return data
+
+    def load(self, key: str) -> dict[str, torch.Tensor]:
+        return safetensors.torch.load(self.read_bytes(key))
+
+    # endregion
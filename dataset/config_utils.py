@@ -35,6 +35,7 @@ class BaseDatasetParams:
     cache_directory: Optional[str] = None
     debug_dataset: bool = False
     architecture: str = "no_default"  # short style like "hv" or "wan"
+    cache_format: str = "file"  # "file" or "pack"
 
 
 @dataclass
@@ -51,6 +52,7 @@ class VideoDatasetParams(BaseDatasetParams):
     frame_extraction: Optional[str] = "head"
     frame_stride: Optional[int] = 1
     frame_sample: Optional[int] = 1
+    streaming_extraction: bool = False
 
 
 @dataclass
@@ -94,6 +96,7 @@ class ConfigSanitizer:
         "resolution": functools.partial(__validate_and_convert_scalar_or_twodim.__func__, int),
         "enable_bucket": bool,
         "bucket_no_upscale": bool,
+        "cache_format": Any("file", "pack"),
     }
     IMAGE_DATASET_DISTINCT_SCHEMA = {
         "image_directory": str,
@@ -107,6 +110,7 @@ class ConfigSanitizer:
         "frame_extraction": str,
         "frame_stride": int,
         "frame_sample": int,
+        "streaming_extraction": bool,
         "cache_directory": str,
     }
 
@@ -267,6 +271,7 @@ def generate_dataset_group_by_blueprint(dataset_group_blueprint: DatasetGroupBlu
         enable_bucket: {dataset.enable_bucket}
         bucket_no_upscale: {dataset.bucket_no_upscale}
         cache_directory: "{dataset.cache_directory}"
+        cache_format: {dataset.cache_format}
         debug_dataset: {dataset.debug_dataset}
     """
         )
@@ -291,6 +296,7 @@ def generate_dataset_group_by_blueprint(dataset_group_blueprint: DatasetGroupBlu
         frame_extraction: {dataset.frame_extraction}
         frame_stride: {dataset.frame_stride}
         frame_sample: {dataset.frame_sample}
+        streaming_extraction: {dataset.streaming_extraction}
     \n"""
                 ),
                 "    ",
@@ -1,20 +1,28 @@
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+import functools
 import glob
 import json
 import math
+import multiprocessing
+from multiprocessing import shared_memory
 import os
+import queue
 import random
+import threading
 import time
-from typing import Optional, Sequence, Tuple, Union
+from typing import Callable, Iterator, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from safetensors.torch import save_file, load_file
 from safetensors import safe_open
 from PIL import Image
 import cv2
 import av
 
+from dataset.cache_manifest import CacheManifest, read_safetensors_header
+from dataset.cache_pack import CachePack
 from utils import safetensors_utils
 from utils.model_utils import dtype_to_str
 
@@ -77,6 +85,14 @@ ARCHITECTURE_HUNYUAN_VIDEO_FULL = "hunyuan_video"
 ARCHITECTURE_WAN = "wan"
 ARCHITECTURE_WAN_FULL = "wan"
 
+CACHE_FORMAT_FILE = "file"  # one safetensors file per item
+CACHE_FORMAT_PACK = "pack"  # append-only shard files with an index, see cache_pack.py
+
+# shared text encoder output cache: `{share key}_{architecture}_te_shared.safetensors` has the outputs of one caption, and
+# the text encoder output cache of each item with the same caption has no tensors, only the name of the shared cache in
+# the metadata "shared_cache"
+TEXT_ENCODER_OUTPUT_SHARED_CACHE_SUFFIX = "_te_shared.safetensors"
+
 
 def glob_images(directory, base="*"):
     img_paths = []
@@ -145,6 +161,42 @@ def resize_image_to_bucket(image: Union[Image.Image, np.ndarray], bucket_reso: t
     return image
 
 
+def resize_tensor_to_bucket(frames: torch.Tensor, bucket_reso: tuple[int, int]) -> torch.Tensor:
+    """
+    Resize the frames to the bucket resolution and crop the center on the device of the frames. The same sizes as
+    resize_image_to_bucket are used: "area" for downscaling (cv2.INTER_AREA) and bicubic with antialiasing for upscaling (in
+    place of LANCZOS, which is not available in PyTorch). The results are close to, but not exactly the same as, the CPU path.
+
+    frames: uint8 or float tensor, N, C, H, W, in [0, 255]
+    Returns: float32 tensor, N, C, bucket_height, bucket_width, in [0, 255]
+    """
+    image_height, image_width = frames.shape[2:4]
+    frames = frames.to(torch.float32)
+
+    bucket_width, bucket_height = bucket_reso
+    if (bucket_width, bucket_height) == (image_width, image_height):
+        return frames
+
+    if bucket_width != image_width and bucket_height != image_height:
+        # resize the image to the bucket resolution to match the short side
+        scale_width = bucket_width / image_width
+        scale_height = bucket_height / image_height
+        scale = max(scale_width, scale_height)
+        image_width = int(image_width * scale + 0.5)
+        image_height = int(image_height * scale + 0.5)
+
+        if scale > 1:
+            frames = F.interpolate(frames, size=(image_height, image_width), mode="bicubic", antialias=True, align_corners=False)
+        else:
+            frames = F.interpolate(frames, size=(image_height, image_width), mode="area")
+        frames = frames.round().clamp(0, 255)  # same as the uint8 conversion in the CPU path
+
+    # crop the image to the bucket resolution
+    crop_left = (image_width - bucket_width) // 2
+    crop_top = (image_height - bucket_height) // 2
+    return frames[:, :, crop_top : crop_top + bucket_height, crop_left : crop_left + bucket_width]
+
+
 class ItemInfo:
     def __init__(
         self,
@@ -163,8 +215,17 @@ class ItemInfo:
         self.frame_count = frame_count
         self.content = content
         self.latent_cache_path = latent_cache_path
+        self.latent_cache_pack: Optional[CachePack] = None  # if set, latent_cache_path is a key in the pack, not a file
         self.text_encoder_output_cache_path: Optional[str] = None
 
+        # for caching: identity of the inputs of the latent cache, and the key computed from it and the encoder
+        self.source_identity: Optional[dict] = None
+        self.cache_key: Optional[str] = None
+
+        # for caching: windows of the same video with the same start frame and fewer frames. Their latents are the leading
+        # latent frames of this item, because the video VAE is causal
+        self.prefix_items: list["ItemInfo"] = []
+
     def __str__(self) -> str:
         return (
             f"ItemInfo(item_key={self.item_key}, caption={self.caption}, "
@@ -173,6 +234,15 @@ class ItemInfo:
         )
 
 
+def get_source_identity(path: str) -> dict:
+    """
+    Returns the identity of the source image or video file to detect the change of the source for the latent cache.
+    The path is not included, so moving the dataset directory does not invalidate the cache.
+    """
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
 # We use simple if-else approach to support multiple architectures.
 # Maybe we can use a plugin system in the future.
 
@@ -219,6 +289,8 @@ def save_latent_cache_common(item_info: ItemInfo, sd: dict[str, torch.Tensor], a
     }
     if item_info.frame_count is not None:
         metadata["frame_count"] = f"{item_info.frame_count}"
+    if item_info.cache_key is not None:
+        metadata["cache_key"] = item_info.cache_key
 
     for key, value in sd.items():
         # NaN check and show warning, replace NaN with 0
@@ -226,6 +298,18 @@ def save_latent_cache_common(item_info: ItemInfo, sd: dict[str, torch.Tensor], a
             logger.warning(f"{key} tensor has NaN: {item_info.item_key}, replace NaN with 0")
             value[torch.isnan(value)] = 0
 
+    if item_info.latent_cache_pack is not None:
+        item_info.latent_cache_pack.append(
+            os.path.basename(item_info.latent_cache_path),
+            sd,
+            metadata=metadata,
+            bucket=item_info.bucket_size,
+            frame_count=item_info.frame_count,
+            original_size=item_info.original_size,
+            cache_key=item_info.cache_key,
+        )
+        return
+
     latent_dir = os.path.dirname(item_info.latent_cache_path)
     os.makedirs(latent_dir, exist_ok=True)
 
@@ -288,6 +372,7 @@ def save_text_encoder_output_cache_common(item_info: ItemInfo, sd: dict[str, tor
 
         existing_metadata.pop("caption1", None)
         existing_metadata.pop("format_version", None)
+        existing_metadata.pop("shared_cache", None)  # the existing cache may be a link to the shared cache
         metadata.update(existing_metadata)  # copy existing metadata except caption and format_version
     else:
         text_encoder_output_dir = os.path.dirname(item_info.text_encoder_output_cache_path)
@@ -296,6 +381,27 @@ def save_text_encoder_output_cache_common(item_info: ItemInfo, sd: dict[str, tor
     safetensors_utils.mem_eff_save_file(sd, item_info.text_encoder_output_cache_path, metadata=metadata)
 
 
+def get_shared_text_encoder_output_cache_path(cache_directory: str, share_key: str, architecture: str) -> str:
+    return os.path.join(cache_directory, f"{share_key}_{architecture}{TEXT_ENCODER_OUTPUT_SHARED_CACHE_SUFFIX}")
+
+
+def save_text_encoder_output_cache_link(item_info: ItemInfo, shared_cache_path: str, arch_fullname: str):
+    """
+    Save the text encoder output cache of the item as a link to the shared cache with the outputs of the same caption.
+    The existing cache is overwritten, the shared cache must have all outputs.
+    """
+    metadata = {
+        "architecture": arch_fullname,
+        "caption1": item_info.caption,
+        "format_version": "1.0.1",
+        "shared_cache": os.path.basename(shared_cache_path),
+    }
+
+    text_encoder_output_dir = os.path.dirname(item_info.text_encoder_output_cache_path)
+    os.makedirs(text_encoder_output_dir, exist_ok=True)
+    safetensors_utils.mem_eff_save_file({}, item_info.text_encoder_output_cache_path, metadata=metadata)
+
+
 class BucketSelector:
     RESOLUTION_STEPS_HUNYUAN = 16
     RESOLUTION_STEPS_WAN = 16
@@ -352,6 +458,305 @@ class BucketSelector:
         return self.bucket_resolutions[bucket_id]
 
 
+def get_frame_windows(
+    frame_count: int,
+    frame_extraction: str,
+    target_frames: list[int],
+    frame_stride: Optional[int] = 1,
+    frame_sample: Optional[int] = 1,
+) -> list[tuple[int, int]]:
+    """
+    Returns the windows (start frame, frame count) to extract from a video with frame_count frames.
+    """
+    crop_pos_and_frames = []
+    if frame_extraction == "head":
+        for target_frame in target_frames:
+            if frame_count >= target_frame:
+                crop_pos_and_frames.append((0, target_frame))
+    elif frame_extraction == "chunk":
+        # split by target_frames
+        for target_frame in target_frames:
+            for i in range(0, frame_count, target_frame):
+                if i + target_frame <= frame_count:
+                    crop_pos_and_frames.append((i, target_frame))
+    elif frame_extraction == "slide":
+        # slide window
+        for target_frame in target_frames:
+            if frame_count >= target_frame:
+                for i in range(0, frame_count - target_frame + 1, frame_stride):
+                    crop_pos_and_frames.append((i, target_frame))
+    elif frame_extraction == "uniform":
+        # select N frames uniformly
+        for target_frame in target_frames:
+            if frame_count >= target_frame:
+                frame_indices = np.linspace(0, frame_count - target_frame, frame_sample, dtype=int)
+                for i in frame_indices:
+                    crop_pos_and_frames.append((int(i), target_frame))
+    else:
+        raise ValueError(f"frame_extraction {frame_extraction} is not supported")
+    return crop_pos_and_frames
+
+
+def group_prefix_windows(
+    window_positions: list[tuple[int, int, int]],
+) -> list[tuple[int, int, int, list[int]]]:
+    """
+    Groups the windows (start frame, frame count, position in the frames) with the same start frame. Returns the longest
+    window of each group with the frame counts of the other windows, which are the prefixes of the longest window.
+    """
+    groups: dict[int, list[tuple[int, int, int]]] = {}
+    for window in window_positions:
+        groups.setdefault(window[0], []).append(window)
+
+    grouped_windows = []
+    for windows in groups.values():
+        windows = sorted(windows, key=lambda window: window[1], reverse=True)
+        start, count, pos = windows[0]
+        prefix_counts = sorted(set(window[1] for window in windows[1:] if window[1] < count))
+        grouped_windows.append((start, count, pos, prefix_counts))
+    return grouped_windows
+
+
+class VideoReader:
+    """
+    Reads frames of a video with PyAV. When the requested frames are far ahead, it seeks to the keyframe before them, so
+    only the needed part of the video is decoded. Several frame ranges can be read from one open container.
+
+    Frames are converted to RGB ndarrays by the decoder and resized without PIL (except for upscaling).
+    """
+
+    SEEK_THRESHOLD = 64  # frames. decoding forward is faster than seeking for short gaps
+
+    def __init__(self, video_path: str):
+        self.video_path = video_path
+        self.container = None
+        self._open()
+
+        # the frame index after seeking is computed from the timestamp. it matches the number of decoded frames only if the
+        # frame rate is constant, so variable frame rate videos are always decoded from the beginning
+        self.is_cfr = self._is_constant_frame_rate()
+        self.can_seek = self.is_cfr
+        self.start_pts = self.stream.start_time or 0
+        self._frame_count = self._get_header_frame_count()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _open(self):
+        if self.container is not None:
+            self.container.close()
+        self.container = av.open(self.video_path)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = "AUTO"
+        self.decoder = self.container.decode(self.stream)
+        self.next_index = 0  # index of the next decoded frame
+
+    def close(self):
+        if self.container is not None:
+            self.container.close()
+            self.container = None
+
+    def _is_constant_frame_rate(self) -> bool:
+        avg_rate = self.stream.average_rate
+        base_rate = getattr(self.stream, "base_rate", None) or getattr(self.stream, "guessed_rate", None)
+        if avg_rate is None or avg_rate <= 0 or base_rate is None or base_rate <= 0 or self.stream.time_base is None:
+            return False
+        return abs(float(avg_rate) - float(base_rate)) <= 0.01 * float(base_rate)
+
+    def _get_header_frame_count(self) -> Optional[int]:
+        frames = self.stream.frames
+        if frames <= 0 or not self.is_cfr:
+            return None  # unknown, or the windows computed from it may not match the decoded frames
+
+        if self.stream.duration is not None:
+            # some muxers write a wrong frame count, check it with the duration
+            expected = float(self.stream.duration * self.stream.time_base * self.stream.average_rate)
+            if abs(frames - expected) > max(2, 0.01 * frames):
+                logger.warning(
+                    f"frame count in the header ({frames}) does not match the duration ({expected:.1f} frames), all frames are"
+                    + f" decoded: {self.video_path}"
+                )
+                return None
+        return frames
+
+    @property
+    def frame_count(self) -> Optional[int]:
+        """
+        Number of frames in the container header, None if unknown or unreliable (variable frame rate, or not matching the
+        duration). The callers decode and count all frames if None.
+        """
+        return self._frame_count
+
+    def _pts_to_index(self, pts: int) -> int:
+        return int(round((pts - self.start_pts) * self.stream.time_base * self.stream.average_rate))
+
+    def _decode_next(self) -> Optional[tuple[int, "av.VideoFrame"]]:
+        frame = next(self.decoder, None)
+        if frame is None:
+            return None
+        index = self.next_index
+        self.next_index += 1
+        return index, frame
+
+    def _seek(self, index: int) -> Optional[tuple[int, "av.VideoFrame"]]:
+        """
+        Seek to the keyframe before the frame, and return the first decoded frame.
+        """
+        timestamp = self.start_pts + int(index / (self.stream.average_rate * self.stream.time_base))
+        self.container.seek(timestamp, stream=self.stream, backward=True, any_frame=False)
+        self.decoder = self.container.decode(self.stream)
+
+        frame = next(self.decoder, None)
+        if frame is not None and frame.pts is not None:
+            first_index = self._pts_to_index(frame.pts)
+            if 0 <= first_index <= index:
+                self.next_index = first_index + 1
+                return first_index, frame
+
+        # the timestamps are not reliable for this video, decode from the beginning
+        logger.warning(f"failed to seek in video, decode from the beginning: {self.video_path}")
+        self.can_seek = False
+        self._open()
+        return self._decode_next()
+
+    def iter_ranges(
+        self,
+        ranges: list[tuple[int, Optional[int]]],
+        bucket_selector: Optional[BucketSelector] = None,
+        bucket_reso: Optional[tuple[int, int]] = None,
+    ) -> Iterator[tuple[int, np.ndarray]]:
+        """
+        Decode the frames in the ranges [start, end), end is None for the end of the video. The ranges must be sorted and must
+        not overlap. Yields the index and the frame.
+
+        bucket_reso: if given, resize the frames to the bucket resolution, (width, height)
+        """
+        for start, end in ranges:
+            if self.next_index > start:
+                self._open()  # rewind
+            if self.can_seek and start - self.next_index > VideoReader.SEEK_THRESHOLD:
+                decoded = self._seek(start)
+            else:
+                decoded = self._decode_next()
+
+            while decoded is not None:
+                index, frame = decoded
+                if index >= start:
+                    frame = frame.to_ndarray(format="rgb24")
+                    if bucket_selector is not None and bucket_reso is None:
+                        bucket_reso = bucket_selector.get_bucket_resolution((frame.shape[1], frame.shape[0]))
+                    if bucket_reso is not None:
+                        frame = resize_image_to_bucket(frame, bucket_reso)
+
+                    yield index, frame
+                    if end is not None and index + 1 >= end:
+                        break
+                decoded = self._decode_next()
+
+            if decoded is None:
+                break  # end of the video
+
+    def read_ranges(
+        self,
+        ranges: list[tuple[int, Optional[int]]],
+        bucket_selector: Optional[BucketSelector] = None,
+        bucket_reso: Optional[tuple[int, int]] = None,
+    ) -> tuple[list[int], list[np.ndarray]]:
+        """
+        Read the frames in the ranges. Returns the indices of the read frames and the frames.
+        """
+        indices = []
+        frames = []
+        for index, frame in self.iter_ranges(ranges, bucket_selector, bucket_reso):
+            indices.append(index)
+            frames.append(frame)
+        return indices, frames
+
+    @staticmethod
+    def merge_windows(windows: list[tuple[int, int]]) -> list[tuple[int, int]]:
+        """
+        Returns the sorted ranges [start, end) of the frames in the windows (start frame, frame count).
+        """
+        ranges = []
+        for start, count in sorted(windows):
+            if len(ranges) > 0 and start <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], start + count)
+            else:
+                ranges.append([start, start + count])
+        return [tuple(r) for r in ranges]
+
+    def read_windows_packed(
+        self,
+        windows: list[tuple[int, int]],
+        bucket_selector: Optional[BucketSelector] = None,
+        bucket_reso: Optional[tuple[int, int]] = None,
+    ) -> tuple[Optional[np.ndarray], list[tuple[int, int, int]]]:
+        """
+        Read the windows (start frame, frame count). Overlapping windows are read once. Returns the frames of all windows in
+        one array, and (start frame, frame count, position in the array) for each window which is completely in the video.
+        """
+        if len(windows) == 0:
+            return None, []
+
+        indices, frames = self.read_ranges(VideoReader.merge_windows(windows), bucket_selector, bucket_reso)
+        if len(frames) == 0:
+            return None, []
+
+        video = np.stack(frames, axis=0)
+        del frames
+        positions = {index: i for i, index in enumerate(indices)}
+
+        window_positions = []
+        for start, count in windows:
+            pos = positions.get(start)
+            if pos is None or start + count - 1 not in positions:
+                continue  # the video is shorter than the frame count in the header
+            window_positions.append((start, count, pos))
+        return video, window_positions
+
+    def iter_windows(
+        self,
+        windows: list[tuple[int, int]],
+        bucket_selector: Optional[BucketSelector] = None,
+        bucket_reso: Optional[tuple[int, int]] = None,
+    ) -> Iterator[tuple[int, int, np.ndarray]]:
+        """
+        Streaming version of read_windows_packed. Each window is yielded as soon as its last frame is decoded, and the frames which no
+        remaining window needs are released. The memory is bounded by the largest window, not by the length of the video.
+        """
+        if len(windows) == 0:
+            return
+
+        windows = sorted(windows, key=lambda w: (w[0] + w[1], w[0]))  # by the end frame
+
+        # min_starts[i]: the first frame needed by windows[i:]
+        min_starts = [0] * len(windows)
+        min_start = math.inf
+        for i in reversed(range(len(windows))):
+            min_start = min(min_start, windows[i][0])
+            min_starts[i] = min_start
+
+        frames: dict[int, np.ndarray] = {}  # decoded frames in ascending order of the index
+        next_window = 0
+        for index, frame in self.iter_ranges(VideoReader.merge_windows(windows), bucket_selector, bucket_reso):
+            frames[index] = frame
+
+            while next_window < len(windows) and sum(windows[next_window]) - 1 <= index:
+                start, count = windows[next_window]
+                next_window += 1
+                yield start, count, np.stack([frames[i] for i in range(start, start + count)], axis=0)
+
+            if next_window == len(windows):
+                break
+
+            # release the frames before the first frame of the remaining windows
+            while len(frames) > 0 and next(iter(frames)) < min_starts[next_window]:
+                del frames[next(iter(frames))]
+
+
 def load_video(
     video_path: str,
     start_frame: Optional[int] = None,
@@ -362,28 +767,258 @@ def load_video(
     """
     bucket_reso: if given, resize the video to the bucket resolution, (width, height)
     """
-    container = av.open(video_path)
-    video = []
-    for i, frame in enumerate(container.decode(video=0)):
-        if start_frame is not None and i < start_frame:
-            continue
-        if end_frame is not None and i >= end_frame:
-            break
-        frame = frame.to_image()
-
-        if bucket_selector is not None and bucket_reso is None:
-            bucket_reso = bucket_selector.get_bucket_resolution(frame.size)
-
-        if bucket_reso is not None:
-            frame = resize_image_to_bucket(frame, bucket_reso)
-        else:
-            frame = np.array(frame)
-
-        video.append(frame)
-    container.close()
+    with VideoReader(video_path) as reader:
+        _, video = reader.read_ranges([(start_frame or 0, end_frame)], bucket_selector, bucket_reso)
     return video
 
 
+def load_video_windows_packed(
+    video_path: str,
+    get_windows: Callable[[int], list[tuple[int, int]]],
+    bucket_selector: Optional[BucketSelector] = None,
+    bucket_reso: Optional[tuple[int, int]] = None,
+) -> tuple[Optional[np.ndarray], list[tuple[int, int, int]]]:
+    """
+    Read the windows returned by get_windows(frame_count) from one open container. Only the frames in the windows are decoded
+    if the frame count is in the container header. Returns the frames of all windows in one array, and (start frame, frame
+    count, position in the array) for each window.
+    """
+    with VideoReader(video_path) as reader:
+        if reader.frame_count is not None:
+            return reader.read_windows_packed(get_windows(reader.frame_count), bucket_selector, bucket_reso)
+
+        # frame count is unknown: decode all frames
+        _, frames = reader.read_ranges([(0, None)], bucket_selector, bucket_reso)
+
+    if len(frames) == 0:
+        return None, []
+    windows = get_windows(len(frames))
+    video = np.stack(frames, axis=0)
+    return video, [(start, count, start) for start, count in windows]
+
+
+def iter_video_windows(
+    video_path: str,
+    get_windows: Callable[[int], list[tuple[int, int]]],
+    bucket_selector: Optional[BucketSelector] = None,
+    bucket_reso: Optional[tuple[int, int]] = None,
+) -> Iterator[tuple[int, int, np.ndarray]]:
+    """
+    Streaming version of load_video_windows_packed. Each window is yielded as soon as it is decoded, and each window has its own
+    frames.
+    """
+    with VideoReader(video_path) as reader:
+        if reader.frame_count is not None:
+            yield from reader.iter_windows(get_windows(reader.frame_count), bucket_selector, bucket_reso)
+            return
+
+        # frame count is unknown: the windows are not known until the end of the video
+        logger.warning(f"frame count is unknown, all frames are decoded into memory: {video_path}")
+        _, frames = reader.read_ranges([(0, None)], bucket_selector, bucket_reso)
+
+    if len(frames) == 0:
+        return
+    windows = get_windows(len(frames))
+    video = np.stack(frames, axis=0)
+    del frames
+    for start, count in windows:
+        yield start, count, video[start : start + count]
+
+
+DECODE_BACKEND_THREAD = "thread"
+DECODE_BACKEND_PROCESS = "process"
+
+
+class DecodeStats:
+    """
+    Throughput of loading and resizing the images and videos in retrieve_latent_cache_batches. This method is thread safe.
+    """
+
+    def __init__(self, num_workers: int):
+        self.num_workers = num_workers
+        self.num_items = 0
+        self.num_frames = 0
+        self.worker_seconds = 0.0  # sum of the time of all workers
+        self.start_time = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def add(self, num_items: int, num_frames: int, seconds: float):
+        with self.lock:
+            self.num_items += num_items
+            self.num_frames += num_frames
+            self.worker_seconds += seconds
+
+    def summary(self) -> str:
+        elapsed = time.perf_counter() - self.start_time
+        # throughput if all workers are busy, which is the upper limit of the decoding
+        capacity = self.num_frames * self.num_workers / self.worker_seconds if self.worker_seconds > 0 else 0.0
+        return (
+            f"decode: {self.num_items} items, {self.num_frames} frames in {elapsed:.1f}s, {self.num_frames / max(elapsed, 1e-6):.1f}"
+            f" frames/s, capacity {capacity:.1f} frames/s with {self.num_workers} workers"
+        )
+
+
+def iter_completed_futures(
+    executor: Executor,
+    tasks: Iterator[tuple[Callable, tuple]],
+    max_in_flight: int,
+    release: Optional[Callable[[Future], None]] = None,
+) -> Iterator[Future]:
+    """
+    Submit the tasks (function, args) to the executor, keeping at most max_in_flight tasks submitted, and yield the futures in
+    the order of completion. The completion is notified by the callback of the future, so no polling is needed.
+
+    If the iteration stops early (exception or close), the pending tasks are cancelled, the running tasks are waited for, and
+    release is called for each successful future which is not yielded, e.g. to free the shared memory of its result.
+    """
+    completed_futures = queue.Queue()
+    in_flight: set[Future] = set()
+    tasks_exhausted = False
+    try:
+        while True:
+            while not tasks_exhausted and len(in_flight) < max_in_flight:
+                task = next(tasks, None)
+                if task is None:
+                    tasks_exhausted = True
+                    break
+                fn, args = task
+                future = executor.submit(fn, *args)
+                in_flight.add(future)
+                future.add_done_callback(completed_futures.put)
+
+            if len(in_flight) == 0:
+                return
+            future = completed_futures.get()
+            in_flight.discard(future)
+            yield future
+    finally:
+        if release is not None and len(in_flight) > 0:
+            for future in in_flight:
+                future.cancel()
+            wait(in_flight)
+            for future in in_flight:
+                if not future.cancelled() and future.exception() is None:
+                    release(future)
+
+
+def _init_decode_worker():
+    cv2.setNumThreads(1)  # each process decodes one item, avoid oversubscription
+
+
+def create_decode_process_pool(num_workers: int) -> ProcessPoolExecutor:
+    """
+    Process pool for loading and resizing, which is not limited by the GIL. "spawn" is used because the caller may already
+    have initialized CUDA. The decoded frames are passed back through shared memory.
+    """
+    return ProcessPoolExecutor(
+        max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_decode_worker
+    )
+
+
+SharedArray = Union[np.ndarray, tuple[str, tuple[int, ...], str]]
+
+
+def to_shared_memory(array: np.ndarray) -> SharedArray:
+    """
+    Copy the array to a new shared memory block. Returns (name, shape, dtype) to pass to from_shared_memory in another process,
+    which unlinks the block.
+
+    On Windows, a named shared memory block is freed when its last handle is closed, which can be before the other process
+    attaches. The array itself is returned there, and it is pickled to the other process.
+    """
+    if os.name == "nt":
+        return array
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    shm.close()
+    return shm.name, array.shape, array.dtype.str
+
+
+def from_shared_memory(shared: SharedArray) -> np.ndarray:
+    """
+    Copy the array out of the shared memory block and unlink the block. The block is released immediately, so the number of
+    blocks is bounded by the number of tasks in flight.
+    """
+    if isinstance(shared, np.ndarray):
+        return shared
+    name, shape, dtype = shared
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return array
+
+
+def release_shared_memory(shared: Optional[SharedArray]):
+    """
+    Unlink the shared memory block of a result which is not received by from_shared_memory.
+    """
+    if shared is None or isinstance(shared, np.ndarray):
+        return
+    try:
+        shm = shared_memory.SharedMemory(name=shared[0])
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def release_fetched_shared_memory(future: Future):
+    """
+    Release the frames of a result of fetch_image_for_latent_cache or fetch_video_windows_for_latent_cache.
+    """
+    release_shared_memory(future.result()[2])
+
+
+def fetch_image_for_latent_cache(
+    image_path: str, caption: str, bucket_selector: BucketSelector, resize: bool = True
+) -> tuple[tuple[int, int], str, SharedArray, str, dict, float]:
+    """
+    Worker function of the process backend: load and resize the image, and return it through shared memory.
+    """
+    start_time = time.perf_counter()
+    image = Image.open(image_path).convert("RGB")
+    image_size = image.size
+    if resize:
+        image = resize_image_to_bucket(image, bucket_selector.get_bucket_resolution(image_size))
+    else:
+        image = np.array(image)
+    image = to_shared_memory(image)
+    return image_size, image_path, image, caption, get_source_identity(image_path), time.perf_counter() - start_time
+
+
+def fetch_video_windows_for_latent_cache(
+    video_path: str,
+    caption: str,
+    bucket_selector: Optional[BucketSelector],
+    get_windows: Callable[[int], list[tuple[int, int]]],
+    end_frame: Optional[int],
+) -> tuple[Optional[tuple[int, int]], str, Optional[SharedArray], list[tuple[int, int, int]], str, dict, float]:
+    """
+    Worker function of the process backend: decode and resize the frames of the windows, and return them through shared
+    memory with (start frame, frame count, position) of the windows. If end_frame is given (head extraction), the frames up to
+    it are decoded and the windows are computed from the number of decoded frames. The frames are not resized if
+    bucket_selector is None.
+    """
+    start_time = time.perf_counter()
+    if end_frame is not None:
+        frames = load_video(video_path, 0, end_frame, bucket_selector)
+        video = np.stack(frames, axis=0) if len(frames) > 0 else None
+        del frames
+        window_positions = [(start, count, start) for start, count in get_windows(len(video))] if video is not None else []
+    else:
+        video, window_positions = load_video_windows_packed(video_path, get_windows, bucket_selector)
+
+    if video is None:
+        return None, video_path, None, [], caption, None, time.perf_counter() - start_time
+
+    frame_size = (video.shape[2], video.shape[1])
+    video = to_shared_memory(video)
+    return frame_size, video_path, video, window_positions, caption, get_source_identity(video_path), time.perf_counter() - start_time
+
+
 class BucketBatchManager:
 
     def __init__(self, bucketed_item_info: dict[tuple[int, int], list[ItemInfo]], batch_size: int):
@@ -399,6 +1034,10 @@ class BucketBatchManager:
             for i in range(num_batches):
                 self.bucket_batch_indices.append((bucket_reso, i))
 
+        # cache files are kept memory-mapped and their headers are parsed only once
+        self.cache_reader = safetensors_utils.MemoryMappedSafeTensorsCache()
+        self.content_keys: dict[str, tuple[str, bool]] = {}  # key in cache file -> (content key, is varlen)
+
         self.shuffle()
 
     def show_bucket_info(self):
@@ -416,44 +1055,97 @@ class BucketBatchManager:
     def __len__(self):
         return len(self.bucket_batch_indices)
 
+    def get_content_key(self, key: str) -> tuple[str, bool]:
+        content_key_and_varlen = self.content_keys.get(key)
+        if content_key_and_varlen is not None:
+            return content_key_and_varlen
+
+        is_varlen_key = key.startswith("varlen_")  # varlen keys are not stacked
+        content_key = key
+
+        if is_varlen_key:
+            content_key = content_key.replace("varlen_", "")
+
+        if content_key.endswith("_mask"):
+            pass
+        else:
+            content_key = content_key.rsplit("_", 1)[0]  # remove dtype
+            if content_key.startswith("latents_"):
+                content_key = content_key.rsplit("_", 1)[0]  # remove FxHxW
+
+        content_key_and_varlen = (content_key, is_varlen_key)
+        self.content_keys[key] = content_key_and_varlen
+        return content_key_and_varlen
+
+    @staticmethod
+    def get_cache_locations(item_info: ItemInfo) -> list[tuple[str, int]]:
+        """
+        Returns (path, offset) of the safetensors data of the latent cache and the text encoder output cache.
+        """
+        if item_info.latent_cache_pack is not None:
+            latent_location = item_info.latent_cache_pack.get_location(os.path.basename(item_info.latent_cache_path))
+        else:
+            latent_location = (item_info.latent_cache_path, 0)
+        return [latent_location, (item_info.text_encoder_output_cache_path, 0)]
+
     def __getitem__(self, idx):
         bucket_reso, batch_idx = self.bucket_batch_indices[idx]
         bucket = self.buckets[bucket_reso]
         start = batch_idx * self.batch_size
         end = min(start + self.batch_size, len(bucket))
+        batch_items = bucket[start:end]
 
-        batch_tensor_data = {}
-        varlen_keys = set()
-        for item_info in bucket[start:end]:
-            sd_latent = load_file(item_info.latent_cache_path)
-            sd_te = load_file(item_info.text_encoder_output_cache_path)
-            sd = {**sd_latent, **sd_te}
-
-            # TODO refactor this
-            for key in sd.keys():
-                is_varlen_key = key.startswith("varlen_")  # varlen keys are not stacked
-                content_key = key
-
-                if is_varlen_key:
-                    content_key = content_key.replace("varlen_", "")
-
-                if content_key.endswith("_mask"):
-                    pass
-                else:
-                    content_key = content_key.rsplit("_", 1)[0]  # remove dtype
-                    if content_key.startswith("latents_"):
-                        content_key = content_key.rsplit("_", 1)[0]  # remove FxHxW
-
-                if content_key not in batch_tensor_data:
-                    batch_tensor_data[content_key] = []
-                batch_tensor_data[content_key].append(sd[key])
+        # pin the batch tensors for faster transfer to GPU, only in the main process.
+        # in DataLoader workers, the tensors are moved to shared memory by PyTorch
+        pin_memory = torch.cuda.is_available() and torch.utils.data.get_worker_info() is None
 
-                if is_varlen_key:
-                    varlen_keys.add(content_key)
+        # each tensor is copied once, from the mapped cache file to the preallocated batch tensor
+        batch_tensor_data = {}
+        num_items_for_key = {}
+        varlen_sources: dict[str, list[tuple[str, str, int, torch.dtype, tuple[int, ...]]]] = {}
+        for i, item_info in enumerate(batch_items):
+            for path, offset in self.get_cache_locations(item_info):
+                header, _ = self.cache_reader.get_header(path, offset)
+                for key, (dtype, shape, _, _) in header.items():
+                    content_key, is_varlen_key = self.get_content_key(key)
+
+                    if is_varlen_key:
+                        varlen_sources.setdefault(content_key, []).append((path, key, offset, dtype, shape))
+                        continue
 
-        for key in batch_tensor_data.keys():
-            if key not in varlen_keys:
-                batch_tensor_data[key] = torch.stack(batch_tensor_data[key])
+                    batch_tensor = batch_tensor_data.get(content_key)
+                    if batch_tensor is None:
+                        batch_tensor = torch.empty((len(batch_items), *shape), dtype=dtype, pin_memory=pin_memory)
+                        batch_tensor_data[content_key] = batch_tensor
+                        num_items_for_key[content_key] = 0
+                    assert (
+                        batch_tensor.shape[1:] == shape and batch_tensor.dtype == dtype
+                    ), f"shape or dtype mismatch in a batch: {key} in {path}, {shape} {dtype} vs {tuple(batch_tensor.shape[1:])} {batch_tensor.dtype}"
+
+                    self.cache_reader.copy_tensor_to(path, key, batch_tensor[i], offset)
+                    num_items_for_key[content_key] += 1
+
+        for content_key, num_items in num_items_for_key.items():
+            assert num_items == len(batch_items), f"some items in the batch do not have {content_key}"
+
+        # varlen tensors of the batch are packed along the first dim into one tensor, with the offsets of the items in
+        # `{content_key}_cu_seqlens` (int32, [0, len0, len0 + len1, ...]), so they are moved to the device at once
+        for content_key, sources in varlen_sources.items():
+            assert len(sources) == len(batch_items), f"some items in the batch do not have {content_key}"
+            _, _, _, dtype, shape = sources[0]
+            lengths = [source_shape[0] for _, _, _, _, source_shape in sources]
+            packed_tensor = torch.empty((sum(lengths), *shape[1:]), dtype=dtype, pin_memory=pin_memory)
+
+            cu_seqlens = [0]
+            for (path, key, offset, source_dtype, source_shape), length in zip(sources, lengths):
+                assert (
+                    source_shape[1:] == shape[1:] and source_dtype == dtype
+                ), f"shape or dtype mismatch in a batch: {key} in {path}, {source_shape} {source_dtype} vs {shape} {dtype}"
+                self.cache_reader.copy_tensor_to(path, key, packed_tensor[cu_seqlens[-1] : cu_seqlens[-1] + length], offset)
+                cu_seqlens.append(cu_seqlens[-1] + length)
+
+            batch_tensor_data[content_key] = packed_tensor
+            batch_tensor_data[f"{content_key}_cu_seqlens"] = torch.tensor(cu_seqlens, dtype=torch.int32)
 
         return batch_tensor_data
 
@@ -632,6 +1324,10 @@ class VideoDatasource(ContentDatasource):
         self.start_frame = None
         self.end_frame = None
 
+        # if set, get_windows(frame_count) -> [(start frame, frame count)], and only the frames in the windows are decoded
+        self.frame_windows_getter: Optional[Callable[[int], list[tuple[int, int]]]] = None
+        self.frame_windows_streaming = False  # if True, the windows are returned as an iterator while decoding
+
         self.bucket_selector = None
 
     def __len__(self):
@@ -643,13 +1339,24 @@ class VideoDatasource(ContentDatasource):
         start_frame: Optional[int] = None,
         end_frame: Optional[int] = None,
         bucket_selector: Optional[BucketSelector] = None,
-    ) -> tuple[str, list[Image.Image], str]:
+    ) -> Union[
+        list[np.ndarray],
+        tuple[Optional[np.ndarray], list[tuple[int, int, int]]],
+        Iterator[tuple[int, int, np.ndarray]],
+    ]:
         # this method can resize the video if bucket_selector is given to reduce the memory usage
+        # if frame_windows_getter is set, returns (frames of all windows, [(start frame, frame count, position)]), or the iterator
+        # of (start frame, frame count, frames) if streaming
 
         start_frame = start_frame if start_frame is not None else self.start_frame
         end_frame = end_frame if end_frame is not None else self.end_frame
         bucket_selector = bucket_selector if bucket_selector is not None else self.bucket_selector
 
+        if self.frame_windows_getter is not None:
+            if self.frame_windows_streaming:
+                return iter_video_windows(video_path, self.frame_windows_getter, bucket_selector)
+            return load_video_windows_packed(video_path, self.frame_windows_getter, bucket_selector)
+
         video = load_video(video_path, start_frame, end_frame, bucket_selector)
         return video
 
@@ -657,6 +1364,12 @@ class VideoDatasource(ContentDatasource):
         self.start_frame = start_frame
         self.end_frame = end_frame
 
+    def set_frame_windows_getter(
+        self, get_windows: Optional[Callable[[int], list[tuple[int, int]]]], streaming: bool = False
+    ):
+        self.frame_windows_getter = get_windows
+        self.frame_windows_streaming = streaming
+
     def set_bucket_selector(self, bucket_selector: BucketSelector):
         self.bucket_selector = bucket_selector
 
@@ -812,6 +1525,7 @@ class BaseDataset(torch.utils.data.Dataset):
         cache_directory: Optional[str] = None,
         debug_dataset: bool = False,
         architecture: str = "no_default",
+        cache_format: str = CACHE_FORMAT_FILE,
     ):
         self.resolution = resolution
         self.caption_extension = caption_extension
@@ -822,12 +1536,21 @@ class BaseDataset(torch.utils.data.Dataset):
         self.cache_directory = cache_directory
         self.debug_dataset = debug_dataset
         self.architecture = architecture
+        self.cache_format = cache_format
         self.seed = None
         self.current_epoch = 0
 
         if not self.enable_bucket:
             self.bucket_no_upscale = False
 
+        assert self.cache_format in [
+            CACHE_FORMAT_FILE,
+            CACHE_FORMAT_PACK,
+        ], f"cache_format must be '{CACHE_FORMAT_FILE}' or '{CACHE_FORMAT_PACK}', got {self.cache_format}"
+        self.latent_cache_pack: Optional[CachePack] = None
+        self.latent_cache_manifest: Optional[CacheManifest] = None  # used for checking the cache key in caching
+        self.decode_stats: Optional[DecodeStats] = None  # set by retrieve_latent_cache_batches
+
     def get_metadata(self) -> dict:
         metadata = {
             "resolution": self.resolution,
@@ -839,12 +1562,197 @@ class BaseDataset(torch.utils.data.Dataset):
         }
         return metadata
 
+    def get_latent_cache_pack(self) -> Optional[CachePack]:
+        """
+        Returns the pack for the latent cache if cache_format is "pack", otherwise None.
+        """
+        if self.cache_format != CACHE_FORMAT_PACK:
+            return None
+        if self.latent_cache_pack is None:
+            assert self.cache_directory is not None, "cache_directory is required / cache_directoryは必須です"
+            self.latent_cache_pack = CachePack(self.cache_directory, f"{self.architecture}_latents")
+        return self.latent_cache_pack
+
     def get_all_latent_cache_files(self):
+        latent_cache_pack = self.get_latent_cache_pack()
+        if latent_cache_pack is not None:
+            return [os.path.join(self.cache_directory, key) for key in latent_cache_pack.keys()]
         return glob.glob(os.path.join(self.cache_directory, f"*_{self.architecture}.safetensors"))
 
+    def latent_cache_exists(self, item_info: ItemInfo) -> bool:
+        latent_cache_pack = self.get_latent_cache_pack()
+        if latent_cache_pack is not None:
+            return os.path.basename(item_info.latent_cache_path) in latent_cache_pack
+        return os.path.exists(item_info.latent_cache_path)
+
+    def get_stored_latent_cache_key(self, item_info: ItemInfo) -> Optional[str]:
+        """
+        Returns the cache key stored in the existing latent cache of the item. Returns None if the cache does not exist,
+        and "" if the cache has no key (created by an older version).
+        """
+        name = os.path.basename(item_info.latent_cache_path)
+        latent_cache_pack = self.get_latent_cache_pack()
+        if latent_cache_pack is not None:
+            entry = latent_cache_pack.get_entry(name)
+            return None if entry is None else entry.get("cache_key", "")
+
+        if not os.path.exists(item_info.latent_cache_path):
+            return None
+
+        # use the manifest if the file is not changed after the manifest is written, to avoid reading the header
+        if self.latent_cache_manifest is None:
+            self.latent_cache_manifest = CacheManifest(self.cache_directory, f"{self.architecture}_latents")
+        entry = self.latent_cache_manifest.items.get(name)
+        stat = os.stat(item_info.latent_cache_path)
+        if entry is not None and entry.get("source") == [name, 0, stat.st_size, stat.st_mtime_ns]:
+            return entry.get("cache_key", "")
+
+        header = read_safetensors_header(item_info.latent_cache_path)
+        return header.get("__metadata__", {}).get("cache_key", "")
+
+    def remove_latent_cache_file(self, cache_file: str):
+        latent_cache_pack = self.get_latent_cache_pack()
+        if latent_cache_pack is not None:
+            latent_cache_pack.remove(os.path.basename(cache_file))
+        else:
+            os.remove(cache_file)
+
+    def close_latent_cache(self):
+        """
+        Called after caching. Compacts the pack index and removes unused shards if cache_format is "pack".
+        """
+        if self.latent_cache_pack is not None:
+            self.latent_cache_pack.close()
+
     def get_all_text_encoder_output_cache_files(self):
         return glob.glob(os.path.join(self.cache_directory, f"*_{self.architecture}_te.safetensors"))
 
+    def get_all_shared_text_encoder_output_cache_files(self):
+        return glob.glob(os.path.join(self.cache_directory, f"*_{self.architecture}{TEXT_ENCODER_OUTPUT_SHARED_CACHE_SUFFIX}"))
+
+    def update_latent_cache_manifest(self):
+        """
+        Called after caching. Writes the manifest of the latent cache to load the cache quickly in training.
+        """
+        manifest = CacheManifest(self.cache_directory, f"{self.architecture}_latents")
+        latent_cache_pack = self.get_latent_cache_pack()
+
+        sources = []
+        for cache_file in self.get_all_latent_cache_files():
+            name = os.path.basename(cache_file)
+            if latent_cache_pack is not None:
+                path, offset = latent_cache_pack.get_location(name)
+                sources.append((name, path, offset, latent_cache_pack.get_entry(name)["length"], None))
+            else:
+                stat = os.stat(cache_file)
+                sources.append((name, cache_file, 0, stat.st_size, stat.st_mtime_ns))
+
+        manifest.update(sources, self.parse_latent_cache_file_name)
+        manifest.save()
+
+    def update_text_encoder_output_cache_manifest(self):
+        """
+        Called after caching. Writes the manifest of the text encoder output cache.
+        """
+        manifest = CacheManifest(self.cache_directory, f"{self.architecture}_te")
+
+        sources = []
+        for cache_file in self.get_all_text_encoder_output_cache_files():
+            stat = os.stat(cache_file)
+            sources.append((os.path.basename(cache_file), cache_file, 0, stat.st_size, stat.st_mtime_ns))
+
+        manifest.update(sources)
+        manifest.save()
+
+    def remove_unused_shared_text_encoder_output_cache_files(self, keep_cache: bool = False):
+        """
+        Called after the manifest of the text encoder output cache is updated. Removes the shared caches which are not
+        linked from any item.
+        """
+        manifest = CacheManifest(self.cache_directory, f"{self.architecture}_te")
+        linked_names = set(entry["shared_cache"] for entry in manifest.items.values() if "shared_cache" in entry)
+
+        for cache_file in self.get_all_shared_text_encoder_output_cache_files():
+            if os.path.basename(cache_file) in linked_names:
+                continue
+            if keep_cache:
+                logger.info(f"Keep shared cache file not linked from the dataset: {cache_file}")
+            else:
+                os.remove(cache_file)
+                logger.info(f"Removed old shared cache file: {cache_file}")
+
+    def parse_latent_cache_file_name(self, name: str) -> dict:
+        """
+        Returns the item info from the name of the latent cache file: item_key, original_size, (frame_pos, frame_count)
+        """
+        raise NotImplementedError
+
+    def get_cached_latent_items(self) -> list[dict]:
+        """
+        Returns the cached items with both the latent cache and the text encoder output cache.
+
+        The item info is taken from the manifest written by the caching scripts. The directory is listed once to check that
+        the files exist, and only the files not in the manifest are parsed from their names.
+        """
+        file_names = set(os.listdir(self.cache_directory)) if os.path.isdir(self.cache_directory) else set()
+
+        latent_cache_pack = self.get_latent_cache_pack()
+        if latent_cache_pack is not None:
+            latent_cache_names = latent_cache_pack.keys()
+        else:
+            suffix = f"_{self.architecture}.safetensors"
+            latent_cache_names = [name for name in file_names if name.endswith(suffix)]
+        latent_cache_names = sorted(latent_cache_names)  # make the order of items deterministic
+
+        manifest = CacheManifest(self.cache_directory, f"{self.architecture}_latents")
+        text_encoder_output_manifest = CacheManifest(self.cache_directory, f"{self.architecture}_te")
+
+        cached_items = []
+        num_not_in_manifest = 0
+        num_shared = 0
+        for name in latent_cache_names:
+            item = manifest.items.get(name)
+            if item is None or "item_key" not in item:
+                item = self.parse_latent_cache_file_name(name)
+                num_not_in_manifest += 1
+
+            text_encoder_output_cache_name = f"{item['item_key']}_{self.architecture}_te.safetensors"
+            if text_encoder_output_cache_name not in file_names:
+                logger.warning(
+                    f"Text encoder output cache file not found: {os.path.join(self.cache_directory, text_encoder_output_cache_name)}"
+                )
+                continue
+
+            # the cache may be a link to the shared cache of the same caption
+            text_encoder_output_cache_path = os.path.join(self.cache_directory, text_encoder_output_cache_name)
+            text_encoder_output_entry = text_encoder_output_manifest.items.get(text_encoder_output_cache_name)
+            if text_encoder_output_entry is not None:
+                shared_cache_name = text_encoder_output_entry.get("shared_cache")
+            else:
+                metadata = read_safetensors_header(text_encoder_output_cache_path).get("__metadata__", {})
+                shared_cache_name = metadata.get("shared_cache")
+            if shared_cache_name is not None:
+                if shared_cache_name not in file_names:
+                    logger.warning(f"Shared text encoder output cache file not found: {shared_cache_name}")
+                    continue
+                text_encoder_output_cache_path = os.path.join(self.cache_directory, shared_cache_name)
+                num_shared += 1
+
+            cached_item = {
+                "item_key": item["item_key"],
+                "original_size": tuple(item["original_size"]),
+                "frame_count": item.get("frame_count"),
+                "latent_cache_path": os.path.join(self.cache_directory, name),
+                "text_encoder_output_cache_path": text_encoder_output_cache_path,
+            }
+            cached_items.append(cached_item)
+
+        if num_not_in_manifest > 0:
+            logger.info(f"{num_not_in_manifest} latent cache files are not in the manifest, parsed from the file names")
+        if num_shared > 0:
+            logger.info(f"{num_shared} items use the shared text encoder output caches")
+        return cached_items
+
     def get_latent_cache_path(self, item_info: ItemInfo) -> str:
         """
         Returns the cache path for the latent tensor.
@@ -866,7 +1774,24 @@ class BaseDataset(torch.utils.data.Dataset):
         assert self.cache_directory is not None, "cache_directory is required / cache_directoryは必須です"
         return os.path.join(self.cache_directory, f"{basename}_{self.architecture}_te.safetensors")
 
-    def retrieve_latent_cache_batches(self, num_workers: int):
+    def retrieve_latent_cache_batches(
+        self,
+        num_workers: int,
+        decode_backend: str = DECODE_BACKEND_THREAD,
+        defer_resize: bool = False,
+        share_window_prefix: bool = False,
+    ):
+        """
+        Yields (bucket key, batch of ItemInfo with the content) for caching. Images and videos are loaded and resized by
+        num_workers threads, or processes if decode_backend is "process". The throughput is recorded in self.decode_stats.
+
+        If defer_resize is True, the contents are not resized and have the original size. The encoder resizes them to the
+        bucket resolution (bucket_size of ItemInfo) on the GPU with resize_tensor_to_bucket.
+
+        If share_window_prefix is True, the windows of a video with the same start frame are yielded as one item of the
+        longest window, and the shorter windows are in prefix_items of it without the content. This is only for the encoders
+        whose latents of a prefix of the frames are the prefix of the latents (causal VAE). Ignored for images.
+        """
         raise NotImplementedError
 
     def retrieve_text_encoder_output_cache_batches(self, num_workers: int):
@@ -976,6 +1901,7 @@ class ImageDataset(BaseDataset):
         cache_directory: Optional[str] = None,
         debug_dataset: bool = False,
         architecture: str = "no_default",
+        cache_format: str = CACHE_FORMAT_FILE,
     ):
         super(ImageDataset, self).__init__(
             resolution,
@@ -987,6 +1913,7 @@ class ImageDataset(BaseDataset):
             cache_directory,
             debug_dataset,
             architecture,
+            cache_format,
         )
         self.image_directory = image_directory
         self.image_jsonl_file = image_jsonl_file
@@ -1014,37 +1941,17 @@ class ImageDataset(BaseDataset):
     def get_total_image_count(self):
         return len(self.datasource) if self.datasource.is_indexable() else None
 
-    def retrieve_latent_cache_batches(self, num_workers: int):
+    def retrieve_latent_cache_batches(
+        self,
+        num_workers: int,
+        decode_backend: str = DECODE_BACKEND_THREAD,
+        defer_resize: bool = False,
+        share_window_prefix: bool = False,
+    ):
         buckset_selector = BucketSelector(self.resolution, self.enable_bucket, self.bucket_no_upscale, self.architecture)
-        executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.decode_stats = DecodeStats(num_workers)
 
         batches: dict[tuple[int, int], list[ItemInfo]] = {}  # (width, height) -> [ItemInfo]
-        futures = []
-
-        # aggregate futures and sort by bucket resolution
-        def aggregate_future(consume_all: bool = False):
-            while len(futures) >= num_workers or (consume_all and len(futures) > 0):
-                completed_futures = [future for future in futures if future.done()]
-                if len(completed_futures) == 0:
-                    if len(futures) >= num_workers or consume_all:  # to avoid adding too many futures
-                        time.sleep(0.1)
-                        continue
-                    else:
-                        break  # submit batch if possible
-
-                for future in completed_futures:
-                    original_size, item_key, image, caption = future.result()
-                    bucket_height, bucket_width = image.shape[:2]
-                    bucket_reso = (bucket_width, bucket_height)
-
-                    item_info = ItemInfo(item_key, caption, original_size, bucket_reso, content=image)
-                    item_info.latent_cache_path = self.get_latent_cache_path(item_info)
-
-                    if bucket_reso not in batches:
-                        batches[bucket_reso] = []
-                    batches[bucket_reso].append(item_info)
-
-                    futures.remove(future)
 
         # submit batch if some bucket has enough items
         def submit_batch(flush: bool = False):
@@ -1058,63 +1965,100 @@ class ImageDataset(BaseDataset):
                     return key, batch
             return None, None
 
-        for fetch_op in self.datasource:
+        if decode_backend == DECODE_BACKEND_PROCESS:
+            # load and resize images in processes, images are returned through shared memory
+            executor = create_decode_process_pool(num_workers)
+            max_in_flight = num_workers * 2  # keep the workers busy while the results are received
+            release = release_fetched_shared_memory  # the results which are not received on early exit
+
+            def create_tasks():
+                for index in range(len(self.datasource)):
+                    image_path, caption = self.datasource.get_caption(index)
+                    yield fetch_image_for_latent_cache, (image_path, caption, buckset_selector, not defer_resize)
+
+        else:
+            executor = ThreadPoolExecutor(max_workers=num_workers)
+            max_in_flight = num_workers
+            release = None
 
             # fetch and resize image in a separate thread
-            def fetch_and_resize(op: callable) -> tuple[tuple[int, int], str, Image.Image, str]:
+            def fetch_and_resize(op: callable) -> tuple[tuple[int, int], str, np.ndarray, str, dict, float]:
+                start_time = time.perf_counter()
                 image_key, image, caption = op()
                 image: Image.Image
                 image_size = image.size
 
-                bucket_reso = buckset_selector.get_bucket_resolution(image_size)
-                image = resize_image_to_bucket(image, bucket_reso)
-                return image_size, image_key, image, caption
+                if defer_resize:
+                    image = np.array(image)
+                else:
+                    bucket_reso = buckset_selector.get_bucket_resolution(image_size)
+                    image = resize_image_to_bucket(image, bucket_reso)
+                return image_size, image_key, image, caption, get_source_identity(image_key), time.perf_counter() - start_time
+
+            def create_tasks():
+                for fetch_op in self.datasource:
+                    yield fetch_and_resize, (fetch_op,)
+
+        futures = iter_completed_futures(executor, create_tasks(), max_in_flight, release)
+        try:
+            for future in futures:
+                original_size, item_key, image, caption, source_identity, elapsed = future.result()
+                if decode_backend == DECODE_BACKEND_PROCESS:
+                    image = from_shared_memory(image)
+                self.decode_stats.add(1, 1, elapsed)
+
+                bucket_reso = buckset_selector.get_bucket_resolution(original_size)  # same as the size of the resized image
+
+                item_info = ItemInfo(item_key, caption, original_size, bucket_reso, content=image)
+                item_info.latent_cache_path = self.get_latent_cache_path(item_info)
+                item_info.source_identity = {**source_identity, "bucket": list(bucket_reso)}
+                item_info.latent_cache_pack = self.get_latent_cache_pack()
+
+                if bucket_reso not in batches:
+                    batches[bucket_reso] = []
+                batches[bucket_reso].append(item_info)
+
+                while True:
+                    key, batch = submit_batch()
+                    if key is None:
+                        break
+                    yield key, batch
 
-            future = executor.submit(fetch_and_resize, fetch_op)
-            futures.append(future)
-            aggregate_future()
             while True:
-                key, batch = submit_batch()
+                key, batch = submit_batch(flush=True)
                 if key is None:
                     break
                 yield key, batch
-
-        aggregate_future(consume_all=True)
-        while True:
-            key, batch = submit_batch(flush=True)
-            if key is None:
-                break
-            yield key, batch
-
-        executor.shutdown()
+        finally:
+            futures.close()  # release the results of the finished tasks which are not received
+            executor.shutdown(wait=True, cancel_futures=True)
 
     def retrieve_text_encoder_output_cache_batches(self, num_workers: int):
         return self._default_retrieve_text_encoder_output_cache_batches(self.datasource, self.batch_size, num_workers)
 
+    def parse_latent_cache_file_name(self, name: str) -> dict:
+        tokens = name.split("_")
+
+        image_size = tokens[-2]  # 0000x0000
+        image_width, image_height = map(int, image_size.split("x"))
+
+        item_key = "_".join(tokens[:-2])
+        return {"item_key": item_key, "original_size": (image_width, image_height)}
+
     def prepare_for_training(self):
         bucket_selector = BucketSelector(self.resolution, self.enable_bucket, self.bucket_no_upscale, self.architecture)
-
-        # glob cache files
-        latent_cache_files = glob.glob(os.path.join(self.cache_directory, f"*_{self.architecture}.safetensors"))
+        latent_cache_pack = self.get_latent_cache_pack()
 
         # assign cache files to item info
         bucketed_item_info: dict[tuple[int, int], list[ItemInfo]] = {}  # (width, height) -> [ItemInfo]
-        for cache_file in latent_cache_files:
-            tokens = os.path.basename(cache_file).split("_")
-
-            image_size = tokens[-2]  # 0000x0000
-            image_width, image_height = map(int, image_size.split("x"))
-            image_size = (image_width, image_height)
-
-            item_key = "_".join(tokens[:-2])
-            text_encoder_output_cache_file = os.path.join(self.cache_directory, f"{item_key}_{self.architecture}_te.safetensors")
-            if not os.path.exists(text_encoder_output_cache_file):
-                logger.warning(f"Text encoder output cache file not found: {text_encoder_output_cache_file}")
-                continue
+        for cached_item in self.get_cached_latent_items():
+            item_key = cached_item["item_key"]
+            image_size = cached_item["original_size"]
 
             bucket_reso = bucket_selector.get_bucket_resolution(image_size)
-            item_info = ItemInfo(item_key, "", image_size, bucket_reso, latent_cache_path=cache_file)
-            item_info.text_encoder_output_cache_path = text_encoder_output_cache_file
+            item_info = ItemInfo(item_key, "", image_size, bucket_reso, latent_cache_path=cached_item["latent_cache_path"])
+            item_info.latent_cache_pack = latent_cache_pack
+            item_info.text_encoder_output_cache_path = cached_item["text_encoder_output_cache_path"]
 
             bucket = bucketed_item_info.get(bucket_reso, [])
             for _ in range(self.num_repeats):
@@ -1159,6 +2103,8 @@ class VideoDataset(BaseDataset):
         cache_directory: Optional[str] = None,
         debug_dataset: bool = False,
         architecture: str = "no_default",
+        cache_format: str = CACHE_FORMAT_FILE,
+        streaming_extraction: bool = False,
     ):
         super(VideoDataset, self).__init__(
             resolution,
@@ -1170,6 +2116,7 @@ class VideoDataset(BaseDataset):
             cache_directory,
             debug_dataset,
             architecture,
+            cache_format,
         )
         self.video_directory = video_directory
         self.video_jsonl_file = video_jsonl_file
@@ -1177,6 +2124,7 @@ class VideoDataset(BaseDataset):
         self.frame_extraction = frame_extraction
         self.frame_stride = frame_stride
         self.frame_sample = frame_sample
+        self.streaming_extraction = streaming_extraction
 
         if video_directory is not None:
             self.datasource = VideoDirectoryDatasource(video_directory, caption_extension)
@@ -1208,77 +2156,59 @@ class VideoDataset(BaseDataset):
         metadata["target_frames"] = self.target_frames
         return metadata
 
-    def retrieve_latent_cache_batches(self, num_workers: int):
+    def retrieve_latent_cache_batches(
+        self,
+        num_workers: int,
+        decode_backend: str = DECODE_BACKEND_THREAD,
+        defer_resize: bool = False,
+        share_window_prefix: bool = False,
+    ):
         buckset_selector = BucketSelector(self.resolution, architecture=self.architecture)
-        self.datasource.set_bucket_selector(buckset_selector)
-
-        executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.datasource.set_bucket_selector(None if defer_resize else buckset_selector)
+        self.decode_stats = DecodeStats(num_workers)
 
         # key: (width, height, frame_count), value: [ItemInfo]
         batches: dict[tuple[int, int, int], list[ItemInfo]] = {}
-        futures = []
-
-        def aggregate_future(consume_all: bool = False):
-            while len(futures) >= num_workers or (consume_all and len(futures) > 0):
-                completed_futures = [future for future in futures if future.done()]
-                if len(completed_futures) == 0:
-                    if len(futures) >= num_workers or consume_all:  # to avoid adding too many futures
-                        time.sleep(0.1)
-                        continue
-                    else:
-                        break  # submit batch if possible
-
-                for future in completed_futures:
-                    original_frame_size, video_key, video, caption = future.result()
-
-                    frame_count = len(video)
-                    video = np.stack(video, axis=0)
-                    height, width = video.shape[1:3]
-                    bucket_reso = (width, height)  # already resized
-
-                    crop_pos_and_frames = []
-                    if self.frame_extraction == "head":
-                        for target_frame in self.target_frames:
-                            if frame_count >= target_frame:
-                                crop_pos_and_frames.append((0, target_frame))
-                    elif self.frame_extraction == "chunk":
-                        # split by target_frames
-                        for target_frame in self.target_frames:
-                            for i in range(0, frame_count, target_frame):
-                                if i + target_frame <= frame_count:
-                                    crop_pos_and_frames.append((i, target_frame))
-                    elif self.frame_extraction == "slide":
-                        # slide window
-                        for target_frame in self.target_frames:
-                            if frame_count >= target_frame:
-                                for i in range(0, frame_count - target_frame + 1, self.frame_stride):
-                                    crop_pos_and_frames.append((i, target_frame))
-                    elif self.frame_extraction == "uniform":
-                        # select N frames uniformly
-                        for target_frame in self.target_frames:
-                            if frame_count >= target_frame:
-                                frame_indices = np.linspace(0, frame_count - target_frame, self.frame_sample, dtype=int)
-                                for i in frame_indices:
-                                    crop_pos_and_frames.append((i, target_frame))
-                    else:
-                        raise ValueError(f"frame_extraction {self.frame_extraction} is not supported")
 
-                    for crop_pos, target_frame in crop_pos_and_frames:
-                        cropped_video = video[crop_pos : crop_pos + target_frame]
-                        body, ext = os.path.splitext(video_key)
-                        item_key = f"{body}_{crop_pos:05d}-{target_frame:03d}{ext}"
-                        batch_key = (*bucket_reso, target_frame)  # bucket_reso with frame_count
-
-                        item_info = ItemInfo(
-                            item_key, caption, original_frame_size, batch_key, frame_count=target_frame, content=cropped_video
-                        )
-                        item_info.latent_cache_path = self.get_latent_cache_path(item_info)
-
-                        batch = batches.get(batch_key, [])
-                        batch.append(item_info)
-                        batches[batch_key] = batch
-
-                    futures.remove(future)
+        def add_window(
+            video_key: str,
+            caption: str,
+            original_frame_size: tuple[int, int],
+            source_identity: dict,
+            crop_pos: int,
+            target_frame: int,
+            cropped_video: np.ndarray,
+            prefix_frames: Optional[list[int]] = None,
+        ):
+            height, width = cropped_video.shape[1:3]
+            bucket_reso = buckset_selector.get_bucket_resolution((width, height))  # same as (width, height) if resized
+            if defer_resize:
+                original_frame_size = bucket_reso  # same as the size of the resized frames, for the same cache file name
+
+            body, ext = os.path.splitext(video_key)
+
+            def create_item_info(frame_count: int, content: Optional[np.ndarray]) -> ItemInfo:
+                item_key = f"{body}_{crop_pos:05d}-{frame_count:03d}{ext}"
+                batch_key = (*bucket_reso, frame_count)  # bucket_reso with frame_count
+
+                item_info = ItemInfo(item_key, caption, original_frame_size, batch_key, frame_count=frame_count, content=content)
+                item_info.latent_cache_path = self.get_latent_cache_path(item_info)
+                item_info.latent_cache_pack = self.get_latent_cache_pack()
+                item_info.source_identity = {
+                    **source_identity,
+                    "bucket": list(bucket_reso),
+                    "window": [int(crop_pos), frame_count],
+                }
+                return item_info
+
+            item_info = create_item_info(target_frame, cropped_video)
+            for prefix_frame in prefix_frames or []:
+                item_info.prefix_items.append(create_item_info(prefix_frame, None))  # encoded with this window
+
+            batch_key = item_info.bucket_size
+            batch = batches.get(batch_key, [])
+            batch.append(item_info)
+            batches[batch_key] = batch
 
         def submit_batch(flush: bool = False):
             for key in batches:
@@ -1291,68 +2221,220 @@ class VideoDataset(BaseDataset):
                     return key, batch
             return None, None
 
-        for operator in self.datasource:
+        get_windows = functools.partial(
+            get_frame_windows,
+            frame_extraction=self.frame_extraction,
+            target_frames=self.target_frames,
+            frame_stride=self.frame_stride,
+            frame_sample=self.frame_sample,
+        )
+        streaming = self.streaming_extraction and self.frame_extraction != "head"
+        if streaming and decode_backend == DECODE_BACKEND_PROCESS:
+            logger.warning("streaming_extraction is not supported with the process backend, the windows are decoded per video")
+            streaming = False
+        if streaming and share_window_prefix:
+            # the windows are yielded one by one, so the windows with the same start frame cannot be grouped
+            logger.warning("share_window_prefix is not supported with streaming_extraction, each window is encoded")
+        if self.frame_extraction != "head":
+            # decode only the frames in the windows. head extraction is already limited by the end frame
+            self.datasource.set_frame_windows_getter(get_windows, streaming)
+
+        if streaming:
+            # windows are passed from the workers as soon as they are decoded. The number of windows in the queue is bounded
+            # by the slots, so the number of windows in memory is bounded regardless of the length of the videos. The
+            # completed futures are put to the same queue without a slot: the done callback runs on the main thread if the
+            # future is already done, and it must not wait for the consumer
+            executor = ThreadPoolExecutor(max_workers=num_workers)
+            window_queue = queue.Queue()
+            window_slots = threading.Semaphore(max(2, num_workers))
+            stop_event = threading.Event()
+
+            def put_to_queue(entry):
+                while not stop_event.is_set():
+                    if window_slots.acquire(timeout=0.1):
+                        window_queue.put(entry)
+                        return
+
+            def fetch_windows(op: callable):
+                start_time = time.perf_counter()
+                video_key, windows, caption = op()
+                source_identity = get_source_identity(video_key)
+                try:
+                    for crop_pos, target_frame, cropped_video in windows:
+                        if stop_event.is_set():
+                            break
+                        # the frames of each window are counted, the overlapping frames are counted more than once
+                        self.decode_stats.add(1, target_frame, time.perf_counter() - start_time)
+
+                        original_frame_size = (cropped_video.shape[2], cropped_video.shape[1])
+                        put_to_queue(
+                            (video_key, caption, original_frame_size, source_identity, crop_pos, target_frame, cropped_video)
+                        )
+                        start_time = time.perf_counter()  # exclude the time waiting for the queue
+                finally:
+                    windows.close()  # close the video
+
+            num_videos = 0
+            for operator in self.datasource:
+                future = executor.submit(fetch_windows, operator)
+                future.add_done_callback(window_queue.put)  # the future itself notifies the completion, after its windows
+                num_videos += 1
+
+            try:
+                num_completed = 0
+                while num_completed < num_videos:
+                    entry = window_queue.get()
+                    if isinstance(entry, Future):
+                        entry.result()  # raise the exception in the worker if any
+                        num_completed += 1
+                        continue
+
+                    window_slots.release()
+                    add_window(*entry)
+                    while True:
+                        key, batch = submit_batch()
+                        if key is None:
+                            break
+                        yield key, batch
+
+                while True:
+                    key, batch = submit_batch(flush=True)
+                    if key is None:
+                        break
+                    yield key, batch
+            finally:
+                stop_event.set()
+                executor.shutdown(wait=True, cancel_futures=True)
+                self.datasource.set_frame_windows_getter(None)
+            return
+
+        if decode_backend == DECODE_BACKEND_PROCESS:
+            # decode and resize videos in processes, frames are returned through shared memory
+            executor = create_decode_process_pool(num_workers)
+            max_in_flight = num_workers * 2  # keep the workers busy while the results are received
+            end_frame = self.datasource.end_frame if self.frame_extraction == "head" else None
+            release = release_fetched_shared_memory  # the results which are not received on early exit
+
+            def create_tasks():
+                for index in range(len(self.datasource)):
+                    video_path, caption = self.datasource.get_caption(index)
+                    bucket_selector = None if defer_resize else buckset_selector
+                    yield fetch_video_windows_for_latent_cache, (video_path, caption, bucket_selector, get_windows, end_frame)
 
-            def fetch_and_resize(op: callable) -> tuple[tuple[int, int], str, list[np.ndarray], str]:
+        else:
+            executor = ThreadPoolExecutor(max_workers=num_workers)
+            max_in_flight = num_workers
+            release = None
+
+            def fetch_and_resize(
+                op: callable,
+            ) -> tuple[Optional[tuple[int, int]], str, Optional[np.ndarray], list[tuple[int, int, int]], str, dict, float]:
+                start_time = time.perf_counter()
                 video_key, video, caption = op()
-                video: list[np.ndarray]
-                frame_size = (video[0].shape[1], video[0].shape[0])
+                if self.frame_extraction != "head":
+                    video, window_positions = video
+                    if video is None:
+                        return None, video_key, None, [], caption, None, time.perf_counter() - start_time
+                    frame_size = (video.shape[2], video.shape[1])
+                else:
+                    video: list[np.ndarray]
+                    frame_size = (video[0].shape[1], video[0].shape[0])
 
-                # resize if necessary
-                bucket_reso = buckset_selector.get_bucket_resolution(frame_size)
-                video = [resize_image_to_bucket(frame, bucket_reso) for frame in video]
+                    # resize if necessary
+                    if not defer_resize:
+                        bucket_reso = buckset_selector.get_bucket_resolution(frame_size)
+                        video = [resize_image_to_bucket(frame, bucket_reso) for frame in video]
 
-                return frame_size, video_key, video, caption
+                    video = np.stack(video, axis=0)
+                    window_positions = [(start, count, start) for start, count in get_windows(len(video))]
+
+                elapsed = time.perf_counter() - start_time
+                return frame_size, video_key, video, window_positions, caption, get_source_identity(video_key), elapsed
+
+            def create_tasks():
+                for operator in self.datasource:
+                    yield fetch_and_resize, (operator,)
+
+        futures = iter_completed_futures(executor, create_tasks(), max_in_flight, release)
+        try:
+            for future in futures:
+                original_frame_size, video_key, video, window_positions, caption, source_identity, elapsed = future.result()
+                if video is not None and decode_backend == DECODE_BACKEND_PROCESS:
+                    video = from_shared_memory(video)
+                self.decode_stats.add(len(window_positions), 0 if video is None else len(video), elapsed)
+
+                if share_window_prefix:
+                    window_positions = group_prefix_windows(window_positions)
+                else:
+                    window_positions = [(crop_pos, target_frame, pos, []) for crop_pos, target_frame, pos in window_positions]
+
+                for crop_pos, target_frame, pos, prefix_frames in window_positions:
+                    cropped_video = video[pos : pos + target_frame]
+                    add_window(
+                        video_key,
+                        caption,
+                        original_frame_size,
+                        source_identity,
+                        crop_pos,
+                        target_frame,
+                        cropped_video,
+                        prefix_frames,
+                    )
+
+                while True:
+                    key, batch = submit_batch()
+                    if key is None:
+                        break
+                    yield key, batch
 
-            future = executor.submit(fetch_and_resize, operator)
-            futures.append(future)
-            aggregate_future()
             while True:
-                key, batch = submit_batch()
+                key, batch = submit_batch(flush=True)
                 if key is None:
                     break
                 yield key, batch
-
-        aggregate_future(consume_all=True)
-        while True:
-            key, batch = submit_batch(flush=True)
-            if key is None:
-                break
-            yield key, batch
-
-        executor.shutdown()
+        finally:
+            futures.close()  # release the results of the finished tasks which are not received
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.datasource.set_frame_windows_getter(None)
 
     def retrieve_text_encoder_output_cache_batches(self, num_workers: int):
         return self._default_retrieve_text_encoder_output_cache_batches(self.datasource, self.batch_size, num_workers)
 
-    def prepare_for_training(self):
-        bucket_selector = BucketSelector(self.resolution, self.enable_bucket, self.bucket_no_upscale, self.architecture)
+    def parse_latent_cache_file_name(self, name: str) -> dict:
+        tokens = name.split("_")
 
-        # glob cache files
-        latent_cache_files = glob.glob(os.path.join(self.cache_directory, f"*_{self.architecture}.safetensors"))
+        image_size = tokens[-2]  # 0000x0000
+        image_width, image_height = map(int, image_size.split("x"))
 
-        # assign cache files to item info
-        bucketed_item_info: dict[tuple[int, int, int], list[ItemInfo]] = {}  # (width, height, frame_count) -> [ItemInfo]
-        for cache_file in latent_cache_files:
-            tokens = os.path.basename(cache_file).split("_")
+        frame_pos, frame_count = tokens[-3].split("-")
+        frame_pos, frame_count = int(frame_pos), int(frame_count)
 
-            image_size = tokens[-2]  # 0000x0000
-            image_width, image_height = map(int, image_size.split("x"))
-            image_size = (image_width, image_height)
+        item_key = "_".join(tokens[:-3])
+        return {
+            "item_key": item_key,
+            "original_size": (image_width, image_height),
+            "frame_pos": frame_pos,
+            "frame_count": frame_count,
+        }
 
-            frame_pos, frame_count = tokens[-3].split("-")
-            frame_pos, frame_count = int(frame_pos), int(frame_count)
+    def prepare_for_training(self):
+        bucket_selector = BucketSelector(self.resolution, self.enable_bucket, self.bucket_no_upscale, self.architecture)
+        latent_cache_pack = self.get_latent_cache_pack()
 
-            item_key = "_".join(tokens[:-3])
-            text_encoder_output_cache_file = os.path.join(self.cache_directory, f"{item_key}_{self.architecture}_te.safetensors")
-            if not os.path.exists(text_encoder_output_cache_file):
-                logger.warning(f"Text encoder output cache file not found: {text_encoder_output_cache_file}")
-                continue
+        # assign cache files to item info
+        bucketed_item_info: dict[tuple[int, int, int], list[ItemInfo]] = {}  # (width, height, frame_count) -> [ItemInfo]
+        for cached_item in self.get_cached_latent_items():
+            item_key = cached_item["item_key"]
+            image_size = cached_item["original_size"]
+            frame_count = cached_item["frame_count"]
 
             bucket_reso = bucket_selector.get_bucket_resolution(image_size)
             bucket_reso = (*bucket_reso, frame_count)
-            item_info = ItemInfo(item_key, "", image_size, bucket_reso, frame_count=frame_count, latent_cache_path=cache_file)
-            item_info.text_encoder_output_cache_path = text_encoder_output_cache_file
+            item_info = ItemInfo(
+                item_key, "", image_size, bucket_reso, frame_count=frame_count, latent_cache_path=cached_item["latent_cache_path"]
+            )
+            item_info.latent_cache_pack = latent_cache_pack
+            item_info.text_encoder_output_cache_path = cached_item["text_encoder_output_cache_path"]
 
             bucket = bucketed_item_info.get(bucket_reso, [])
             for _ in range(self.num_repeats):
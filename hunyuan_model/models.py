@@ -15,7 +15,8 @@ from .posemb_layers import apply_rotary_emb
 from .mlp_layers import MLP, MLPEmbedder, FinalLayer
 from .modulate_layers import ModulateDiT, modulate, apply_gate
 from .token_refiner import SingleTokenRefiner
-from modules.custom_offloading_utils import ModelOffloader, synchronize_device, clean_memory_on_device
+from modules.block_swap_planner import get_hunyuan_blocks_to_swap
+from modules.custom_offloading_utils import ModelOffloader, OffloaderStats, synchronize_device, clean_memory_on_device
 from hunyuan_model.posemb_layers import get_nd_rotary_pos_embed
 
 from utils.safetensors_utils import MemoryEfficientSafeOpen
@@ -645,28 +646,62 @@ class HYVideoDiffusionTransformer(nn.Module):  # ModelMixin, ConfigMixin):
     def enable_img_in_txt_in_offloading(self):
         self._enable_img_in_txt_in_offloading = True
 
-    def enable_block_swap(self, num_blocks: int, device: torch.device, supports_backward: bool):
+    def enable_block_swap(
+        self,
+        num_blocks: int,
+        device: torch.device,
+        supports_backward: bool,
+        prefetch_depth: int = 0,
+        fp8_host_weights: bool = False,
+    ):
         self.blocks_to_swap = num_blocks
         self.num_double_blocks = len(self.double_blocks)
         self.num_single_blocks = len(self.single_blocks)
-        double_blocks_to_swap = num_blocks // 2
-        single_blocks_to_swap = (num_blocks - double_blocks_to_swap) * 2 + 1
-
-        assert double_blocks_to_swap <= self.num_double_blocks - 1 and single_blocks_to_swap <= self.num_single_blocks - 1, (
-            f"Cannot swap more than {self.num_double_blocks - 1} double blocks and {self.num_single_blocks - 1} single blocks. "
+        double_blocks_to_swap, single_blocks_to_swap = get_hunyuan_blocks_to_swap(num_blocks)
+
+        # with backward, the second last block must be swapped in before the backward of the last block
+        num_resident_blocks = 2 if supports_backward else 1
+        max_double_blocks_to_swap = self.num_double_blocks - num_resident_blocks
+        max_single_blocks_to_swap = self.num_single_blocks - num_resident_blocks
+        assert double_blocks_to_swap <= max_double_blocks_to_swap and single_blocks_to_swap <= max_single_blocks_to_swap, (
+            f"Cannot swap more than {max_double_blocks_to_swap} double blocks and {max_single_blocks_to_swap} single blocks. "
             f"Requested {double_blocks_to_swap} double blocks and {single_blocks_to_swap} single blocks."
         )
 
         self.offloader_double = ModelOffloader(
-            "double", self.double_blocks, self.num_double_blocks, double_blocks_to_swap, supports_backward, device  # , debug=True
+            "double",
+            self.double_blocks,
+            self.num_double_blocks,
+            double_blocks_to_swap,
+            supports_backward,
+            device,
+            prefetch_depth=prefetch_depth,
+            fp8_host_weights=fp8_host_weights,  # , debug=True
         )
         self.offloader_single = ModelOffloader(
-            "single", self.single_blocks, self.num_single_blocks, single_blocks_to_swap, supports_backward, device  # , debug=True
+            "single",
+            self.single_blocks,
+            self.num_single_blocks,
+            single_blocks_to_swap,
+            supports_backward,
+            device,
+            prefetch_depth=prefetch_depth,
+            fp8_host_weights=fp8_host_weights,  # , debug=True
         )
         print(
             f"HYVideoDiffusionTransformer: Block swap enabled. Swapping {num_blocks} blocks, double blocks: {double_blocks_to_swap}, single blocks: {single_blocks_to_swap}."
         )
 
+    def enable_block_swap_stats(self):
+        if self.blocks_to_swap:
+            self.offloader_double.enable_stats()
+            self.offloader_single.enable_stats()
+
+    def get_block_swap_stats(self) -> list[OffloaderStats]:
+        if not self.blocks_to_swap:
+            return []
+        return [offloader.stats for offloader in [self.offloader_double, self.offloader_single] if offloader.stats is not None]
+
     def switch_block_swap_for_inference(self):
         if self.blocks_to_swap:
             self.offloader_double.set_forward_only(True)
@@ -26,6 +26,7 @@ from hunyuan_model.text_encoder import PROMPT_TEMPLATE
 from hunyuan_model.vae import load_vae
 from hunyuan_model.models import load_transformer, get_rotary_pos_embed
 from hunyuan_model.fp8_optimization import convert_fp8_linear
+from modules.block_swap_planner import get_hunyuan_seq_len, parse_blocks_to_swap, plan_hunyuan_blocks_to_swap
 from modules.scheduling_flow_match_discrete import FlowMatchDiscreteScheduler
 from networks import lora
 
@@ -472,7 +473,29 @@ def parse_args():
     parser.add_argument(
         "--vae_spatial_tile_sample_min_size", type=int, default=None, help="spatial tile sample min size for VAE, default 256"
     )
-    parser.add_argument("--blocks_to_swap", type=int, default=None, help="number of blocks to swap in the model")
+    parser.add_argument(
+        "--blocks_to_swap",
+        type=parse_blocks_to_swap,
+        default=None,
+        help="number of blocks to swap in the model, or 'auto' to choose it from the VRAM budget",
+    )
+    parser.add_argument(
+        "--vram_budget",
+        type=float,
+        default=None,
+        help="VRAM budget in GB for blocks_to_swap auto. Default is the total memory of the device minus a reserve",
+    )
+    parser.add_argument(
+        "--block_swap_prefetch",
+        type=int,
+        default=0,
+        help="copy the swapped blocks on a CUDA stream and stage them to pinned memory up to this number of swaps ahead, e.g. 2",
+    )
+    parser.add_argument(
+        "--block_swap_fp8",
+        action="store_true",
+        help="keep the swapped blocks in FP8 with per-channel scales in the main memory, and up-convert them on the device after the transfer. halves the transfer, but the weights are quantized",
+    )
     parser.add_argument("--img_in_txt_in_offloading", action="store_true", help="offload img_in and txt_in to cpu")
     parser.add_argument(
         "--output_type", type=str, default="video", choices=["video", "images", "latent", "both"], help="output type"
@@ -619,6 +642,23 @@ def main():
 
             clean_memory_on_device(device)
 
+        # if image_latents is given, the model should be I2V model, so the in_channels should be 32
+        dit_in_channels = args.dit_in_channels if args.dit_in_channels is not None else (32 if image_latents is not None else 16)
+
+        # choose the number of blocks to swap before loading DiT
+        if args.blocks_to_swap == "auto":
+            batch_size = 2 if do_classifier_free_guidance and not args.split_uncond else 1  # uncond is in the same batch
+            args.blocks_to_swap = plan_hunyuan_blocks_to_swap(
+                dit_weight_dtype,
+                get_hunyuan_seq_len(width, height, video_length),
+                batch_size,
+                False,
+                False,
+                device,
+                args.vram_budget,
+                dit_in_channels,
+            )
+
         # load DiT model
         blocks_to_swap = args.blocks_to_swap if args.blocks_to_swap else 0
         loading_device = "cpu"  # if blocks_to_swap > 0 else device
@@ -627,9 +667,6 @@ def main():
         if args.attn_mode == "sdpa":
             args.attn_mode = "torch"
 
-        # if image_latents is given, the model should be I2V model, so the in_channels should be 32
-        dit_in_channels = args.dit_in_channels if args.dit_in_channels is not None else (32 if image_latents is not None else 16)
-
         # if we use LoRA, weigths should be bf16 instead of fp8, because merging should be done in bf16
         # the model is too large, so we load the model to cpu. in addition, the .pt file is loaded to cpu anyway
         # on the fly merging will be a solution for this issue for .safetenors files (not implemented yet)
@@ -727,7 +764,13 @@ def main():
 
         if blocks_to_swap > 0:
             logger.info(f"Enable swap {blocks_to_swap} blocks to CPU from device: {device}")
-            transformer.enable_block_swap(blocks_to_swap, device, supports_backward=False)
+            transformer.enable_block_swap(
+                blocks_to_swap,
+                device,
+                supports_backward=False,
+                prefetch_depth=args.block_swap_prefetch,
+                fp8_host_weights=args.block_swap_fp8,
+            )
             transformer.move_to_device_except_swap_blocks(device)
             transformer.prepare_block_swap_before_forward()
         else:
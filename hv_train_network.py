@@ -13,7 +13,7 @@ import random
 import time
 import json
 from multiprocessing import Value
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional
 import accelerate
 import numpy as np
 from packaging.version import Version
@@ -39,6 +39,7 @@ from hunyuan_model.models import load_transformer, get_rotary_pos_embed_by_shape
 import hunyuan_model.text_encoder as text_encoder_module
 from hunyuan_model.vae import load_vae, VAE_VER
 import hunyuan_model.vae as vae_module
+from modules.block_swap_planner import get_hunyuan_seq_len, parse_blocks_to_swap, plan_hunyuan_blocks_to_swap
 from modules.scheduling_flow_match_discrete import FlowMatchDiscreteScheduler
 import networks.lora as lora_module
 from dataset.config_utils import BlueprintGenerator, ConfigSanitizer
@@ -1277,6 +1278,44 @@ class NetworkTrainer:
 
         return transformer
 
+    def plan_blocks_to_swap(
+        self,
+        args: argparse.Namespace,
+        accelerator: Accelerator,
+        train_dataset_group: config_utils.DatasetGroup,
+        dit_weight_dtype: Optional[torch.dtype],
+    ) -> int:
+        seq_len, batch_size = self.get_largest_batch(train_dataset_group, get_hunyuan_seq_len)
+        return plan_hunyuan_blocks_to_swap(
+            dit_weight_dtype,
+            seq_len,
+            batch_size,
+            True,
+            args.gradient_checkpointing,
+            accelerator.device,
+            args.vram_budget,
+            args.dit_in_channels,
+        )
+
+    def get_largest_batch(
+        self, train_dataset_group: config_utils.DatasetGroup, get_seq_len: Callable[[int, int, int], int]
+    ) -> tuple[int, int]:
+        """
+        Returns (sequence length, batch size) of the batch with the most tokens. get_seq_len(width, height, frames)
+        """
+        max_tokens, seq_len, batch_size = 0, 0, 1
+        for dataset in train_dataset_group.datasets:
+            for bucket_reso in dataset.batch_manager.bucket_resos:
+                width, height = bucket_reso[:2]
+                frames = bucket_reso[2] if len(bucket_reso) > 2 else 1
+                bucket_seq_len = get_seq_len(width, height, frames)
+                if bucket_seq_len * dataset.batch_size > max_tokens:
+                    max_tokens = bucket_seq_len * dataset.batch_size
+                    seq_len, batch_size = bucket_seq_len, dataset.batch_size
+
+        logger.info(f"plan blocks_to_swap for the largest batch: sequence length {seq_len}, batch size {batch_size}")
+        return seq_len, batch_size
+
     def scale_shift_latents(self, latents):
         latents = latents * vae_module.SCALING_FACTOR
         return latents
@@ -1408,6 +1447,8 @@ class NetworkTrainer:
             vae.eval()
 
         # load DiT model
+        if args.blocks_to_swap == "auto":
+            args.blocks_to_swap = self.plan_blocks_to_swap(args, accelerator, train_dataset_group, dit_weight_dtype)
         blocks_to_swap = args.blocks_to_swap if args.blocks_to_swap else 0
         self.blocks_to_swap = blocks_to_swap
         loading_device = "cpu" if blocks_to_swap > 0 else accelerator.device
@@ -1435,8 +1476,16 @@ class NetworkTrainer:
 
         if blocks_to_swap > 0:
             logger.info(f"enable swap {blocks_to_swap} blocks to CPU from device: {accelerator.device}")
-            transformer.enable_block_swap(blocks_to_swap, accelerator.device, supports_backward=True)
+            transformer.enable_block_swap(
+                blocks_to_swap,
+                accelerator.device,
+                supports_backward=True,
+                prefetch_depth=args.block_swap_prefetch,
+                fp8_host_weights=args.block_swap_fp8,
+            )
             transformer.move_to_device_except_swap_blocks(accelerator.device)
+            if args.block_swap_stats:
+                transformer.enable_block_swap_stats()
 
         # load network model for differential training
         sys.path.append(os.path.dirname(__file__))
@@ -1760,7 +1809,16 @@ class NetworkTrainer:
         # function for saving/removing
         save_dtype = dit_dtype
 
+        pending_save = None  # Future of the checkpoint which is being written in the background (--async_save)
+
+        def wait_for_pending_save():
+            nonlocal pending_save
+            if pending_save is not None:
+                pending_save.result()  # raise the exception in the writer if any
+                pending_save = None
+
         def save_model(ckpt_name: str, unwrapped_nw, steps, epoch_no, force_sync_upload=False):
+            nonlocal pending_save
             os.makedirs(args.output_dir, exist_ok=True)
             ckpt_file = os.path.join(args.output_dir, ckpt_name)
 
@@ -1794,8 +1852,10 @@ class NetworkTrainer:
 
             metadata_to_save.update(sai_metadata)
 
-            unwrapped_nw.save_weights(ckpt_file, save_dtype, metadata_to_save)
+            wait_for_pending_save()  # the checkpoints are written one at a time
+            pending_save = unwrapped_nw.save_weights(ckpt_file, save_dtype, metadata_to_save, async_save=args.async_save)
             if args.huggingface_repo_id is not None:
+                wait_for_pending_save()  # the file must be complete before the upload
                 huggingface_utils.upload(args, ckpt_file, "/" + ckpt_name, force_sync_upload=force_sync_upload)
 
         def remove_model(old_ckpt_name):
@@ -1930,6 +1990,8 @@ class NetworkTrainer:
                     logs = self.generate_step_logs(
                         args, current_loss, avr_loss, lr_scheduler, lr_descriptions, optimizer, keys_scaled, mean_norm, maximum_norm
                     )
+                    for block_swap_stats in accelerator.unwrap_model(transformer).get_block_swap_stats():
+                        logs.update(block_swap_stats.get_logs())
                     accelerator.log(logs, step=global_step)
 
                 if global_step >= args.max_train_steps:
@@ -1968,6 +2030,9 @@ class NetworkTrainer:
         if is_main_process:
             network = accelerator.unwrap_model(network)
 
+            for block_swap_stats in accelerator.unwrap_model(transformer).get_block_swap_stats():
+                logger.info(block_swap_stats.format_summary())
+
         accelerator.end_training()
         optimizer_eval_fn()
 
@@ -1977,6 +2042,7 @@ class NetworkTrainer:
         if is_main_process:
             ckpt_name = train_utils.get_last_ckpt_name(args.output_name)
             save_model(ckpt_name, network, global_step, num_train_epochs, force_sync_upload=True)
+            wait_for_pending_save()
 
             logger.info("model saved.")
 
@@ -2247,9 +2313,37 @@ def setup_parser_common() -> argparse.ArgumentParser:
 
     parser.add_argument(
         "--blocks_to_swap",
-        type=int,
+        type=parse_blocks_to_swap,
         default=None,
-        help="number of blocks to swap in the model, max XXX / モデル内のブロックの数、最大XXX",
+        help="number of blocks to swap in the model, max XXX, or 'auto' to choose it from the VRAM budget"
+        " / モデル内のブロックの数、最大XXX。'auto'でVRAM予算から決定する",
+    )
+    parser.add_argument(
+        "--vram_budget",
+        type=float,
+        default=None,
+        help="VRAM budget in GB for blocks_to_swap auto, default is the total memory of the device minus a reserve"
+        " / blocks_to_swap autoのVRAM予算（GB）。デフォルトはデバイスの全メモリから予備を引いた値",
+    )
+    parser.add_argument(
+        "--block_swap_prefetch",
+        type=int,
+        default=0,
+        help="copy the swapped blocks on a CUDA stream and stage them to pinned memory up to this number of swaps ahead, e.g. 2."
+        " 0 for the default block swap / スワップするブロックをCUDAストリームでコピーし、この数だけ先まで固定メモリに準備する（例：2）。0で従来のblock swap",
+    )
+    parser.add_argument(
+        "--block_swap_fp8",
+        action="store_true",
+        help="keep the swapped blocks in FP8 with per-channel scales in the main memory, and up-convert them on the device after"
+        " the transfer. halves the transfer, but the weights are quantized"
+        " / スワップするブロックをチャネルごとのスケール付きのFP8でメインメモリに保持し、転送後にデバイス上で変換する。転送量は半分になるが重みは量子化される",
+    )
+    parser.add_argument(
+        "--block_swap_stats",
+        action="store_true",
+        help="measure the transfer, wait and compute time of the swapped blocks, log them to the trackers and show the summary"
+        " at the end / スワップするブロックの転送、待機、計算時間を計測し、トラッカーに記録して最後に集計を表示する",
     )
     parser.add_argument(
         "--img_in_txt_in_offloading",
@@ -2453,6 +2547,12 @@ def setup_parser_common() -> argparse.ArgumentParser:
         help="save training state (including optimizer states etc.) on train end even if --save_state is not specified"
         " / --save_stateが未指定時にもoptimizerなど学習状態も含めたstateを学習終了時に保存する",
     )
+    parser.add_argument(
+        "--async_save",
+        action="store_true",
+        help="write checkpoints in a background thread (with fsync), training continues while the file is written"
+        " / チェックポイントをバックグラウンドのスレッドで書き込む（fsyncあり）、書き込み中も学習を続ける",
+    )
 
     # SAI Model spec
     parser.add_argument(
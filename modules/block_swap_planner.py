@@ -0,0 +1,454 @@
+import argparse
+import math
+import re
+from typing import Callable, Optional, Union
+
+import torch
+
+import logging
+
+from utils.safetensors_utils import MemoryEfficientSafeOpen
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+# Automatic blocks_to_swap planner
+#
+# `--blocks_to_swap auto` chooses the smallest number of blocks to swap so that the estimated device memory fits the budget:
+#   weights of the non-block layers + weights of the resident blocks + activations + reserve <= budget
+# The sizes of the weights are read from the safetensors header (nothing is loaded), in the dtype on the device. The
+# activations are estimated from the model config and the largest input. Both are estimates: if it runs out of memory,
+# lower --vram_budget.
+
+SAFETENSORS_DTYPE_SIZES = {
+    "F64": 8,
+    "F32": 4,
+    "F16": 2,
+    "BF16": 2,
+    "I64": 8,
+    "I32": 4,
+    "I16": 2,
+    "I8": 1,
+    "U8": 1,
+    "BOOL": 1,
+    "F8_E5M2": 1,
+    "F8_E4M3": 1,
+}
+
+# CUDA context, allocator fragmentation and the small tensors not counted in the estimate
+DEFAULT_RESERVE_BYTES = int(1.5 * 1024**3)
+DEFAULT_TRAINING_RESERVE_BYTES = int(2.5 * 1024**3)  # LoRA network, its gradients and optimizer states
+
+
+def parse_blocks_to_swap(value: str) -> Union[int, str]:
+    """argparse type for `--blocks_to_swap`: number of blocks or "auto" """
+    if value.lower() == "auto":
+        return "auto"
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"blocks_to_swap must be an integer or 'auto': {value}")
+
+
+def get_checkpoint_block_bytes(
+    path: str,
+    block_key_pattern: str,
+    num_blocks: int,
+    get_element_size: Optional[Callable[[str, int], int]] = None,
+) -> tuple[list[int], int]:
+    """
+    Get the sizes of the weights from the safetensors header without loading them.
+
+    Args:
+        path: safetensors file
+        block_key_pattern: regex with a group for the block index, e.g. r"^(?:model\\.diffusion_model\\.)?blocks\\.(\\d+)\\."
+        num_blocks: number of blocks
+        get_element_size: function (key, element size in the file) -> element size on the device. None for the file dtype
+
+    Returns:
+        (list of the bytes of each block, bytes of the other weights)
+    """
+    with MemoryEfficientSafeOpen(path) as f:
+        header = f.header
+
+    pattern = re.compile(block_key_pattern)
+    block_bytes = [0] * num_blocks
+    other_bytes = 0
+    for key, value in header.items():
+        if key == "__metadata__":
+            continue
+        element_size = SAFETENSORS_DTYPE_SIZES[value["dtype"]]
+        if get_element_size is not None:
+            element_size = get_element_size(key, element_size)
+        nbytes = math.prod(value["shape"]) * element_size
+
+        m = pattern.match(key)
+        if m is not None and int(m.group(1)) < num_blocks:
+            block_bytes[int(m.group(1))] += nbytes
+        else:
+            other_bytes += nbytes
+    return block_bytes, other_bytes
+
+
+def get_resident_block_bytes(block_bytes: list[int], blocks_to_swap: int) -> int:
+    """bytes of the blocks on the device. the blocks on the device change while swapping, so the largest ones are counted"""
+    return sum(sorted(block_bytes, reverse=True)[: len(block_bytes) - blocks_to_swap])
+
+
+def plan_blocks_to_swap(
+    block_bytes: Union[list[int], list[list[int]]],
+    other_bytes: int,
+    activation_bytes: int,
+    vram_budget: int,
+    max_blocks_to_swap: int,
+    split_blocks_to_swap: Optional[Callable[[int], list[int]]] = None,
+) -> tuple[Optional[int], list[tuple[int, int, int]]]:
+    """
+    Choose the smallest number of blocks to swap that fits the budget. The swapped blocks reuse the memory of the resident
+    blocks on the device, so the device holds `num_blocks - blocks_to_swap` blocks at a time.
+
+    For the models with several lists of blocks, each swapped by its own offloader, block_bytes is the list of the bytes of
+    each list, and split_blocks_to_swap(blocks_to_swap) returns the number of blocks to swap in each list.
+
+    Returns:
+        (blocks_to_swap or None if nothing fits, list of (blocks_to_swap, weight bytes on the device, total bytes))
+    """
+    if split_blocks_to_swap is None:
+        block_bytes = [block_bytes]
+        split_blocks_to_swap = lambda blocks_to_swap: [blocks_to_swap]
+
+    rows = []
+    chosen = None
+    for blocks_to_swap in range(0, max_blocks_to_swap + 1):
+        splits = split_blocks_to_swap(blocks_to_swap)
+        weight_bytes = other_bytes + sum(get_resident_block_bytes(b, n) for b, n in zip(block_bytes, splits))
+        total_bytes = weight_bytes + activation_bytes
+        rows.append((blocks_to_swap, weight_bytes, total_bytes))
+        if chosen is None and total_bytes <= vram_budget:
+            chosen = blocks_to_swap
+    return chosen, rows
+
+
+def format_plan_report(
+    rows: list[tuple[int, int, int]], activation_bytes: int, vram_budget: int, chosen: Optional[int]
+) -> str:
+    gb = 1024**3
+    lines = [
+        f"block swap plan: budget {vram_budget / gb:.2f} GB, activations (estimated) {activation_bytes / gb:.2f} GB",
+        f"{'blocks_to_swap':>14} {'weights GB':>11} {'total GB':>9}",
+    ]
+    for blocks_to_swap, weight_bytes, total_bytes in rows:
+        mark = " <-" if blocks_to_swap == chosen else (" ok" if total_bytes <= vram_budget else "")
+        lines.append(f"{blocks_to_swap:>14} {weight_bytes / gb:>11.2f} {total_bytes / gb:>9.2f}{mark}")
+    return "\n".join(lines)
+
+
+def get_vram_budget(device: Union[str, torch.device], vram_budget_gb: Optional[float], reserve_bytes: int) -> int:
+    """budget in bytes: `--vram_budget` if specified, otherwise the total memory of the device minus the reserve"""
+    if vram_budget_gb is not None:
+        return int(vram_budget_gb * 1024**3)
+
+    device = torch.device(device)
+    if device.type != "cuda" or not torch.cuda.is_available():
+        raise ValueError("--vram_budget is required for blocks_to_swap auto on this device / このデバイスではvram_budgetの指定が必要です")
+    total_memory = torch.cuda.get_device_properties(device).total_memory
+    return total_memory - reserve_bytes
+
+
+# region Wan
+
+
+def get_wan_seq_len(config, width: int, height: int, frames: int) -> int:
+    lat_f = (frames - 1) // config.vae_stride[0] + 1
+    lat_h = height // config.vae_stride[1]
+    lat_w = width // config.vae_stride[2]
+    return lat_f * lat_h * lat_w // (config.patch_size[0] * config.patch_size[1] * config.patch_size[2])
+
+
+def estimate_wan_activation_bytes(
+    config,
+    seq_len: int,
+    batch_size: int,
+    i2v: bool,
+    training: bool,
+    gradient_checkpointing: bool,
+    dtype_size: int = 2,
+) -> int:
+    """
+    Rough estimate of the activation memory of WanModel.forward (and backward for training).
+
+    Inference keeps the residual stream in float32 and the temporaries of one block: normalized input, q, k, v, attention
+    output, the hidden layer of FFN etc. Training keeps the inputs of the blocks with gradient checkpointing, or the
+    activations of all blocks without it.
+    """
+    dim = config.dim
+    ffn_dim = config.ffn_dim
+    tokens = batch_size * seq_len
+    context_tokens = batch_size * (config.text_len + (257 if i2v else 0))
+
+    residual = tokens * dim * 4 * 2  # x and the modulated input in float32
+    block_peak = tokens * (6 * dim + 2 * ffn_dim) * dtype_size + context_tokens * dim * 2 * dtype_size
+    if not training:
+        return residual + block_peak
+
+    # saved for backward in one block: inputs of the Linear layers, attention outputs and the hidden layer of FFN
+    saved_per_block = tokens * (12 * dim + 3 * ffn_dim) * dtype_size
+    if gradient_checkpointing:
+        saved = config.num_layers * tokens * dim * 4 + saved_per_block  # block inputs + one block recomputed
+    else:
+        saved = config.num_layers * saved_per_block
+    return residual + block_peak + saved
+
+
+def get_wan_block_bytes(
+    dit_path: str, config, weight_dtype: Optional[torch.dtype], fp8_scaled: bool
+) -> tuple[list[int], int]:
+    """sizes of the blocks and the other weights of WanModel on the device, see load_wan_model for the dtypes"""
+    from wan.modules.model import FP8_OPTIMIZATION_TARGET_KEYS, FP8_OPTIMIZATION_EXCLUDE_KEYS
+
+    def get_element_size(key: str, element_size: int) -> int:
+        if fp8_scaled:
+            is_target = any(pattern in key for pattern in FP8_OPTIMIZATION_TARGET_KEYS) and key.endswith(".weight")
+            is_excluded = any(pattern in key for pattern in FP8_OPTIMIZATION_EXCLUDE_KEYS)
+            return 1 if is_target and not is_excluded else element_size
+        if weight_dtype is not None:
+            return weight_dtype.itemsize
+        return element_size
+
+    return get_checkpoint_block_bytes(
+        dit_path, r"^(?:model\.diffusion_model\.)?blocks\.(\d+)\.", config.num_layers, get_element_size
+    )
+
+
+def plan_wan_blocks_to_swap(
+    dit_path: str,
+    config,
+    i2v: bool,
+    weight_dtype: Optional[torch.dtype],
+    fp8_scaled: bool,
+    seq_len: int,
+    batch_size: int,
+    training: bool,
+    gradient_checkpointing: bool,
+    device: Union[str, torch.device],
+    vram_budget_gb: Optional[float],
+) -> int:
+    """
+    Plan blocks_to_swap for WanModel and log the report. Raises ValueError if it does not fit even with the maximum number of
+    blocks to swap.
+    """
+    reserve_bytes = DEFAULT_TRAINING_RESERVE_BYTES if training else DEFAULT_RESERVE_BYTES
+    vram_budget = get_vram_budget(device, vram_budget_gb, reserve_bytes)
+
+    block_bytes, other_bytes = get_wan_block_bytes(dit_path, config, weight_dtype, fp8_scaled)
+    activation_bytes = estimate_wan_activation_bytes(config, seq_len, batch_size, i2v, training, gradient_checkpointing)
+
+    # backward needs two blocks on the device, see ModelOffloader
+    max_blocks_to_swap = config.num_layers - (2 if training else 1)
+    chosen, rows = plan_blocks_to_swap(block_bytes, other_bytes, activation_bytes, vram_budget, max_blocks_to_swap)
+    logger.info(format_plan_report(rows, activation_bytes, vram_budget, chosen))
+
+    if chosen is None:
+        raise ValueError(
+            f"the model does not fit in the VRAM budget even with blocks_to_swap={max_blocks_to_swap}, reduce the resolution,"
+            " frames or batch size / blocks_to_swapを最大にしてもVRAMに収まりません。解像度、フレーム数またはバッチサイズを減らしてください"
+        )
+    logger.info(f"blocks_to_swap auto: {chosen}")
+    return chosen
+
+
+# endregion
+
+# region HunyuanVideo
+
+HUNYUAN_TEXT_LEN = 256  # max length of the LLM text encoder
+HUNYUAN_VIDEO_CONFIG_NAME = "HYVideo-T/2-cfgdistill"
+
+
+def get_hunyuan_seq_len(width: int, height: int, frames: int) -> int:
+    """number of video tokens: VAE stride (4, 8, 8) and patch size (1, 2, 2)"""
+    lat_f = (frames - 1) // 4 + 1
+    return lat_f * (height // 16) * (width // 16)
+
+
+def get_hunyuan_blocks_to_swap(blocks_to_swap: int) -> tuple[int, int]:
+    """(double blocks, single blocks) to swap for blocks_to_swap, see HYVideoDiffusionTransformer.enable_block_swap"""
+    if blocks_to_swap == 0:
+        return 0, 0
+    double_blocks_to_swap = blocks_to_swap // 2
+    single_blocks_to_swap = (blocks_to_swap - double_blocks_to_swap) * 2 + 1
+    return double_blocks_to_swap, single_blocks_to_swap
+
+
+def get_hunyuan_max_blocks_to_swap(num_double_blocks: int, num_single_blocks: int, training: bool) -> int:
+    # backward needs two blocks of each list on the device, see ModelOffloader
+    num_resident_blocks = 2 if training else 1
+    max_blocks_to_swap = 0
+    while True:
+        double_blocks_to_swap, single_blocks_to_swap = get_hunyuan_blocks_to_swap(max_blocks_to_swap + 1)
+        if (
+            double_blocks_to_swap > num_double_blocks - num_resident_blocks
+            or single_blocks_to_swap > num_single_blocks - num_resident_blocks
+        ):
+            return max_blocks_to_swap
+        max_blocks_to_swap += 1
+
+
+def estimate_hunyuan_activation_bytes(
+    config: dict, seq_len: int, batch_size: int, training: bool, gradient_checkpointing: bool, dtype_size: int = 2
+) -> int:
+    """
+    Rough estimate of the activation memory of HYVideoDiffusionTransformer.forward (and backward for training), in the same
+    way as estimate_wan_activation_bytes. The video and the text tokens are processed together in the single blocks.
+    """
+    dim = config["hidden_size"]
+    ffn_dim = int(dim * config["mlp_width_ratio"])
+    num_layers = config["mm_double_blocks_depth"] + config["mm_single_blocks_depth"]
+    tokens = batch_size * (seq_len + HUNYUAN_TEXT_LEN)
+
+    residual = tokens * dim * dtype_size * 2  # x and the modulated input
+    block_peak = tokens * (6 * dim + 2 * ffn_dim) * dtype_size
+    if not training:
+        return residual + block_peak
+
+    saved_per_block = tokens * (12 * dim + 3 * ffn_dim) * dtype_size
+    if gradient_checkpointing:
+        saved = num_layers * tokens * dim * dtype_size + saved_per_block  # block inputs + one block recomputed
+    else:
+        saved = num_layers * saved_per_block
+    return residual + block_peak + saved
+
+
+def get_hunyuan_block_bytes(weight_dtype: Optional[torch.dtype], in_channels: int = 16) -> tuple[list[int], list[int], int]:
+    """
+    Sizes of the double blocks, the single blocks and the other weights of HYVideoDiffusionTransformer on the device. The
+    checkpoint may be a .pt file, so the sizes are counted on a model without weights, not from the file.
+    """
+    import accelerate
+    from hunyuan_model.models import load_dit_model
+
+    factor_kwargs = {"device": None, "dtype": None, "attn_mode": "torch", "split_attn": False}
+    with accelerate.init_empty_weights():
+        model = load_dit_model(4096, 768, in_channels, 16, factor_kwargs)  # same as load_transformer
+
+    element_size = weight_dtype.itemsize if weight_dtype is not None else 2
+
+    def get_bytes(module: torch.nn.Module) -> int:
+        return sum(p.numel() for p in module.parameters()) * element_size
+
+    double_block_bytes = [get_bytes(block) for block in model.double_blocks]
+    single_block_bytes = [get_bytes(block) for block in model.single_blocks]
+    other_bytes = get_bytes(model) - sum(double_block_bytes) - sum(single_block_bytes)
+    return double_block_bytes, single_block_bytes, other_bytes
+
+
+def plan_hunyuan_blocks_to_swap(
+    weight_dtype: Optional[torch.dtype],
+    seq_len: int,
+    batch_size: int,
+    training: bool,
+    gradient_checkpointing: bool,
+    device: Union[str, torch.device],
+    vram_budget_gb: Optional[float],
+    in_channels: int = 16,
+) -> int:
+    """
+    Plan blocks_to_swap for HYVideoDiffusionTransformer and log the report. blocks_to_swap is split into the double and the
+    single blocks by get_hunyuan_blocks_to_swap. Raises ValueError if it does not fit even with the maximum number of blocks
+    to swap.
+    """
+    from hunyuan_model.models import HUNYUAN_VIDEO_CONFIG
+
+    config = HUNYUAN_VIDEO_CONFIG[HUNYUAN_VIDEO_CONFIG_NAME]
+    reserve_bytes = DEFAULT_TRAINING_RESERVE_BYTES if training else DEFAULT_RESERVE_BYTES
+    vram_budget = get_vram_budget(device, vram_budget_gb, reserve_bytes)
+
+    double_block_bytes, single_block_bytes, other_bytes = get_hunyuan_block_bytes(weight_dtype, in_channels)
+    activation_bytes = estimate_hunyuan_activation_bytes(config, seq_len, batch_size, training, gradient_checkpointing)
+
+    max_blocks_to_swap = get_hunyuan_max_blocks_to_swap(len(double_block_bytes), len(single_block_bytes), training)
+    chosen, rows = plan_blocks_to_swap(
+        [double_block_bytes, single_block_bytes],
+        other_bytes,
+        activation_bytes,
+        vram_budget,
+        max_blocks_to_swap,
+        lambda blocks_to_swap: list(get_hunyuan_blocks_to_swap(blocks_to_swap)),
+    )
+    logger.info(format_plan_report(rows, activation_bytes, vram_budget, chosen))
+
+    if chosen is None:
+        raise ValueError(
+            f"the model does not fit in the VRAM budget even with blocks_to_swap={max_blocks_to_swap}, reduce the resolution,"
+            " frames or batch size / blocks_to_swapを最大にしてもVRAMに収まりません。解像度、フレーム数またはバッチサイズを減らしてください"
+        )
+    double_blocks_to_swap, single_blocks_to_swap = get_hunyuan_blocks_to_swap(chosen)
+    logger.info(f"blocks_to_swap auto: {chosen} (double blocks: {double_blocks_to_swap}, single blocks: {single_blocks_to_swap})")
+    return chosen
+
+
+# endregion
+
+
+def setup_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Dry run of blocks_to_swap auto: print the plan and exit")
+    parser.add_argument("--task", type=str, default="t2v-14B", help="Wan task, or 'hunyuan-video' for HunyuanVideo")
+    parser.add_argument("--dit", type=str, default=None, help="DiT checkpoint path, required for Wan")
+    parser.add_argument("--video_size", type=int, nargs=2, default=[480, 832], help="video size, height and width")
+    parser.add_argument("--video_length", type=int, default=81, help="number of frames")
+    parser.add_argument("--batch_size", type=int, default=1, help="batch size")
+    parser.add_argument("--fp8", action="store_true", help="fp8 weights (--fp8 / --fp8_base)")
+    parser.add_argument("--fp8_scaled", action="store_true", help="scaled fp8 weights")
+    parser.add_argument("--training", action="store_true", help="plan for training instead of generation")
+    parser.add_argument("--gradient_checkpointing", action="store_true", help="gradient checkpointing for training")
+    parser.add_argument("--vram_budget", type=float, default=None, help="VRAM budget in GB, default is the total memory")
+    parser.add_argument("--device", type=str, default="cuda", help="device")
+    return parser
+
+
+def main():
+    from wan.configs import WAN_CONFIGS
+
+    args = setup_parser().parse_args()
+    height, width = args.video_size
+    if args.task == "hunyuan-video":
+        try:
+            plan_hunyuan_blocks_to_swap(
+                torch.float8_e4m3fn if args.fp8 else torch.bfloat16,
+                get_hunyuan_seq_len(width, height, args.video_length),
+                args.batch_size,
+                args.training,
+                args.gradient_checkpointing,
+                args.device,
+                args.vram_budget,
+            )
+        except ValueError as e:
+            logger.error(str(e))
+        return
+
+    if args.dit is None:
+        raise ValueError("--dit is required for Wan")
+    config = WAN_CONFIGS[args.task]
+    weight_dtype = torch.float8_e4m3fn if args.fp8 and not args.fp8_scaled else config.param_dtype
+    seq_len = get_wan_seq_len(config, width, height, args.video_length)
+    try:
+        plan_wan_blocks_to_swap(
+            args.dit,
+            config,
+            "i2v" in args.task,
+            weight_dtype,
+            args.fp8_scaled,
+            seq_len,
+            args.batch_size,
+            args.training,
+            args.gradient_checkpointing,
+            args.device,
+            args.vram_budget,
+        )
+    except ValueError as e:
+        logger.error(str(e))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,12 @@
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
 import gc
 import time
 from typing import Optional
 import torch
 import torch.nn as nn
 
+from modules.fp8_optimization_utils import optimize_state_dict_with_fp8
+
 
 def clean_memory_on_device(device: torch.device):
     r"""
@@ -30,6 +32,76 @@ def synchronize_device(device: torch.device):
         torch.mps.synchronize()
 
 
+def set_host_weights(layer: nn.Module):
+    """
+    Keep the current CPU weights of the layer as the host weights. When the weights are moved to CPU, the host weights are
+    used instead of copying the weights from the device. The weights must not be modified on the device, and they must be
+    on CPU when this is called, e.g. views of the memory-mapped checkpoint.
+    """
+    for module in layer.modules():
+        if hasattr(module, "weight") and module.weight is not None:
+            assert module.weight.device.type == "cpu", "weights must be on CPU to keep them as the host weights"
+            module.offload_host_weight = module.weight.data
+
+
+def set_fp8_host_weights(layers: list[nn.Module], calc_device: torch.device) -> tuple[int, int]:
+    """
+    Quantize the weights of the Linear layers to FP8 with per-channel scales (the scale_weight convention of
+    optimize_state_dict_with_fp8), and keep them as the host weights. They are transferred in FP8 and up-converted to the
+    original dtype on the device, see copy_host_weight_to_device. The weights already in FP8 are not changed. The weights
+    must be on CPU, and set_host_weights must be called after this. The weights of all layers are quantized at once, so the
+    same-shaped weights of the layers are batched.
+
+    Returns:
+        (bytes of the weights before, bytes after)
+    """
+    modules: dict[str, nn.Linear] = {}
+    for i, layer in enumerate(layers):
+        for name, module in layer.named_modules():
+            if isinstance(module, nn.Linear) and module.weight.dtype.itemsize > 1:
+                modules[f"{i}.{name}"] = module
+    state_dict = {key + ".weight": module.weight.data for key, module in modules.items()}
+    bytes_before = sum(w.numel() * w.element_size() for w in state_dict.values())
+    state_dict = optimize_state_dict_with_fp8(state_dict, calc_device, scale_mode="channel")
+
+    bytes_after = 0
+    for key, module in modules.items():
+        module.offload_device_dtype = module.weight.dtype
+        module.offload_host_scale = state_dict[key + ".scale_weight"]
+        module.weight.data = state_dict[key + ".weight"]
+        bytes_after += module.weight.numel() * module.weight.element_size()
+    return bytes_before, bytes_after
+
+
+def copy_host_weight_to_device(
+    module: nn.Module, source: torch.Tensor, device_weight: Optional[torch.Tensor], device: torch.device
+) -> torch.Tensor:
+    """
+    Copy the host weight (or staged weight) to device_weight on the device, or to a new tensor if device_weight is None.
+    The FP8 host weights (set_fp8_host_weights) are transferred in FP8 and up-converted on the device.
+    """
+    scale_weight = getattr(module, "offload_host_scale", None)
+    if scale_weight is None or source.dtype == module.offload_device_dtype:
+        if device_weight is None:
+            return source.to(device, non_blocking=True)
+        device_weight.copy_(source, non_blocking=True)
+        return device_weight
+
+    quantized = source.to(device, non_blocking=True)
+    if device_weight is None:
+        device_weight = torch.empty(quantized.shape, dtype=module.offload_device_dtype, device=device)
+    device_weight.copy_(quantized)
+    device_weight.mul_(scale_weight.to(device, non_blocking=True))  # (out, 1) scales
+    return device_weight
+
+
+def get_host_weight(module: nn.Module, device_weight: torch.Tensor) -> torch.Tensor:
+    host_weight = getattr(module, "offload_host_weight", None)
+    if host_weight is not None:
+        return host_weight  # no copy: the weights on the device are the same as the host weights
+    return device_weight.data.to("cpu", non_blocking=True)
+
+
 def swap_weight_devices_cuda(device: torch.device, layer_to_cpu: nn.Module, layer_to_cuda: nn.Module):
     assert layer_to_cpu.__class__ == layer_to_cuda.__class__
 
@@ -52,7 +124,7 @@ def swap_weight_devices_cuda(device: torch.device, layer_to_cpu: nn.Module, laye
                     # print(
                     #     f"Module {module_to_cuda_name} not found in CPU model or shape mismatch, so not swapping and moving to device"
                     # )
-                    module_to_cuda.weight.data = module_to_cuda.weight.data.to(device)
+                    module_to_cuda.weight.data = copy_host_weight_to_device(module_to_cuda, module_to_cuda.weight.data, None, device)
 
     torch.cuda.current_stream().synchronize()  # this prevents the illegal loss value
 
@@ -61,14 +133,13 @@ def swap_weight_devices_cuda(device: torch.device, layer_to_cpu: nn.Module, laye
         # cuda to cpu
         for module_to_cpu, module_to_cuda, cuda_data_view, cpu_data_view in weight_swap_jobs:
             cuda_data_view.record_stream(stream)
-            module_to_cpu.weight.data = cuda_data_view.data.to("cpu", non_blocking=True)
+            module_to_cpu.weight.data = get_host_weight(module_to_cpu, cuda_data_view)
 
         stream.synchronize()
 
         # cpu to cuda
         for module_to_cpu, module_to_cuda, cuda_data_view, cpu_data_view in weight_swap_jobs:
-            cuda_data_view.copy_(module_to_cuda.weight.data, non_blocking=True)
-            module_to_cuda.weight.data = cuda_data_view
+            module_to_cuda.weight.data = copy_host_weight_to_device(module_to_cuda, module_to_cuda.weight.data, cuda_data_view, device)
 
     stream.synchronize()
     torch.cuda.current_stream().synchronize()  # this prevents the illegal loss value
@@ -87,14 +158,13 @@ def swap_weight_devices_no_cuda(device: torch.device, layer_to_cpu: nn.Module, l
 
     # device to cpu
     for module_to_cpu, module_to_cuda, cuda_data_view, cpu_data_view in weight_swap_jobs:
-        module_to_cpu.weight.data = cuda_data_view.data.to("cpu", non_blocking=True)
+        module_to_cpu.weight.data = get_host_weight(module_to_cpu, cuda_data_view)
 
     synchronize_device()
 
     # cpu to device
     for module_to_cpu, module_to_cuda, cuda_data_view, cpu_data_view in weight_swap_jobs:
-        cuda_data_view.copy_(module_to_cuda.weight.data, non_blocking=True)
-        module_to_cuda.weight.data = cuda_data_view
+        module_to_cuda.weight.data = copy_host_weight_to_device(module_to_cuda, module_to_cuda.weight.data, cuda_data_view, device)
 
     synchronize_device()
 
@@ -102,15 +172,348 @@ def swap_weight_devices_no_cuda(device: torch.device, layer_to_cpu: nn.Module, l
 def weighs_to_device(layer: nn.Module, device: torch.device):
     for module in layer.modules():
         if hasattr(module, "weight") and module.weight is not None:
-            module.weight.data = module.weight.data.to(device, non_blocking=True)
+            if torch.device(device).type == "cpu" and module.weight.device.type != "cpu":
+                module.weight.data = get_host_weight(module, module.weight)
+            elif torch.device(device).type != "cpu":
+                # the FP8 host weights may be moved to the device as they are by Module.to
+                module.weight.data = copy_host_weight_to_device(module, module.weight.data, None, device)
+            else:
+                module.weight.data = module.weight.data.to(device, non_blocking=True)
+
+
+# region swap schedule
+# the block indices of the swaps, shared by the offloader and the CPU simulation of the schedule (simulate_swap_schedule)
+
+
+def get_forward_swap(num_blocks: int, blocks_to_swap: int, forward_only: bool, block_idx: int) -> Optional[tuple[int, int]]:
+    """
+    Returns (block to cpu, block to cuda) submitted after the forward of block_idx, or None.
+    """
+    # if supports_backward and backward is enabled, we swap blocks more than blocks_to_swap in backward pass
+    if not forward_only and block_idx >= blocks_to_swap:
+        return None
+
+    block_idx_to_cpu = block_idx
+    block_idx_to_cuda = num_blocks - blocks_to_swap + block_idx
+    block_idx_to_cuda = block_idx_to_cuda % num_blocks  # this works for forward-only offloading
+    return block_idx_to_cpu, block_idx_to_cuda
+
+
+def get_backward_swap(num_blocks: int, blocks_to_swap: int, block_index: int) -> tuple[Optional[tuple[int, int]], Optional[int]]:
+    """
+    Returns (block to cpu, block to cuda) submitted after the backward of block_index or None, and the block to wait for
+    before the backward of the next (previous) block or None.
+    """
+    # -1 for 0-based index
+    num_blocks_propagated = num_blocks - block_index - 1
+    swapping = num_blocks_propagated > 0 and num_blocks_propagated <= blocks_to_swap
+    waiting = block_index > 0 and block_index <= blocks_to_swap
+
+    swap = (num_blocks - num_blocks_propagated, blocks_to_swap - num_blocks_propagated) if swapping else None
+    wait = block_index - 1 if waiting else None
+    return swap, wait
+
+
+def get_swap_schedule(num_blocks: int, blocks_to_swap: int, forward_only: bool) -> list[tuple[int, int]]:
+    """
+    Returns the swaps of a step (forward, and backward if not forward_only) in the order of submission.
+    """
+    schedule = []
+    for block_idx in range(num_blocks):
+        swap = get_forward_swap(num_blocks, blocks_to_swap, forward_only, block_idx)
+        if swap is not None:
+            schedule.append(swap)
+    if not forward_only:
+        for block_index in reversed(range(num_blocks)):
+            swap, _ = get_backward_swap(num_blocks, blocks_to_swap, block_index)
+            if swap is not None:
+                schedule.append(swap)
+    return schedule
+
+
+def simulate_swap_schedule(num_blocks: int, blocks_to_swap: int, forward_only: bool, num_steps: int = 3) -> None:
+    """
+    Simulate the block devices over num_steps steps on CPU, in the same order as ModelOffloader and the models call it.
+    A swapped in block is on the device only after it is waited for. Raises AssertionError if a block is computed while it
+    is not on the device, a swap moves a wrong block, the number of device slots changes, or the swaps are not in the
+    order of get_swap_schedule (which is used for the prefetch).
+    """
+    num_slots = num_blocks - blocks_to_swap
+    on_device = set(range(num_slots))  # prepare_block_devices_before_forward
+    in_flight: dict[int, int] = {}  # block to cuda -> block to cpu
+    schedule = get_swap_schedule(num_blocks, blocks_to_swap, forward_only)
+    submitted = []
+
+    def submit(swap):
+        block_idx_to_cpu, block_idx_to_cuda = swap
+        assert block_idx_to_cpu in on_device, f"block {block_idx_to_cpu} to cpu is not on the device"
+        assert block_idx_to_cuda not in on_device and block_idx_to_cuda not in in_flight, f"block {block_idx_to_cuda} is on the device"
+        on_device.remove(block_idx_to_cpu)
+        in_flight[block_idx_to_cuda] = block_idx_to_cpu
+        submitted.append(swap)
+
+    def wait(block_idx):
+        if block_idx in in_flight:
+            del in_flight[block_idx]
+            on_device.add(block_idx)
+
+    def compute(block_idx):
+        assert block_idx in on_device, f"block {block_idx} is not on the device: {sorted(on_device)}, in flight: {in_flight}"
+        assert len(on_device) + len(in_flight) == num_slots, "the number of device slots is changed"
+
+    for _ in range(num_steps):
+        # forward
+        for block_idx in range(num_blocks):
+            wait(block_idx)
+            compute(block_idx)
+            swap = get_forward_swap(num_blocks, blocks_to_swap, forward_only, block_idx)
+            if swap is not None:
+                submit(swap)
+
+        # backward: the hook of each block is called after its backward
+        if not forward_only:
+            for block_index in reversed(range(num_blocks)):
+                compute(block_index)
+                swap, wait_idx = get_backward_swap(num_blocks, blocks_to_swap, block_index)
+                if swap is not None:
+                    submit(swap)
+                if wait_idx is not None:
+                    wait(wait_idx)
+
+    assert submitted == schedule * num_steps, "the swaps are not in the order of the schedule"
+
+
+# endregion
+
+
+class StagingBufferPool:
+    """
+    Pinned host buffers to stage the weights of the blocks before copying them to the device. The buffers are allocated at
+    the first use and reused across the steps. A buffer is returned with the event of the copy from it, and it becomes
+    available when the copy is finished.
+    """
+
+    def __init__(self, num_buffers: int, buffer_size: int):
+        self.num_buffers = num_buffers
+        self.buffer_size = buffer_size
+        self.buffers: list[torch.Tensor] = []
+        self.free_indices: list[int] = []
+        self.releasing: list[tuple[int, torch.cuda.Event]] = []
+
+    def acquire(self) -> Optional[int]:
+        """
+        Returns the index of an available buffer without blocking, or None.
+        """
+        still_releasing = []
+        for buffer_idx, event in self.releasing:
+            if event.query():
+                self.free_indices.append(buffer_idx)
+            else:
+                still_releasing.append((buffer_idx, event))
+        self.releasing = still_releasing
+
+        if not self.free_indices and len(self.buffers) < self.num_buffers:
+            self.buffers.append(torch.empty(self.buffer_size, dtype=torch.uint8, pin_memory=True))
+            self.free_indices.append(len(self.buffers) - 1)
+
+        return self.free_indices.pop() if self.free_indices else None
+
+    def release(self, buffer_idx: int, event: Optional[torch.cuda.Event] = None):
+        if event is None:
+            self.free_indices.append(buffer_idx)
+        else:
+            self.releasing.append((buffer_idx, event))
+
+    def synchronize(self):
+        for buffer_idx, event in self.releasing:
+            event.synchronize()
+            self.free_indices.append(buffer_idx)
+        self.releasing = []
+
+
+STAGING_ALIGNMENT = 256
+
+
+def get_block_weight_bytes(layer: nn.Module) -> int:
+    size = 0
+    for module in layer.modules():
+        if hasattr(module, "weight") and module.weight is not None:
+            size += -(-module.weight.numel() * module.weight.element_size() // STAGING_ALIGNMENT) * STAGING_ALIGNMENT
+    return size
+
+
+def stage_block_weights(layer: nn.Module, buffer: torch.Tensor) -> dict[str, torch.Tensor]:
+    """
+    Copy the host weights of the layer to the pinned buffer. Returns the views of the buffer for the module names.
+    """
+    staged = {}
+    offset = 0
+    for name, module in layer.named_modules():
+        if hasattr(module, "weight") and module.weight is not None:
+            host_weight = module.offload_host_weight
+            num_bytes = host_weight.numel() * host_weight.element_size()
+            view = buffer[offset : offset + num_bytes].view(host_weight.dtype).view(host_weight.shape)
+            view.copy_(host_weight)
+            staged[name] = view
+            offset += -(-num_bytes // STAGING_ALIGNMENT) * STAGING_ALIGNMENT
+    return staged
+
+
+class OffloaderStats:
+    """
+    Per-block counters of the offloader: transfer bytes, transfer time, wait time and compute time.
+
+    - transfer: the swap which moves the block to the device, including the copy of the other block back to CPU if any.
+      Measured in the thread (default) or with the events on the copy stream (prefetch).
+    - wait: the host blocked for the swap (default), or the compute stream stalled for the copy (prefetch).
+    - compute: from the wait for the block to its swap out: all blocks in forward, the swapped blocks in backward.
+
+    On CUDA, the times on the streams are measured with events, which are resolved when the stats are read, so the
+    measurement does not synchronize each block.
+    """
+
+    COUNTERS = ["transfer_bytes", "transfer_time", "wait_time", "compute_time"]
+
+    def __init__(self, block_type: str, num_blocks: int, cuda_available: bool):
+        self.block_type = block_type
+        self.num_blocks = num_blocks
+        self.cuda_available = cuda_available
+        self.reset()
+
+    def reset(self):
+        self.num_transfers = [0] * self.num_blocks
+        self.transfer_bytes = [0] * self.num_blocks
+        self.transfer_time = [0.0] * self.num_blocks
+        self.wait_time = [0.0] * self.num_blocks
+        self.compute_time = [0.0] * self.num_blocks
+        self.pending: list[tuple[str, int, torch.cuda.Event, torch.cuda.Event]] = []  # (counter, block idx, start, end)
+        self.compute_start: Optional[tuple[int, object]] = None  # (block idx, event or time)
+        self.last_totals = {counter: 0 for counter in self.COUNTERS}
+
+    def record(self, stream: Optional[torch.cuda.Stream] = None):
+        """returns an event recorded on the stream (CUDA) or the current time"""
+        if not self.cuda_available:
+            return time.perf_counter()
+        event = torch.cuda.Event(enable_timing=True)
+        event.record(stream)
+        return event
+
+    def add_transfer(self, block_idx: int, num_bytes: int, start, end):
+        self.num_transfers[block_idx] += 1
+        self.transfer_bytes[block_idx] += num_bytes
+        self._add_time("transfer_time", block_idx, start, end)
+
+    def add_wait(self, block_idx: int, start, end):
+        self._add_time("wait_time", block_idx, start, end)
+
+    def start_compute(self, block_idx: int):
+        # an interval not closed by its block is discarded, e.g. the last block in backward
+        self.compute_start = (block_idx, self.record())
+
+    def end_compute(self, block_idx: int):
+        if self.compute_start is not None and self.compute_start[0] == block_idx:
+            self._add_time("compute_time", block_idx, self.compute_start[1], self.record())
+        self.compute_start = None
+
+    def _add_time(self, counter: str, block_idx: int, start, end):
+        if isinstance(start, float):
+            getattr(self, counter)[block_idx] += max(0.0, end - start)
+        else:
+            self.pending.append((counter, block_idx, start, end))
+
+    def resolve(self):
+        """wait for the pending events and add their times to the counters"""
+        for counter, block_idx, start, end in self.pending:
+            end.synchronize()
+            start.synchronize()
+            # negative for the waits if the copy was finished before the compute stream reached it
+            getattr(self, counter)[block_idx] += max(0.0, start.elapsed_time(end) / 1000)
+        self.pending = []
+
+    def get_totals(self) -> dict[str, float]:
+        self.resolve()
+        return {counter: sum(getattr(self, counter)) for counter in self.COUNTERS}
+
+    def get_logs(self, prefix: str = "block_swap") -> dict[str, float]:
+        """
+        Returns the logs of the counters since the last call, for the trackers. overlap is the fraction of the transfer time
+        hidden behind the computation.
+        """
+        totals = self.get_totals()
+        delta = {counter: totals[counter] - self.last_totals[counter] for counter in self.COUNTERS}
+        self.last_totals = totals
+
+        key = f"{prefix}/{self.block_type}"
+        logs = {
+            f"{key}/transfer_gb": delta["transfer_bytes"] / 1024**3,
+            f"{key}/transfer_time": delta["transfer_time"],
+            f"{key}/wait_time": delta["wait_time"],
+            f"{key}/compute_time": delta["compute_time"],
+        }
+        if delta["transfer_time"] > 0:
+            logs[f"{key}/overlap"] = max(0.0, 1.0 - delta["wait_time"] / delta["transfer_time"])
+        return logs
+
+    def format_summary(self) -> str:
+        totals = self.get_totals()
+        gb = 1024**3
+        lines = [
+            f"[{self.block_type}] block swap stats",
+            f"{'block':>5} {'transfers':>9} {'GB':>8} {'transfer s':>10} {'GB/s':>6} {'wait s':>8} {'compute s':>9}",
+        ]
+        for i in range(self.num_blocks):
+            if self.num_transfers[i] == 0 and self.compute_time[i] == 0:
+                continue
+            bandwidth = self.transfer_bytes[i] / gb / self.transfer_time[i] if self.transfer_time[i] > 0 else 0.0
+            lines.append(
+                f"{i:>5} {self.num_transfers[i]:>9} {self.transfer_bytes[i] / gb:>8.2f} {self.transfer_time[i]:>10.2f}"
+                f" {bandwidth:>6.1f} {self.wait_time[i]:>8.2f} {self.compute_time[i]:>9.2f}"
+            )
+        bandwidth = totals["transfer_bytes"] / gb / totals["transfer_time"] if totals["transfer_time"] > 0 else 0.0
+        lines.append(
+            f"{'total':>5} {sum(self.num_transfers):>9} {totals['transfer_bytes'] / gb:>8.2f} {totals['transfer_time']:>10.2f}"
+            f" {bandwidth:>6.1f} {totals['wait_time']:>8.2f} {totals['compute_time']:>9.2f}"
+        )
+        if totals["transfer_time"] > 0:
+            overlap = max(0.0, 1.0 - totals["wait_time"] / totals["transfer_time"])
+            lines.append(f"overlap (transfer time hidden behind compute): {overlap * 100:.1f}%")
+        if totals["compute_time"] + totals["wait_time"] > 0:
+            blocked = totals["wait_time"] / (totals["compute_time"] + totals["wait_time"])
+            lines.append(f"blocked on transfers: {blocked * 100:.1f}% of wait + compute time")
+        return "\n".join(lines)
+
+
+def get_swap_transfer_bytes(block_to_cpu: nn.Module, block_to_cuda: nn.Module) -> int:
+    """bytes copied by a swap: the weights of block_to_cuda, and the weights of block_to_cpu without the host weights"""
+    num_bytes = 0
+    for module in block_to_cuda.modules():
+        if hasattr(module, "weight") and module.weight is not None:
+            num_bytes += module.weight.numel() * module.weight.element_size()
+    for module in block_to_cpu.modules():
+        if hasattr(module, "weight") and module.weight is not None and getattr(module, "offload_host_weight", None) is None:
+            num_bytes += module.weight.numel() * module.weight.element_size()
+    return num_bytes
 
 
 class Offloader:
     """
     common offloading class
+
+    If prefetch_depth > 0 and the device is CUDA, the weights are copied on a dedicated CUDA stream and the compute stream
+    waits for the events of the copies, instead of waiting for the thread futures. The weights are not copied back to
+    CPU: the host weights are kept (see set_host_weights), so the weights must not be modified on the device. The host
+    weights of the blocks to be swapped in are staged to pinned buffers by a thread, up to prefetch_depth swaps ahead.
     """
 
-    def __init__(self, block_type: str, num_blocks: int, blocks_to_swap: int, device: torch.device, debug: bool = False):
+    def __init__(
+        self,
+        block_type: str,
+        num_blocks: int,
+        blocks_to_swap: int,
+        device: torch.device,
+        debug: bool = False,
+        prefetch_depth: int = 0,
+    ):
         self.block_type = block_type
         self.num_blocks = num_blocks
         self.blocks_to_swap = blocks_to_swap
@@ -120,6 +523,21 @@ class Offloader:
         self.thread_pool = ThreadPoolExecutor(max_workers=1)
         self.futures = {}
         self.cuda_available = device.type == "cuda"
+        self.stats: Optional[OffloaderStats] = None
+
+        if prefetch_depth > 0 and not self.cuda_available:
+            print(f"[{self.block_type}] Prefetch is supported only on CUDA, disabled")
+            prefetch_depth = 0
+        self.prefetch_depth = prefetch_depth
+        self.use_streams = prefetch_depth > 0
+        if self.use_streams:
+            self.copy_stream = torch.cuda.Stream(device)
+            self.staging_pool: Optional[StagingBufferPool] = None  # created by the subclass, needs the block size
+            self.staged: dict[int, Future] = {}  # block idx to cuda -> future of (buffer index, staged weights)
+            self.ready_events: dict[int, torch.cuda.Event] = {}  # block idx to cuda -> event of the copy
+
+    def enable_stats(self):
+        self.stats = OffloaderStats(self.block_type, self.num_blocks, self.cuda_available)
 
     def swap_weight_devices(self, block_to_cpu: nn.Module, block_to_cuda: nn.Module):
         if self.cuda_available:
@@ -128,15 +546,23 @@ class Offloader:
             swap_weight_devices_no_cuda(self.device, block_to_cpu, block_to_cuda)
 
     def _submit_move_blocks(self, blocks, block_idx_to_cpu, block_idx_to_cuda):
+        if self.use_streams:
+            self._submit_move_blocks_stream(blocks, block_idx_to_cpu, block_idx_to_cuda)
+            return
+
         def move_blocks(bidx_to_cpu, block_to_cpu, bidx_to_cuda, block_to_cuda):
+            start_time = time.perf_counter()
             if self.debug:
-                start_time = time.perf_counter()
                 print(
                     f"[{self.block_type}] Move block {bidx_to_cpu} to CPU and block {bidx_to_cuda} to {'CUDA' if self.cuda_available else 'device'}"
                 )
 
+            num_bytes = get_swap_transfer_bytes(block_to_cpu, block_to_cuda) if self.stats is not None else 0
             self.swap_weight_devices(block_to_cpu, block_to_cuda)
 
+            if self.stats is not None:
+                # the swap is synchronized in the thread
+                self.stats.add_transfer(bidx_to_cuda, num_bytes, start_time, time.perf_counter())
             if self.debug:
                 print(f"[{self.block_type}] Moved blocks {bidx_to_cpu} and {bidx_to_cuda} in {time.perf_counter()-start_time:.2f}s")
             return bidx_to_cpu, bidx_to_cuda  # , event
@@ -149,21 +575,135 @@ class Offloader:
         )
 
     def _wait_blocks_move(self, block_idx):
+        if self.use_streams:
+            self._wait_blocks_move_stream(block_idx)
+            return
+
         if block_idx not in self.futures:
             return
 
         if self.debug:
             print(f"[{self.block_type}] Wait for block {block_idx}")
-            start_time = time.perf_counter()
+        start_time = time.perf_counter()
 
         future = self.futures.pop(block_idx)
         _, bidx_to_cuda = future.result()
 
         assert block_idx == bidx_to_cuda, f"Block index mismatch: {block_idx} != {bidx_to_cuda}"
 
+        if self.stats is not None:
+            self.stats.add_wait(block_idx, start_time, time.perf_counter())
         if self.debug:
             print(f"[{self.block_type}] Waited for block {block_idx}: {time.perf_counter()-start_time:.2f}s")
 
+    # region CUDA streams
+
+    def _stage_block(self, blocks: list[nn.Module], block_idx: int) -> bool:
+        """
+        Stage the host weights of the block to a pinned buffer in the thread. Returns False if no buffer is available.
+        """
+        if block_idx in self.staged:
+            return True
+        buffer_idx = self.staging_pool.acquire()
+        if buffer_idx is None:
+            return False
+
+        def stage(block, buffer_idx):
+            return buffer_idx, stage_block_weights(block, self.staging_pool.buffers[buffer_idx])
+
+        self.staged[block_idx] = self.thread_pool.submit(stage, blocks[block_idx], buffer_idx)
+        return True
+
+    def _submit_move_blocks_stream(self, blocks, block_idx_to_cpu, block_idx_to_cuda):
+        if self.debug:
+            print(f"[{self.block_type}] Submit block {block_idx_to_cpu} to CPU and block {block_idx_to_cuda} to CUDA")
+            start_time = time.perf_counter()
+
+        compute_stream = torch.cuda.current_stream(self.device)
+        compute_done = torch.cuda.Event()
+        compute_done.record(compute_stream)
+
+        # the staged weights, usually prefetched. if not, stage now
+        if block_idx_to_cuda not in self.staged:
+            self._stage_block(blocks, block_idx_to_cuda)
+        future = self.staged.pop(block_idx_to_cuda, None)
+        buffer_idx, staged = future.result() if future is not None else (None, None)
+
+        block_to_cpu = blocks[block_idx_to_cpu]
+        block_to_cuda = blocks[block_idx_to_cuda]
+        modules_to_cpu = {k: v for k, v in block_to_cpu.named_modules()}
+
+        num_bytes = 0
+        with torch.cuda.stream(self.copy_stream):
+            # the weights of block_to_cpu are overwritten after its computation
+            self.copy_stream.wait_event(compute_done)
+            copy_start = self.stats.record(self.copy_stream) if self.stats is not None else None
+
+            for name, module_to_cuda in block_to_cuda.named_modules():
+                if not hasattr(module_to_cuda, "weight") or module_to_cuda.weight is None:
+                    continue
+
+                source = staged[name] if staged is not None else module_to_cuda.offload_host_weight
+                module_to_cpu = modules_to_cpu.get(name, None)
+                if (
+                    module_to_cpu is not None
+                    and module_to_cpu.weight.shape == module_to_cuda.weight.shape
+                    and module_to_cpu.weight.device.type == self.device.type
+                ):
+                    # reuse the device memory of block_to_cpu, no copy to CPU. the dtype of the device memory is kept
+                    device_weight = module_to_cpu.weight.data
+                    module_to_cpu.weight.data = module_to_cpu.offload_host_weight
+                    copy_host_weight_to_device(module_to_cuda, source, device_weight, self.device)
+                else:
+                    if module_to_cpu is not None and module_to_cpu.weight.device.type == self.device.type:
+                        # the device memory cannot be reused, release it
+                        module_to_cpu.weight.data = module_to_cpu.offload_host_weight
+                    device_weight = copy_host_weight_to_device(module_to_cuda, source, None, self.device)
+                    device_weight.record_stream(compute_stream)
+                module_to_cuda.weight.data = device_weight
+                num_bytes += source.numel() * source.element_size()
+
+            ready = torch.cuda.Event(enable_timing=self.stats is not None)
+            ready.record(self.copy_stream)
+
+        self.ready_events[block_idx_to_cuda] = ready
+        if self.stats is not None:
+            self.stats.add_transfer(block_idx_to_cuda, num_bytes, copy_start, ready)
+        if buffer_idx is not None:
+            self.staging_pool.release(buffer_idx, ready)
+
+        if self.debug:
+            print(f"[{self.block_type}] Submitted blocks {block_idx_to_cpu} and {block_idx_to_cuda} in {time.perf_counter()-start_time:.2f}s")
+
+    def _wait_blocks_move_stream(self, block_idx):
+        event = self.ready_events.pop(block_idx, None)
+        if event is None:
+            return
+
+        # the compute stream waits for the copy, the host does not wait
+        compute_stream = torch.cuda.current_stream(self.device)
+        if self.stats is not None:
+            # the stall is from the compute stream reaching here to the end of the copy
+            self.stats.add_wait(block_idx, self.stats.record(compute_stream), event)
+        compute_stream.wait_event(event)
+
+        if self.debug:
+            print(f"[{self.block_type}] Wait for block {block_idx} on the compute stream")
+
+    def _synchronize_streams(self):
+        """
+        Wait for all the copies and the staging, and discard the staged weights. Call this before moving the weights.
+        """
+        for future in self.staged.values():
+            buffer_idx, _ = future.result()
+            self.staging_pool.release(buffer_idx)
+        self.staged = {}
+        self.copy_stream.synchronize()
+        self.ready_events = {}
+        self.staging_pool.synchronize()
+
+    # endregion
+
 
 class ModelOffloader(Offloader):
     """
@@ -179,11 +719,48 @@ class ModelOffloader(Offloader):
         supports_backward: bool,
         device: torch.device,
         debug: bool = False,
+        use_host_weights: bool = False,
+        prefetch_depth: int = 0,
+        fp8_host_weights: bool = False,
     ):
-        super().__init__(block_type, num_blocks, blocks_to_swap, device, debug)
+        super().__init__(block_type, num_blocks, blocks_to_swap, device, debug, prefetch_depth)
+
+        # with one block on the device, the backward of the second last block starts before it is swapped in. this is in
+        # the schedule (see simulate_swap_schedule), so it applies to both the thread and the stream swaps
+        assert (
+            not supports_backward or blocks_to_swap <= num_blocks - 2
+        ), f"Cannot swap more than {num_blocks - 2} blocks with backward. Requested {blocks_to_swap} blocks to swap."
+
+        if fp8_host_weights:
+            if supports_backward:
+                # only the swapped blocks: the other blocks stay on the device in training, and quantizing them loses
+                # precision without saving transfers. they are transferred in the original dtype in forward only offloading
+                swapped_block_indices = {idx for swap in get_swap_schedule(num_blocks, blocks_to_swap, False) for idx in swap}
+                fp8_blocks = [block for i, block in enumerate(blocks) if i in swapped_block_indices]
+            else:
+                fp8_blocks = blocks  # all blocks are swapped in forward only offloading
+            bytes_before, bytes_after = set_fp8_host_weights(fp8_blocks, device)
+            print(
+                f"[{self.block_type}] FP8 host weights of Linear layers in {len(fp8_blocks)} blocks: {bytes_before / 1024**3:.2f} GB"
+                f" -> {bytes_after / 1024**3:.2f} GB"
+            )
+
+        if use_host_weights or self.use_streams or fp8_host_weights:
+            # the blocks must be on CPU here, see set_host_weights
+            for block in blocks:
+                set_host_weights(block)
+
+        if self.use_streams:
+            # one more buffer for the swap being copied
+            buffer_size = max(get_block_weight_bytes(block) for block in blocks)
+            self.staging_pool = StagingBufferPool(self.prefetch_depth + 1, buffer_size)
+            print(
+                f"[{self.block_type}] Prefetch {self.prefetch_depth} swaps ahead with pinned buffers of {buffer_size / 1024**2:.1f} MB"
+            )
 
         self.supports_backward = supports_backward
         self.forward_only = not supports_backward  # forward only offloading: can be changed to True for inference
+        self.schedule_positions: Optional[dict[tuple[int, int], int]] = None
 
         if self.supports_backward:
             # register backward hooks
@@ -196,6 +773,7 @@ class ModelOffloader(Offloader):
 
     def set_forward_only(self, forward_only: bool):
         self.forward_only = forward_only
+        self.schedule_positions = None
 
     def __del__(self):
         if self.supports_backward:
@@ -203,31 +781,51 @@ class ModelOffloader(Offloader):
                 handle.remove()
 
     def create_backward_hook(self, blocks: list[nn.Module], block_index: int) -> Optional[callable]:
-        # -1 for 0-based index
-        num_blocks_propagated = self.num_blocks - block_index - 1
-        swapping = num_blocks_propagated > 0 and num_blocks_propagated <= self.blocks_to_swap
-        waiting = block_index > 0 and block_index <= self.blocks_to_swap
+        swap, block_idx_to_wait = get_backward_swap(self.num_blocks, self.blocks_to_swap, block_index)
+        swapping = swap is not None
+        waiting = block_idx_to_wait is not None
 
         if not swapping and not waiting:
             return None
 
         # create  hook
-        block_idx_to_cpu = self.num_blocks - num_blocks_propagated
-        block_idx_to_cuda = self.blocks_to_swap - num_blocks_propagated
-        block_idx_to_wait = block_index - 1
-
         def backward_hook(module, grad_input, grad_output):
             if self.debug:
                 print(f"Backward hook for block {block_index}")
+            if self.stats is not None:
+                self.stats.end_compute(block_index)
 
             if swapping:
-                self._submit_move_blocks(blocks, block_idx_to_cpu, block_idx_to_cuda)
+                self._submit_move_blocks(blocks, *swap)
+                self._prefetch(blocks, swap)
             if waiting:
                 self._wait_blocks_move(block_idx_to_wait)
+                if self.stats is not None:
+                    self.stats.start_compute(block_idx_to_wait)
             return None
 
         return backward_hook
 
+    def _prefetch(self, blocks: list[nn.Module], last_swap: Optional[tuple[int, int]]):
+        """
+        Stage the blocks of the next swaps in the schedule, up to prefetch_depth swaps ahead of last_swap.
+        """
+        if not self.use_streams:
+            return
+
+        if self.schedule_positions is None:
+            self.schedule = get_swap_schedule(self.num_blocks, self.blocks_to_swap, self.forward_only)
+            self.schedule_positions = {swap: i for i, swap in enumerate(self.schedule)}
+
+        position = self.schedule_positions.get(last_swap, -1) if last_swap is not None else -1
+        for i in range(1, self.prefetch_depth + 1):
+            if len(self.staged) >= self.prefetch_depth:
+                break
+            # the schedule is repeated in the next step
+            _, block_idx_to_cuda = self.schedule[(position + i) % len(self.schedule)]
+            if not self._stage_block(blocks, block_idx_to_cuda):
+                break  # no buffer is available, retry after the next swap
+
     def prepare_block_devices_before_forward(self, blocks: list[nn.Module]):
         if self.blocks_to_swap is None or self.blocks_to_swap == 0:
             return
@@ -235,6 +833,9 @@ class ModelOffloader(Offloader):
         if self.debug:
             print(f"[{self.block_type}] Prepare block devices before forward")
 
+        if self.use_streams:
+            self._synchronize_streams()
+
         for b in blocks[0 : self.num_blocks - self.blocks_to_swap]:
             b.to(self.device)
             weighs_to_device(b, self.device)  # make sure weights are on device
@@ -246,21 +847,35 @@ class ModelOffloader(Offloader):
         synchronize_device(self.device)
         clean_memory_on_device(self.device)
 
+        self._prefetch(blocks, None)
+
     def wait_for_block(self, block_idx: int):
         if self.blocks_to_swap is None or self.blocks_to_swap == 0:
             return
         self._wait_blocks_move(block_idx)
+        if self.stats is not None:
+            self.stats.start_compute(block_idx)
 
     def submit_move_blocks_forward(self, blocks: list[nn.Module], block_idx: int):
         # check if blocks_to_swap is enabled
         if self.blocks_to_swap is None or self.blocks_to_swap == 0:
             return
+        if self.stats is not None:
+            self.stats.end_compute(block_idx)
 
-        # if supports_backward and backward is enabled, we swap blocks more than blocks_to_swap in backward pass
-        if not self.forward_only and block_idx >= self.blocks_to_swap:
+        swap = get_forward_swap(self.num_blocks, self.blocks_to_swap, self.forward_only, block_idx)
+        if swap is None:
             return
 
-        block_idx_to_cpu = block_idx
-        block_idx_to_cuda = self.num_blocks - self.blocks_to_swap + block_idx
-        block_idx_to_cuda = block_idx_to_cuda % self.num_blocks  # this works for forward-only offloading
-        self._submit_move_blocks(blocks, block_idx_to_cpu, block_idx_to_cuda)
+        self._submit_move_blocks(blocks, *swap)
+        self._prefetch(blocks, swap)
+
+
+if __name__ == "__main__":
+    # check the swap schedule on CPU: python -m modules.custom_offloading_utils
+    for num_blocks in [2, 3, 4, 10, 20, 40]:
+        for blocks_to_swap in range(1, num_blocks):
+            simulate_swap_schedule(num_blocks, blocks_to_swap, forward_only=True)
+            if blocks_to_swap <= num_blocks - 2:
+                simulate_swap_schedule(num_blocks, blocks_to_swap, forward_only=False)
+    print("Swap schedule check passed")
@@ -88,12 +88,69 @@ def quantize_tensor_to_fp8(tensor, scale, exp_bits=4, mantissa_bits=3, sign_bits
     return quantized, scale
 
 
+FP8_SCALE_MODES = ["tensor", "channel", "block"]
+
+
+def calculate_fp8_scale(weights, max_value, scale_mode="tensor", block_size=128):
+    """
+    Calculate the scale factors of a batch of weights with the same shape.
+
+    Args:
+        weights (torch.Tensor): Weights stacked along the first dimension, (n, *weight_shape)
+        max_value (float): Maximum value of FP8 format
+        scale_mode (str): "tensor" for one scale per weight, "channel" for one scale per output channel (row), "block" for
+            one scale per block of block_size input elements in each row
+        block_size (int): Block size for "block" mode
+
+    Returns:
+        torch.Tensor: Scale factors, (n, 1) for "tensor", (n, out_features, 1) for "channel" and
+            (n, out_features, in_features // block_size) for "block"
+    """
+    n = weights.shape[0]
+    if scale_mode == "tensor":
+        amax = torch.amax(torch.abs(weights.reshape(n, -1)), dim=1, keepdim=True)
+    elif scale_mode == "channel":
+        amax = torch.amax(torch.abs(weights), dim=2, keepdim=True)
+    elif scale_mode == "block":
+        out_features, in_features = weights.shape[1:]
+        amax = torch.amax(torch.abs(weights.reshape(n, out_features, in_features // block_size, block_size)), dim=3)
+    else:
+        raise ValueError(f"Unsupported scale mode: {scale_mode}")
+
+    scale = amax / max_value
+    return torch.where(scale > 0, scale, torch.ones_like(scale))  # all zero weights/rows/blocks: avoid division by zero
+
+
+def dequantize_fp8_weight(weight, scale_weight, dtype):
+    """
+    Dequantize a FP8 weight with its scale. The scale shapes are () or (1,) for "tensor", (out_features, 1) for "channel"
+    and (out_features, in_features // block_size) for "block".
+    """
+    if scale_weight.ndim == 2 and scale_weight.shape[1] > 1:
+        out_features, num_blocks = scale_weight.shape
+        weight = weight.to(dtype).view(out_features, num_blocks, -1) * scale_weight.unsqueeze(-1)
+        return weight.view(out_features, -1)
+    return weight.to(dtype) * scale_weight
+
+
 def optimize_state_dict_with_fp8(
-    state_dict, calc_device, target_layer_keys=None, exclude_layer_keys=None, exp_bits=4, mantissa_bits=3, move_to_device=False
+    state_dict,
+    calc_device,
+    target_layer_keys=None,
+    exclude_layer_keys=None,
+    exp_bits=4,
+    mantissa_bits=3,
+    move_to_device=False,
+    scale_mode="tensor",
+    block_size=128,
+    max_batch_bytes=256 * 1024 * 1024,
 ):
     """
     Optimize Linear layer weights in a model's state dict to FP8 format.
 
+    The weights with the same shape, dtype and device are quantized in batches of up to max_batch_bytes: they are copied
+    to the calculating device together, and the scales are calculated for the whole batch at once.
+
     Args:
         state_dict (dict): State dict to optimize, replaced in-place
         calc_device (str): Device to quantize tensors on
@@ -102,6 +159,10 @@ def optimize_state_dict_with_fp8(
         exp_bits (int): Number of exponent bits
         mantissa_bits (int): Number of mantissa bits
         move_to_device (bool): Move optimized tensors to the calculating device
+        scale_mode (str): "tensor", "channel" or "block", see calculate_fp8_scale. The weights which are not 2D (or not
+            divisible by block_size for "block") are quantized with "tensor" mode
+        block_size (int): Block size for "block" mode
+        max_batch_bytes (int): Maximum size of the weights in a batch
 
     Returns:
         dict: FP8 optimized state dict
@@ -112,6 +173,8 @@ def optimize_state_dict_with_fp8(
         fp8_dtype = torch.float8_e5m2
     else:
         raise ValueError(f"Unsupported FP8 format: E{exp_bits}M{mantissa_bits}")
+    if scale_mode not in FP8_SCALE_MODES:
+        raise ValueError(f"Unsupported scale mode: {scale_mode}")
 
     # Calculate FP8 max value
     max_value = calculate_fp8_maxval(exp_bits, mantissa_bits)
@@ -120,8 +183,8 @@ def optimize_state_dict_with_fp8(
     # Create optimized state dict
     optimized_count = 0
 
-    # Enumerate tarket keys
-    target_state_dict_keys = []
+    # Enumerate tarket keys, grouped by shape, dtype and device
+    target_key_groups: dict[tuple, list[str]] = {}
     for key in state_dict.keys():
         # Check if it's a weight key and matches target patterns
         is_target = (target_layer_keys is None or any(pattern in key for pattern in target_layer_keys)) and key.endswith(".weight")
@@ -129,51 +192,84 @@ def optimize_state_dict_with_fp8(
         is_target = is_target and not is_excluded
 
         if is_target and isinstance(state_dict[key], torch.Tensor):
-            target_state_dict_keys.append(key)
-
-    # Process each key
-    for key in tqdm(target_state_dict_keys):
-        value = state_dict[key]
-
-        # Save original device and dtype
-        original_device = value.device
-        original_dtype = value.dtype
-
-        # Move to calculation device
-        if calc_device is not None:
-            value = value.to(calc_device)
-
-        # Calculate scale factor
-        scale = torch.max(torch.abs(value.flatten())) / max_value
-        # print(f"Optimizing {key} with scale: {scale}")
-
-        # Quantize weight to FP8
-        quantized_weight, _ = quantize_tensor_to_fp8(value, scale, exp_bits, mantissa_bits, 1, max_value, min_value)
-
-        # Add to state dict using original key for weight and new key for scale
-        fp8_key = key  # Maintain original key
-        scale_key = key.replace(".weight", ".scale_weight")
-
-        quantized_weight = quantized_weight.to(fp8_dtype)
-
-        if not move_to_device:
-            quantized_weight = quantized_weight.to(original_device)
-
-        scale_tensor = torch.tensor([scale], dtype=original_dtype, device=quantized_weight.device)
-
-        state_dict[fp8_key] = quantized_weight
-        state_dict[scale_key] = scale_tensor
-
-        optimized_count += 1
-
-        if calc_device is not None:  # optimized_count % 10 == 0 and
-            # free memory on calculation device
-            clean_memory_on_device(calc_device)
+            value = state_dict[key]
+            target_key_groups.setdefault((tuple(value.shape), value.dtype, value.device), []).append(key)
+
+    num_target_keys = sum(len(keys) for keys in target_key_groups.values())
+    pbar = tqdm(total=num_target_keys)
+
+    # Process each group in batches
+    for (shape, original_dtype, original_device), keys in target_key_groups.items():
+        group_scale_mode = scale_mode
+        if group_scale_mode != "tensor" and len(shape) != 2:
+            group_scale_mode = "tensor"
+        elif group_scale_mode == "block" and shape[1] % block_size != 0:
+            logger.warning(f"in_features {shape[1]} is not divisible by block size {block_size}, use channel-wise scales")
+            group_scale_mode = "channel"
+
+        device = calc_device if calc_device is not None else original_device
+        weight_bytes = state_dict[keys[0]].numel() * state_dict[keys[0]].element_size()
+        batch_size = max(1, min(len(keys), max_batch_bytes // max(weight_bytes, 1)))
+
+        for i in range(0, len(keys), batch_size):
+            batch_keys = keys[i : i + batch_size]
+
+            # Move to calculation device
+            values = torch.empty((len(batch_keys),) + shape, dtype=original_dtype, device=device)
+            for j, key in enumerate(batch_keys):
+                values[j].copy_(state_dict[key], non_blocking=True)
+
+            # Calculate scale factors and quantize weights to FP8
+            scale = calculate_fp8_scale(values, max_value, group_scale_mode, block_size)
+            if group_scale_mode == "tensor":
+                scaled_values, broadcast_scale = values, scale.reshape(len(batch_keys), *([1] * len(shape)))
+            elif group_scale_mode == "channel":
+                scaled_values, broadcast_scale = values, scale
+            else:
+                scaled_values = values.view(len(batch_keys), shape[0], shape[1] // block_size, block_size)
+                broadcast_scale = scale.unsqueeze(-1)
+            quantized_weights, _ = quantize_tensor_to_fp8(
+                scaled_values, broadcast_scale, exp_bits, mantissa_bits, 1, max_value, min_value
+            )
+            quantized_weights = quantized_weights.view((len(batch_keys),) + shape)
+            del values, scaled_values, broadcast_scale
+
+            quantized_weights = quantized_weights.to(fp8_dtype)
+            if not move_to_device:
+                # one transfer for the batch
+                quantized_weights = quantized_weights.to(original_device)
+                scale = scale.to(original_device)
+
+            for j, key in enumerate(batch_keys):
+                # Add to state dict using original key for weight and new key for scale
+                scale_key = key.replace(".weight", ".scale_weight")
+                # each weight has its own storage: safetensors does not save shared storage, and a view would keep the whole
+                # batch alive
+                state_dict[key] = quantized_weights[j].clone()
+                state_dict[scale_key] = scale[j].clone()  # (1,) for "tensor" mode, same as before
+
+            optimized_count += len(batch_keys)
+            pbar.update(len(batch_keys))
+
+    pbar.close()
+
+    if calc_device is not None:
+        # free memory on calculation device
+        clean_memory_on_device(calc_device)
 
     logger.info(f"Number of optimized Linear layers: {optimized_count}")
     return state_dict
 
 
+def is_rowwise_scaled_mm_supported(device, dtype):
+    """
+    Returns True if scaled_mm supports per-row scales of the input and per-column scales of the weight on the device. It
+    requires SM 9.0+ (H100 etc.) and bfloat16 output.
+    """
+    device = torch.device(device)
+    return device.type == "cuda" and torch.cuda.get_device_capability(device) >= (9, 0) and dtype == torch.bfloat16
+
+
 def fp8_linear_forward_patch(self: nn.Linear, x, use_scaled_mm=False, max_value=None):
     """
     Patched forward method for Linear layers with FP8 weights.
@@ -181,21 +277,34 @@ def fp8_linear_forward_patch(self: nn.Linear, x, use_scaled_mm=False, max_value=
     Args:
         self: Linear layer instance
         x (torch.Tensor): Input tensor
-        use_scaled_mm (bool): Use scaled_mm for FP8 Linear layers, requires SM 8.9+ (RTX 40 series)
+        use_scaled_mm (bool): Use scaled_mm for FP8 Linear layers, requires SM 8.9+ (RTX 40 series). Per-channel scales
+            require SM 9.0+, see is_rowwise_scaled_mm_supported
         max_value (float): Maximum value for FP8 quantization. If None, no quantization is applied for input tensor.
 
     Returns:
         torch.Tensor: Result of linear transformation
     """
+    rowwise = self.scale_weight.numel() > 1
+    if use_scaled_mm and rowwise and x.dtype != torch.bfloat16:
+        use_scaled_mm = False  # rowwise scaled_mm supports bfloat16 output only, dequantize the weight
+
     if use_scaled_mm:
         input_dtype = x.dtype
         original_weight_dtype = self.scale_weight.dtype
         weight_dtype = self.weight.dtype
-        target_dtype = torch.float8_e5m2
+        # rowwise scaled_mm supports E4M3FN input only. E4M3FN has a small range, so the input is scaled per row
+        target_dtype = torch.float8_e4m3fn if rowwise else torch.float8_e5m2
         assert weight_dtype == torch.float8_e4m3fn, "Only FP8 E4M3FN format is supported"
         assert x.ndim == 3, "Input tensor must be 3D (batch_size, seq_len, hidden_dim)"
+        original_shape = x.shape
 
-        if max_value is None:
+        if rowwise:
+            # per-row scale of the input: (M, 1)
+            x = x.reshape(-1, x.shape[2]).to(torch.float32)
+            scale_x = torch.amax(torch.abs(x), dim=1, keepdim=True) / torch.finfo(target_dtype).max
+            scale_x = torch.where(scale_x > 0, scale_x, torch.ones_like(scale_x))
+            x = x / scale_x
+        elif max_value is None:
             # no input quantization
             scale_x = torch.tensor(1.0, dtype=torch.float32, device=x.device)
         else:
@@ -205,24 +314,32 @@ def fp8_linear_forward_patch(self: nn.Linear, x, use_scaled_mm=False, max_value=
             # quantize input tensor to FP8: this seems to consume a lot of memory
             x, _ = quantize_tensor_to_fp8(x, scale_x, 5, 2, 1, max_value, -max_value)
 
-        original_shape = x.shape
-        x = x.reshape(-1, x.shape[2]).to(target_dtype)
+        x = x.reshape(-1, x.shape[-1]).to(target_dtype)
 
         weight = self.weight.t()
         scale_weight = self.scale_weight.to(torch.float32)
+        if rowwise:
+            # per-channel scales: rowwise scaled_mm needs (M, 1) scale for the input and (1, N) scale for the weight
+            scale_weight = scale_weight.reshape(1, -1)
 
         if self.bias is not None:
-            # float32 is not supported with bias in scaled_mm
-            o = torch._scaled_mm(x, weight, out_dtype=original_weight_dtype, bias=self.bias, scale_a=scale_x, scale_b=scale_weight)
+            # float32 is not supported with bias in scaled_mm. rowwise scaled_mm needs bfloat16 output and bias
+            out_dtype = torch.bfloat16 if rowwise else original_weight_dtype
+            bias = self.bias.to(out_dtype)
+            o = torch._scaled_mm(x, weight, out_dtype=out_dtype, bias=bias, scale_a=scale_x, scale_b=scale_weight)
         else:
             o = torch._scaled_mm(x, weight, out_dtype=input_dtype, scale_a=scale_x, scale_b=scale_weight)
 
         return o.reshape(original_shape[0], original_shape[1], -1).to(input_dtype)
 
     else:
-        # Dequantize the weight
+        # Dequantize the weight, or use the cached dequantized weight
         original_dtype = self.scale_weight.dtype
-        dequantized_weight = self.weight.to(original_dtype) * self.scale_weight
+        dequantized_weight = getattr(self, "fp8_dequantized_weight", None)
+        if dequantized_weight is None or dequantized_weight.device != self.weight.device:
+            dequantized_weight = dequantize_fp8_weight(self.weight, self.scale_weight, original_dtype)
+            if getattr(self, "fp8_cache_dequantized_weight", False):
+                self.fp8_dequantized_weight = dequantized_weight.detach()
 
         # Perform linear transformation
         if self.bias is not None:
@@ -233,7 +350,38 @@ def fp8_linear_forward_patch(self: nn.Linear, x, use_scaled_mm=False, max_value=
         return output
 
 
-def apply_fp8_monkey_patch(model, optimized_state_dict, use_scaled_mm=False):
+def fp8_linear_reference(x, weight, scale_weight, bias=None):
+    """
+    Reference implementation of the patched forward: dequantize the FP8 weight and calculate in float32. This works on
+    CPU, to validate the patched forward and the quantization without GPU.
+    """
+    dequantized_weight = dequantize_fp8_weight(weight.cpu(), scale_weight.cpu().to(torch.float32), torch.float32)
+    bias = bias.cpu().to(torch.float32) if bias is not None else None
+    return F.linear(x.cpu().to(torch.float32), dequantized_weight, bias)
+
+
+def set_fp8_dequantized_weight_cache(model, enabled):
+    """
+    Enable or disable the cache of the dequantized weights of the FP8 Linear layers patched by apply_fp8_monkey_patch.
+    The cached weight is calculated in the first forward, and is kept on the device of the weight. This uses the memory
+    of the weights in the original dtype, so enable it only for the layers which stay resident on the device (not
+    swapped). It has no effect on the layers with scaled_mm. The cache is a non-persistent buffer: it is moved with the
+    module by to(), is not saved in the state dict, and is released when disabled.
+
+    Returns:
+        int: Number of the layers
+    """
+    count = 0
+    for module in model.modules():
+        if isinstance(module, nn.Linear) and hasattr(module, "scale_weight"):
+            module.fp8_cache_dequantized_weight = enabled
+            if not enabled:
+                module.fp8_dequantized_weight = None
+            count += 1
+    return count
+
+
+def apply_fp8_monkey_patch(model, optimized_state_dict, use_scaled_mm=False, compute_dtype=None):
     """
     Apply monkey patching to a model using FP8 optimized state dict.
 
@@ -241,6 +389,8 @@ def apply_fp8_monkey_patch(model, optimized_state_dict, use_scaled_mm=False):
         model (nn.Module): Model instance to patch
         optimized_state_dict (dict): FP8 optimized state dict
         use_scaled_mm (bool): Use scaled_mm for FP8 Linear layers, requires SM 8.9+ (RTX 40 series)
+        compute_dtype (torch.dtype): dtype of the inputs in the forward. The weights of the model may still have another
+            dtype when patched. If None, the dtype of the scales in the state dict (the original dtype of the weights)
 
     Returns:
         nn.Module: The patched model (same instance, modified in-place)
@@ -252,27 +402,47 @@ def apply_fp8_monkey_patch(model, optimized_state_dict, use_scaled_mm=False):
     # Find all scale keys to identify FP8-optimized layers
     scale_keys = [k for k in optimized_state_dict.keys() if k.endswith(".scale_weight")]
 
-    # Enumerate patched layers
-    patched_module_paths = set()
+    # Enumerate patched layers and the shapes of the scales
+    patched_module_scale_shapes = {}
     for scale_key in scale_keys:
         # Extract module path from scale key (remove .scale_weight)
         module_path = scale_key.rsplit(".scale_weight", 1)[0]
-        patched_module_paths.add(module_path)
+        patched_module_scale_shapes[module_path] = optimized_state_dict[scale_key].shape
 
     patched_count = 0
+    num_not_scaled_mm = 0
 
     # Apply monkey patch to each layer with FP8 weights
     for name, module in model.named_modules():
         # Check if this module has a corresponding scale_weight
-        has_scale = name in patched_module_paths
+        has_scale = name in patched_module_scale_shapes
 
         # Apply patch if it's a Linear layer with FP8 scale
         if isinstance(module, nn.Linear) and has_scale:
-            # register the scale_weight as a buffer to load the state_dict
-            module.register_buffer("scale_weight", torch.tensor(1.0, dtype=module.weight.dtype))
+            # register the scale_weight as a buffer to load the state_dict. per-tensor scale is registered as a scalar
+            scale_shape = patched_module_scale_shapes[name]
+            if scale_shape.numel() == 1:
+                module.register_buffer("scale_weight", torch.tensor(1.0, dtype=module.weight.dtype))
+            else:
+                module.register_buffer("scale_weight", torch.ones(scale_shape, dtype=module.weight.dtype))
+            module.register_buffer("fp8_dequantized_weight", None, persistent=False)  # set_fp8_dequantized_weight_cache
+
+            # scaled_mm supports per-tensor scale, and per-channel scale (rowwise) on SM 9.0+. not block-wise scale
+            module_compute_dtype = compute_dtype or optimized_state_dict[name + ".scale_weight"].dtype
+            module_use_scaled_mm = use_scaled_mm and (
+                scale_shape.numel() == 1
+                or (
+                    len(scale_shape) == 2
+                    and scale_shape[1] == 1
+                    and torch.cuda.is_available()
+                    and is_rowwise_scaled_mm_supported(torch.cuda.current_device(), module_compute_dtype)
+                )
+            )
+            if use_scaled_mm and not module_use_scaled_mm:
+                num_not_scaled_mm += 1
 
             # Create a new forward method with the patched version.
-            def new_forward(self, x):
+            def new_forward(self, x, use_scaled_mm=module_use_scaled_mm):
                 return fp8_linear_forward_patch(self, x, use_scaled_mm, max_value)
 
             # Bind method to module
@@ -280,6 +450,8 @@ def apply_fp8_monkey_patch(model, optimized_state_dict, use_scaled_mm=False):
 
             patched_count += 1
 
+    if num_not_scaled_mm > 0:
+        logger.warning(f"scaled_mm is not supported with the scales of {num_not_scaled_mm} Linear layers, dequantize the weights")
     logger.info(f"Number of monkey-patched Linear layers: {patched_count}")
     return model
 
@@ -323,8 +495,8 @@ def example_usage():
     state_dict = test_model.state_dict()
 
     # Apply FP8 optimization to state dict
-    cuda_device = torch.device("cuda")
-    optimized_state_dict = optimize_state_dict_with_fp8(state_dict, cuda_device, ["single_blocks"], ["2"])
+    calc_device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    optimized_state_dict = optimize_state_dict_with_fp8(state_dict, calc_device, ["single_blocks"], ["2"])
 
     # Apply monkey patching to the model
     optimized_model = TestModel()  # re-instantiate model
@@ -352,5 +524,63 @@ def example_usage():
     return test_model
 
 
+# Accuracy check against the bfloat16 outputs, runs on CPU
+def check_accuracy(device="cpu"):
+    device = torch.device(device)
+    torch.manual_seed(42)
+
+    class TestModel(nn.Module):
+        def __init__(self, in_features, out_features):
+            super().__init__()
+            self.fc = nn.Linear(in_features, out_features)
+
+        def forward(self, x):
+            return self.fc(x)
+
+    for in_features, out_features in [(1536, 1536), (1536, 8960), (8960, 1536)]:
+        # the magnitudes of the rows vary like the real weights, and there are some outliers
+        weight = torch.randn(out_features, in_features) * 0.02 * torch.exp(torch.randn(out_features, 1) * 0.5)
+        weight[torch.rand_like(weight) < 1e-4] *= 20
+        weight = weight.to(torch.bfloat16)
+        bias = (torch.randn(out_features) * 0.01).to(torch.bfloat16)
+        x = torch.randn(2, 64, in_features, dtype=torch.bfloat16)
+
+        reference_output = F.linear(x.float(), weight.float(), bias.float())
+
+        errors = {}
+        for scale_mode in FP8_SCALE_MODES:
+            state_dict = {"fc.weight": weight.clone(), "fc.bias": bias.clone()}
+            state_dict = optimize_state_dict_with_fp8(state_dict, device, ["fc"], None, scale_mode=scale_mode)
+
+            model = TestModel(in_features, out_features).to(torch.bfloat16)
+            apply_fp8_monkey_patch(model, state_dict)
+            model.load_state_dict(state_dict, strict=True, assign=True)
+            model.to(device)
+
+            with torch.no_grad():
+                output = model(x.to(device)).cpu().float()
+
+                # the patched forward matches the float32 reference of the quantized weights within bfloat16 precision
+                fp8_reference_output = fp8_linear_reference(x, state_dict["fc.weight"], state_dict["fc.scale_weight"], bias)
+                diff = (output - fp8_reference_output).abs().max().item()
+                assert diff <= 2e-2 * fp8_reference_output.abs().max().item(), f"patched forward mismatch: {scale_mode}, {diff}"
+
+                # the cached dequantized weight gives the same output
+                set_fp8_dequantized_weight_cache(model, True)
+                cached_output_1 = model(x.to(device)).cpu().float()
+                cached_output_2 = model(x.to(device)).cpu().float()
+                assert model.fc.fp8_dequantized_weight is not None
+                assert torch.equal(cached_output_1, output) and torch.equal(cached_output_2, output)
+
+            errors[scale_mode] = ((output - reference_output).norm() / reference_output.norm()).item()
+
+        print(f"Linear {in_features} -> {out_features}, relative error to bfloat16: " + ", ".join(f"{k}: {v:.5f}" for k, v in errors.items()))
+        assert errors["channel"] <= errors["tensor"] and errors["block"] <= errors["tensor"], "per-channel/block scales are worse"
+        assert max(errors.values()) < 0.1, "too large quantization error"
+
+    print("Accuracy check passed")
+
+
 if __name__ == "__main__":
     example_usage()
+    check_accuracy()
@@ -752,7 +752,10 @@ class LoRANetwork(torch.nn.Module):
     def get_trainable_params(self):
         return self.parameters()
 
-    def save_weights(self, file, dtype, metadata):
+    def save_weights(self, file, dtype, metadata, async_save: bool = False):
+        """
+        If async_save is True, the safetensors file is written in the background and the Future is returned.
+        """
         if metadata is not None and len(metadata) == 0:
             metadata = None
 
@@ -775,9 +778,15 @@ class LoRANetwork(torch.nn.Module):
             metadata["sshs_model_hash"] = model_hash
             metadata["sshs_legacy_hash"] = legacy_hash
 
+            if async_save:
+                from utils.safetensors_utils import mem_eff_save_file_async
+
+                # the metadata is copied because the caller updates it for the next checkpoint
+                return mem_eff_save_file_async(state_dict, file, dict(metadata), fsync=True)
             save_file(state_dict, file, metadata)
         else:
             torch.save(state_dict, file)
+        return None
 
     def backup_weights(self):
         # 重みのバックアップを行う
@@ -0,0 +1,81 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+import torch.nn as nn
+
+from modules.fp8_optimization_utils import (
+    FP8_SCALE_MODES,
+    apply_fp8_monkey_patch,
+    fp8_linear_reference,
+    is_rowwise_scaled_mm_supported,
+    optimize_state_dict_with_fp8,
+    set_fp8_dequantized_weight_cache,
+)
+
+
+class LinearModel(nn.Module):
+    def __init__(self, in_features, out_features):
+        super().__init__()
+        self.fc = nn.Linear(in_features, out_features)
+
+    def forward(self, x):
+        return self.fc(x)
+
+
+def create_patched_model(scale_mode, device, use_scaled_mm=False, in_features=256, out_features=384):
+    torch.manual_seed(0)
+    weight = (torch.randn(out_features, in_features) * 0.02 * torch.exp(torch.randn(out_features, 1) * 0.5)).to(torch.bfloat16)
+    bias = (torch.randn(out_features) * 0.01).to(torch.bfloat16)
+    state_dict = {"fc.weight": weight, "fc.bias": bias}
+    state_dict = optimize_state_dict_with_fp8(state_dict, device, ["fc"], None, scale_mode=scale_mode)
+
+    # the model is float32 when patched, as in load_wan_model with fp8_scaled
+    model = LinearModel(in_features, out_features)
+    apply_fp8_monkey_patch(model, state_dict, use_scaled_mm=use_scaled_mm, compute_dtype=torch.bfloat16)
+    model.load_state_dict(state_dict, strict=True, assign=True)
+    model.to(device)
+    return model, state_dict
+
+
+@pytest.mark.parametrize("scale_mode", FP8_SCALE_MODES)
+def test_patched_forward_matches_reference(scale_mode):
+    model, state_dict = create_patched_model(scale_mode, "cpu")
+    x = torch.randn(2, 16, 256, dtype=torch.bfloat16)
+
+    with torch.no_grad():
+        output = model(x).float()
+    reference = fp8_linear_reference(x, state_dict["fc.weight"], state_dict["fc.scale_weight"], state_dict["fc.bias"])
+    assert torch.allclose(output, reference, atol=2e-2 * reference.abs().max().item())
+
+
+def test_dequantized_weight_cache():
+    model, _ = create_patched_model("channel", "cpu")
+    x = torch.randn(2, 16, 256, dtype=torch.bfloat16)
+
+    with torch.no_grad():
+        output = model(x)
+        assert set_fp8_dequantized_weight_cache(model, True) == 1
+        assert torch.equal(model(x), output)
+
+    # the cache is a non-persistent buffer: not saved, and released when disabled
+    assert model.fc.fp8_dequantized_weight is not None
+    assert "fc.fp8_dequantized_weight" not in model.state_dict()
+    set_fp8_dequantized_weight_cache(model, False)
+    assert model.fc.fp8_dequantized_weight is None
+
+
+@pytest.mark.parametrize("scale_mode", ["tensor", "channel"])
+def test_scaled_mm_matches_reference(scale_mode):
+    if not torch.cuda.is_available() or torch.cuda.get_device_capability() < (8, 9):
+        pytest.skip("scaled_mm requires SM 8.9+")
+    if scale_mode == "channel" and not is_rowwise_scaled_mm_supported("cuda", torch.bfloat16):
+        pytest.skip("rowwise scaled_mm requires SM 9.0+")
+
+    model, state_dict = create_patched_model(scale_mode, "cuda", use_scaled_mm=True)
+    x = torch.randn(2, 16, 256, dtype=torch.bfloat16)
+
+    with torch.no_grad():
+        output = model(x.cuda()).cpu().float()
+    reference = fp8_linear_reference(x, state_dict["fc.weight"], state_dict["fc.scale_weight"], state_dict["fc.bias"])
+    # the input is quantized to fp8 in scaled_mm
+    assert (output - reference).norm() / reference.norm() < 5e-2
@@ -0,0 +1,82 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+import torch.nn as nn
+
+from wan.modules.attention import flash_attention
+from wan.modules.model import WanModel, get_context_pad_bias
+
+TEXT_LEN = 32
+CONTEXT_LENS = [5, 9]  # mixed caption lengths in one batch
+
+
+def attention_reference(q, k, v):
+    q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
+    return torch.nn.functional.scaled_dot_product_attention(q, k, v).transpose(1, 2)
+
+
+def create_model(model_type):
+    torch.manual_seed(0)
+    model = WanModel(
+        model_type,
+        text_len=TEXT_LEN,
+        in_dim=8 if model_type == "i2v" else 4,  # I2V concatenates y to x
+        dim=64,
+        ffn_dim=128,
+        freq_dim=32,
+        text_dim=32,
+        out_dim=4,
+        num_heads=4,
+        num_layers=2,
+        attn_mode="torch",
+    )
+    for param in model.parameters():
+        nn.init.normal_(param, std=0.2)  # non-zero biases: the padding tokens are not zero after the embedding
+    model.eval()
+    return model
+
+
+def test_context_pad_bias_matches_padded_attention():
+    torch.manual_seed(0)
+    b, lq, n, d = len(CONTEXT_LENS), 64, 4, 16
+    context_len = max(CONTEXT_LENS) + 1
+    q = torch.randn(b, lq, n, d)
+    k_pad, v_pad = torch.randn(n, d), torch.randn(n, d)
+    k = torch.randn(b, context_len, n, d)
+    v = torch.randn(b, context_len, n, d)
+    for i, length in enumerate(CONTEXT_LENS):
+        k[i, length:] = k_pad
+        v[i, length:] = v_pad
+    k_full = torch.cat([k, k_pad.expand(b, TEXT_LEN - context_len, n, d)], dim=1)
+    v_full = torch.cat([v, v_pad.expand(b, TEXT_LEN - context_len, n, d)], dim=1)
+    expected = attention_reference(q.double(), k_full.double(), v_full.double())
+
+    bias = get_context_pad_bias(CONTEXT_LENS, context_len, TEXT_LEN, q.device)
+    assert bias.shape == (b, 1, 1, context_len)
+    q_t, k_t, v_t = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
+    x = torch.nn.functional.scaled_dot_product_attention(q_t, k_t, v_t, attn_mask=bias).transpose(1, 2)
+    assert torch.allclose(x.double(), expected, atol=1e-5)
+
+    # flash_attention runs in bf16, with and without split_attn
+    for split_attn in [False, True]:
+        x = flash_attention([q, k, v], attn_mode="torch", split_attn=split_attn, attn_bias=bias)
+        assert torch.allclose(x.double(), expected, atol=2e-2 * expected.abs().max().item())
+
+
+@pytest.mark.parametrize("model_type", ["t2v", "i2v"])
+def test_pad_free_context_matches_padded_context(model_type):
+    model = create_model(model_type)
+    x = [torch.randn(4, 2, 8, 8) for _ in CONTEXT_LENS]
+    t = torch.tensor([500.0] * len(CONTEXT_LENS))
+    context = [torch.randn(length, 32) for length in CONTEXT_LENS]
+    kwargs = {}
+    if model_type == "i2v":
+        kwargs = dict(clip_fea=torch.randn(len(CONTEXT_LENS), 257, 1280), y=[torch.randn(4, 2, 8, 8) for _ in CONTEXT_LENS])
+
+    with torch.no_grad():
+        expected = torch.stack(model(x, t, context, seq_len=32, **kwargs))
+        model.enable_pad_free_context()
+        actual = torch.stack(model(x, t, context, seq_len=32, **kwargs))
+
+    # the attention runs in bf16, so the outputs match within the bf16 precision
+    assert torch.allclose(actual, expected, atol=2e-2 * expected.abs().max().item())
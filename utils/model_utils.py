@@ -1,5 +1,6 @@
 import hashlib
 from io import BytesIO
+import os
 from typing import Optional
 
 import safetensors.torch
@@ -149,3 +150,14 @@ def str_to_dtype(s: Optional[str], default_dtype: Optional[torch.dtype] = None)
         return torch.float8_e4m3fn  # default fp8
     else:
         raise ValueError(f"Unsupported dtype: {s}")
+
+
+def get_model_identity(path: Optional[str]) -> Optional[str]:
+    """
+    Returns the identity of the model file for the cache key: the file size and the hash of a part of the file, which is
+    fast even for large models.
+    """
+    if path is None:
+        return None
+    size = os.path.getsize(path) if os.path.isfile(path) else 0
+    return f"{model_hash(path)}-{size}"
@@ -1,14 +1,42 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import mmap
+import os
+import queue
+import shutil
+import threading
+import time
 import torch
 import json
 import struct
 from typing import Dict, Any, Union, Optional
 
+import numpy as np
+
 from safetensors.torch import load_file
 
+import logging
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
 
-def mem_eff_save_file(tensors: Dict[str, torch.Tensor], filename: str, metadata: Dict[str, Any] = None):
+
+def mem_eff_save_file(
+    tensors: Dict[str, torch.Tensor],
+    filename: str,
+    metadata: Dict[str, Any] = None,
+    fsync: bool = False,
+    buffer_size: int = 64 * 1024 * 1024,
+    num_buffers: int = 4,
+):
     """
     memory efficient save file
+
+    The tensors are written by a background thread. CUDA tensors are copied to a ring of num_buffers pinned buffers of
+    buffer_size bytes, so the device-to-host copies overlap with the file writes and the host memory usage is constant.
+    The file is written to a temporary file and renamed at the end, so an interrupted save does not leave a broken file.
+    If fsync is True, the data is flushed to the disk before the rename. On Windows, the file cannot be renamed over a target
+    which is open in another process, and the target is overwritten in place instead (not atomic).
     """
 
     _TYPES = {
@@ -56,25 +84,111 @@ def mem_eff_save_file(tensors: Dict[str, torch.Tensor], filename: str, metadata:
     hjson = json.dumps(header).encode("utf-8")
     hjson += b" " * (-(len(hjson) + 8) % _ALIGN)
 
-    with open(filename, "wb") as f:
-        f.write(struct.pack("<Q", len(hjson)))
-        f.write(hjson)
+    # (bytes to write, event to wait for before writing, pinned buffer to return to the ring), None to stop
+    write_queue: queue.Queue = queue.Queue(maxsize=num_buffers)
+    free_buffers: queue.Queue = queue.Queue()
+    errors = []
 
-        for k, v in tensors.items():
-            if v.numel() == 0:
-                continue
-            if v.is_cuda:
-                # Direct GPU to disk save
-                with torch.cuda.device(v.device):
+    def write_worker(f):
+        while True:
+            entry = write_queue.get()
+            if entry is None:
+                return
+            data, event, buffer = entry
+            try:
+                if not errors:  # skip the remaining writes after an error, but keep returning the buffers
+                    if event is not None:
+                        event.synchronize()
+                    f.write(memoryview(data.numpy()))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                if buffer is not None:
+                    free_buffers.put(buffer)
+
+    tmp_filename = filename + ".tmp"
+    try:
+        with open(tmp_filename, "wb") as f:
+            f.write(struct.pack("<Q", len(hjson)))
+            f.write(hjson)
+
+            writer = threading.Thread(target=write_worker, args=(f,), daemon=True)
+            writer.start()
+            num_allocated_buffers = 0
+            try:
+                for k, v in tensors.items():
+                    if v.numel() == 0:
+                        continue
                     if v.dim() == 0:  # if scalar, need to add a dimension to work with view
                         v = v.unsqueeze(0)
-                    tensor_bytes = v.contiguous().view(torch.uint8)
-                    tensor_bytes.cpu().numpy().tofile(f)
-            else:
-                # CPU tensor save
-                if v.dim() == 0:  # if scalar, need to add a dimension to work with view
-                    v = v.unsqueeze(0)
-                v.contiguous().view(torch.uint8).numpy().tofile(f)
+                    tensor_bytes = v.detach().contiguous().view(torch.uint8).view(-1)
+
+                    if tensor_bytes.is_cuda:
+                        # copy to the pinned buffers in chunks, the writer waits for the copy of each chunk
+                        with torch.cuda.device(tensor_bytes.device):
+                            for chunk_start in range(0, tensor_bytes.numel(), buffer_size):
+                                if num_allocated_buffers < num_buffers:
+                                    buffer = torch.empty(buffer_size, dtype=torch.uint8, pin_memory=True)
+                                    num_allocated_buffers += 1
+                                else:
+                                    buffer = free_buffers.get()
+
+                                chunk = tensor_bytes[chunk_start : chunk_start + buffer_size]
+                                staged = buffer[: chunk.numel()]
+                                staged.copy_(chunk, non_blocking=True)
+                                event = torch.cuda.Event()
+                                event.record()
+                                write_queue.put((staged, event, buffer))
+                    else:
+                        if tensor_bytes.device.type != "cpu":
+                            tensor_bytes = tensor_bytes.cpu()
+                        write_queue.put((tensor_bytes, None, None))
+
+                    if errors:
+                        break
+            finally:
+                write_queue.put(None)
+                writer.join()
+
+            if errors:
+                raise errors[0]
+
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+
+        try:
+            os.replace(tmp_filename, filename)
+        except PermissionError:
+            if os.name != "nt":
+                raise
+            # the target is open (e.g. by a viewer or another training process). this fails too if the target is mapped
+            logger.warning(f"cannot replace {filename}, it may be open in another process. overwrite it in place")
+            shutil.copyfile(tmp_filename, filename)
+            os.remove(tmp_filename)
+    except BaseException:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+_async_save_executor: Optional[ThreadPoolExecutor] = None
+
+
+def mem_eff_save_file_async(
+    tensors: Dict[str, torch.Tensor], filename: str, metadata: Dict[str, Any] = None, fsync: bool = False
+) -> Future:
+    """
+    Save the tensors in the background and return the Future. The tensors are copied to CPU memory first, so they can be
+    modified (e.g. by the next training step) after this function returns. The host memory for the copy is needed, so this
+    is for small state dicts such as LoRA weights. The files are saved in the order of the calls.
+    """
+    global _async_save_executor
+    if _async_save_executor is None:
+        _async_save_executor = ThreadPoolExecutor(max_workers=1)
+
+    snapshot = {key: value.detach().to("cpu", copy=True) for key, value in tensors.items()}
+    return _async_save_executor.submit(mem_eff_save_file, snapshot, filename, metadata, fsync)
 
 
 class MemoryEfficientSafeOpen:
@@ -83,12 +197,19 @@ class MemoryEfficientSafeOpen:
         self.filename = filename
         self.file = open(filename, "rb")
         self.header, self.header_size = self._read_header()
+        self.mmap: Optional[mmap.mmap] = None  # for get_tensor_view
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.file.close()
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                pass  # some views are still alive, the mapping is closed when they are released
+            self.mmap = None
 
     def keys(self):
         return [k for k in self.header.keys() if k != "__metadata__"]
@@ -96,37 +217,61 @@ class MemoryEfficientSafeOpen:
     def metadata(self) -> Dict[str, str]:
         return self.header.get("__metadata__", {})
 
-    def get_tensor(self, key):
+    def get_tensor(self, key, pin_memory: bool = False):
+        """
+        Read the tensor into a newly allocated tensor (pinned if pin_memory is True) without an intermediate buffer.
+        """
         if key not in self.header:
             raise KeyError(f"Tensor '{key}' not found in the file")
 
         metadata = self.header[key]
         offset_start, offset_end = metadata["data_offsets"]
 
-        if offset_start == offset_end:
-            tensor_bytes = None
-        else:
+        byte_tensor = torch.empty(offset_end - offset_start, dtype=torch.uint8, pin_memory=pin_memory)
+        if offset_start != offset_end:
             # adjust offset by header size
             self.file.seek(self.header_size + 8 + offset_start)
-            tensor_bytes = self.file.read(offset_end - offset_start)
+            view = memoryview(byte_tensor.numpy())
+            pos = 0
+            while pos < len(view):
+                n = self.file.readinto(view[pos:])
+                if n == 0:
+                    raise EOFError(f"unexpected end of file: {self.filename}")
+                pos += n
 
-        return self._deserialize_tensor(tensor_bytes, metadata)
+        return self._deserialize_tensor(byte_tensor, metadata)
+
+    def get_tensor_view(self, key):
+        """
+        Returns the tensor backed by the memory-mapped file without reading it. The mapping is copy-on-write, so the tensor
+        can be modified without changing the file. Use this when the tensor is converted or moved to another device anyway.
+        """
+        if key not in self.header:
+            raise KeyError(f"Tensor '{key}' not found in the file")
+
+        metadata = self.header[key]
+        offset_start, offset_end = metadata["data_offsets"]
+
+        if offset_start == offset_end:
+            byte_tensor = torch.empty(0, dtype=torch.uint8)
+        else:
+            if self.mmap is None:
+                self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_COPY)
+            byte_tensor = torch.frombuffer(
+                self.mmap, dtype=torch.uint8, count=offset_end - offset_start, offset=self.header_size + 8 + offset_start
+            )
+
+        return self._deserialize_tensor(byte_tensor, metadata)
 
     def _read_header(self):
         header_size = struct.unpack("<Q", self.file.read(8))[0]
         header_json = self.file.read(header_size).decode("utf-8")
         return json.loads(header_json), header_size
 
-    def _deserialize_tensor(self, tensor_bytes, metadata):
+    def _deserialize_tensor(self, byte_tensor: torch.Tensor, metadata):
         dtype = self._get_torch_dtype(metadata["dtype"])
         shape = metadata["shape"]
 
-        if tensor_bytes is None:
-            byte_tensor = torch.empty(0, dtype=torch.uint8)
-        else:
-            tensor_bytes = bytearray(tensor_bytes)  # make it writable
-            byte_tensor = torch.frombuffer(tensor_bytes, dtype=torch.uint8)
-
         # process float8 types
         if metadata["dtype"] in ["F8_E5M2", "F8_E4M3"]:
             return self._convert_float8(byte_tensor, metadata["dtype"], shape)
@@ -168,18 +313,245 @@ class MemoryEfficientSafeOpen:
             raise ValueError(f"Unsupported float8 type: {dtype_str} (upgrade PyTorch to support float8 types)")
 
 
+class MemoryMappedSafeTensorsCache:
+    """
+    Keeps safetensors files memory-mapped and caches their parsed headers, to read many small files repeatedly without
+    opening the file and parsing the header every time. A safetensors blob at an offset in a larger file (such as a shard
+    of the packed cache) is also supported.
+
+    The tensor data is copied directly from the mapped file into the given tensor, so no intermediate buffer is created.
+    """
+
+    def __init__(self, max_open_files: int = 256):
+        self.max_open_files = max_open_files
+        self.buffers: OrderedDict[str, mmap.mmap] = OrderedDict()  # LRU
+        # (path, offset) -> ({key: (dtype, shape, start, end)}, absolute offset of the data). metadata is not cached
+        self.headers: dict[tuple[str, int], tuple[dict[str, tuple[torch.dtype, tuple[int, ...], int, int]], int]] = {}
+
+    def __getstate__(self):
+        # mmap objects cannot be pickled, reopen them in the new process
+        state = self.__dict__.copy()
+        state["buffers"] = OrderedDict()
+        return state
+
+    def get_buffer(self, path: str) -> mmap.mmap:
+        buffer = self.buffers.get(path)
+        if buffer is not None:
+            self.buffers.move_to_end(path)
+            return buffer
+
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffers[path] = buffer
+        if len(self.buffers) > self.max_open_files:
+            _, oldest_buffer = self.buffers.popitem(last=False)
+            oldest_buffer.close()
+        return buffer
+
+    def get_header(self, path: str, offset: int = 0) -> tuple[dict[str, tuple[torch.dtype, tuple[int, ...], int, int]], int]:
+        header_key = (path, offset)
+        cached = self.headers.get(header_key)
+        if cached is not None:
+            return cached
+
+        buffer = self.get_buffer(path)
+        header_size = struct.unpack_from("<Q", buffer, offset)[0]
+        header_json = json.loads(buffer[offset + 8 : offset + 8 + header_size].decode("utf-8"))
+
+        header = {}
+        for key, value in header_json.items():
+            if key == "__metadata__":
+                continue
+            dtype = MemoryEfficientSafeOpen._get_torch_dtype(value["dtype"])
+            if dtype is None:
+                raise ValueError(f"Unsupported dtype: {value['dtype']} in {path}")
+            start, end = value["data_offsets"]
+            header[key] = (dtype, tuple(value["shape"]), start, end)
+
+        cached = (header, offset + 8 + header_size)
+        self.headers[header_key] = cached
+        return cached
+
+    def copy_tensor_to(self, path: str, key: str, out: torch.Tensor, offset: int = 0):
+        """
+        Copy the tensor in the file to `out`. `out` must be a contiguous CPU tensor with the same number of bytes.
+        """
+        header, data_start = self.get_header(path, offset)
+        _, _, start, end = header[key]
+        if start == end:
+            return
+
+        assert out.is_contiguous() and out.numel() * out.element_size() == end - start, f"size mismatch: {key} in {path}"
+        src = np.frombuffer(self.get_buffer(path), dtype=np.uint8, count=end - start, offset=data_start + start)
+        dst = out.view(-1).view(torch.uint8).numpy()
+        dst[:] = src
+
+    def get_tensor(self, path: str, key: str, offset: int = 0, pin_memory: bool = False) -> torch.Tensor:
+        header, _ = self.get_header(path, offset)
+        dtype, shape, _, _ = header[key]
+        tensor = torch.empty(shape, dtype=dtype, pin_memory=pin_memory)
+        self.copy_tensor_to(path, key, tensor, offset)
+        return tensor
+
+
+def _read_range_into(path: str, fd: Optional[int], out: torch.Tensor, offset: int):
+    """
+    Read the bytes at offset of the file into `out` (contiguous uint8 CPU tensor) without an intermediate buffer.
+    """
+    view = memoryview(out.numpy())
+    pos = 0
+    if fd is not None:
+        while pos < len(view):
+            n = os.preadv(fd, [view[pos:]], offset + pos)
+            if n == 0:
+                raise EOFError(f"unexpected end of file: {path}")
+            pos += n
+    else:
+        # no preadv (Windows): open the file for each range, file objects are not shared between threads
+        with open(path, "rb") as f:
+            f.seek(offset)
+            while pos < len(view):
+                n = f.readinto(view[pos:])
+                if n == 0:
+                    raise EOFError(f"unexpected end of file: {path}")
+                pos += n
+
+
+def load_safetensors_parallel(
+    path: str,
+    device: Union[str, torch.device],
+    dtype: Optional[torch.dtype] = None,
+    num_threads: int = 8,
+    chunk_size: int = 16 * 1024 * 1024,
+    max_in_flight_bytes: int = 1024 * 1024 * 1024,
+) -> dict[str, torch.Tensor]:
+    """
+    Load a safetensors file with multiple threads. The tensors are split into chunks of chunk_size bytes, and the chunks
+    are read concurrently with pread into preallocated tensors, which are pinned if the device is CUDA. The conversion to
+    dtype and the upload to the device run in this thread while the later chunks are being read.
+
+    max_in_flight_bytes limits the bytes which are read but not moved to the device yet, so the host memory usage is
+    bounded when loading to CUDA. When loading to CPU, the tensors are read directly into the returned tensors (if dtype is
+    not changed).
+    """
+    device = torch.device(device)
+    to_cuda = device.type == "cuda"
+
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size).decode("utf-8"))
+    header.pop("__metadata__", None)
+    data_start = 8 + header_size
+
+    fd = None
+    if hasattr(os, "preadv"):
+        fd = os.open(path, os.O_RDONLY)
+        if hasattr(os, "posix_fadvise"):
+            # chunks are read roughly in the file order: let the kernel read ahead aggressively
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    keys = sorted(header.keys(), key=lambda k: header[k]["data_offsets"][0])  # file order
+    state_dict = {}
+    pending_uploads: list[tuple[torch.cuda.Event, torch.Tensor]] = []  # pinned buffers in use by async copies
+
+    def release_uploaded(wait: bool) -> int:
+        nonlocal pending_uploads
+        released = 0
+        remaining = []
+        for event, buffer in pending_uploads:
+            if wait:
+                event.synchronize()
+            if wait or event.query():
+                released += buffer.numel()
+            else:
+                remaining.append((event, buffer))
+        pending_uploads = remaining
+        return released
+
+    executor = ThreadPoolExecutor(max_workers=num_threads)
+    try:
+        # submit the reads of the tensors in the file order, and finish the tensors in the same order
+        submitted: list[tuple[str, torch.Tensor, list[Future]]] = []
+        in_flight_bytes = 0
+        next_index = 0
+
+        def submit_next():
+            nonlocal next_index, in_flight_bytes
+            key = keys[next_index]
+            next_index += 1
+            start, end = header[key]["data_offsets"]
+            buffer = torch.empty(end - start, dtype=torch.uint8, pin_memory=to_cuda)
+            futures = []
+            for chunk_start in range(0, end - start, chunk_size):
+                chunk = buffer[chunk_start : chunk_start + chunk_size]
+                futures.append(executor.submit(_read_range_into, path, fd, chunk, data_start + start + chunk_start))
+            submitted.append((key, buffer, futures))
+            in_flight_bytes += end - start
+
+        for index in range(len(keys)):
+            # keep the readers busy: submit until the limit, at least one tensor is always submitted
+            while next_index < len(keys) and (next_index <= index or in_flight_bytes < max_in_flight_bytes):
+                submit_next()
+
+            key, buffer, futures = submitted[index]
+            submitted[index] = None  # release the reference
+            for future in futures:
+                future.result()
+
+            metadata = header[key]
+            tensor_dtype = MemoryEfficientSafeOpen._get_torch_dtype(metadata["dtype"])
+            if tensor_dtype is None:
+                raise ValueError(f"Unsupported dtype: {metadata['dtype']} in {path}")
+            tensor = buffer.view(tensor_dtype).reshape(metadata["shape"])
+
+            if to_cuda:
+                tensor = tensor.to(device, dtype=dtype, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record()
+                pending_uploads.append((event, buffer))
+                in_flight_bytes -= release_uploaded(wait=False)
+            else:
+                tensor = tensor.to(device, dtype=dtype)
+                in_flight_bytes -= buffer.numel()
+
+            state_dict[key] = tensor
+
+        release_uploaded(wait=True)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if fd is not None:
+            os.close(fd)
+
+    return state_dict
+
+
+def load_safetensors_mmap(path: str, dtype: Optional[torch.dtype] = None) -> dict[str, torch.Tensor]:
+    """
+    Load the tensors as views of the memory-mapped file on CPU. Nothing is read at loading: the data is read from the disk
+    (or the page cache) when the tensor is accessed, and the pages can be reclaimed by the OS, so the resident memory does
+    not grow with the file size. The tensors with a different dtype are converted, and they are read into the memory.
+    """
+    state_dict = {}
+    num_converted = 0
+    with MemoryEfficientSafeOpen(path) as f:
+        for key in f.keys():
+            tensor = f.get_tensor_view(key)
+            if dtype is not None and tensor.dtype != dtype:
+                tensor = tensor.to(dtype=dtype)
+                num_converted += 1
+            state_dict[key] = tensor
+    if num_converted > 0:
+        logger.warning(f"{num_converted} tensors are converted to {dtype} and not memory-mapped: {path}")
+    return state_dict
+
+
 def load_safetensors(
     path: str, device: Union[str, torch.device], disable_mmap: bool = False, dtype: Optional[torch.dtype] = torch.float32
 ) -> dict[str, torch.Tensor]:
     if disable_mmap:
         # return safetensors.torch.load(open(path, "rb").read())
-        # use experimental loader
-        # logger.info(f"Loading without mmap (experimental)")
-        state_dict = {}
-        with MemoryEfficientSafeOpen(path) as f:
-            for key in f.keys():
-                state_dict[key] = f.get_tensor(key).to(device, dtype=dtype)
-        return state_dict
+        # read with multiple threads without mmap, the tensors are not backed by the file
+        return load_safetensors_parallel(path, device, dtype)
     else:
         try:
             state_dict = load_file(path, device=device)
@@ -189,3 +561,49 @@ def load_safetensors(
             for key in state_dict.keys():
                 state_dict[key] = state_dict[key].to(dtype=dtype)
         return state_dict
+
+
+if __name__ == "__main__":
+    # benchmark of the loaders: python -m utils.safetensors_utils path/to/model.safetensors --device cuda
+    # the page cache is not dropped, run it once to warm up the cache, or drop it manually to measure the disk bandwidth
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=str, help="safetensors file to load")
+    parser.add_argument("--device", type=str, default="cpu", help="device to load the tensors to")
+    parser.add_argument("--num_threads", type=int, nargs="*", default=[1, 4, 8, 16], help="numbers of threads to benchmark")
+    args = parser.parse_args()
+
+    file_size = os.path.getsize(args.path)
+
+    def benchmark(name: str, fn):
+        start_time = time.perf_counter()
+        state_dict = fn()
+        if torch.device(args.device).type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start_time
+        logger.info(f"{name}: {elapsed:.2f}s, {file_size / elapsed / 1024**3:.2f} GB/s")
+        return state_dict
+
+    reference = benchmark("safetensors.load_file", lambda: load_file(args.path, device=args.device))
+
+    def load_serial():
+        with MemoryEfficientSafeOpen(args.path) as f:
+            return {key: f.get_tensor(key).to(args.device) for key in f.keys()}
+
+    benchmark("MemoryEfficientSafeOpen (serial)", load_serial)
+
+    def load_view():
+        with MemoryEfficientSafeOpen(args.path) as f:
+            return {key: f.get_tensor_view(key).to(args.device, copy=True) for key in f.keys()}
+
+    benchmark("MemoryEfficientSafeOpen (mmap view)", load_view)
+
+    for num_threads in args.num_threads:
+        state_dict = benchmark(
+            f"load_safetensors_parallel ({num_threads} threads)",
+            lambda: load_safetensors_parallel(args.path, args.device, num_threads=num_threads),
+        )
+        for key, tensor in reference.items():
+            assert torch.equal(state_dict[key].reshape(-1).view(torch.uint8), tensor.reshape(-1).view(torch.uint8)), key
+        del state_dict
@@ -53,6 +53,7 @@ def flash_attention(
     version=None,
     attn_mode: Optional[str] = "torch",
     split_attn: bool = False,
+    attn_bias: Optional[torch.Tensor] = None,
 ):
     """
     q:              [B, Lq, Nq, C1].
@@ -66,6 +67,7 @@ def flash_attention(
     window_size:    (left right). If not (-1, -1), apply sliding window local attention.
     deterministic:  bool. If True, slightly slower and uses more memory.
     dtype:          torch.dtype. Apply when dtype of q/k/v is not float16/bfloat16.
+    attn_bias:      [B, 1 or Nq, 1 or Lq, Lk]. Added to the scores (after scaling), in the dtype of q. SDPA only.
     """
     q, k, v = qkv
     qkv.clear()
@@ -87,6 +89,7 @@ def flash_attention(
         assert k_lens is None or (
             min(k_lens) == max(k_lens) and k_lens[0] == lk
         ), "k_lens is not supported except for flash attention 3."
+    assert attn_bias is None or attn_mode in ["torch", "sdpa"], "attn_bias is supported only with SDPA."
 
     # SDPA
     if attn_mode == "torch" or attn_mode == "sdpa":
@@ -96,17 +99,25 @@ def flash_attention(
         q = half(q.transpose(1, 2))
         k = half(k.transpose(1, 2))
         v = half(v.transpose(1, 2))
+        if attn_bias is not None:
+            attn_bias = attn_bias.to(q.dtype)  # SDPA requires the same dtype as the query
 
         if not split_attn:
             q = torch.nn.functional.scaled_dot_product_attention(
-                q, k, v, is_causal=causal, dropout_p=dropout_p, scale=softmax_scale
+                q, k, v, attn_mask=attn_bias, is_causal=causal, dropout_p=dropout_p, scale=softmax_scale
             )
             x = q
         else:
             x = torch.empty_like(q)
             for i in range(q.size(0)):
                 x[i : i + 1] = torch.nn.functional.scaled_dot_product_attention(
-                    q[i : i + 1], k[i : i + 1], v[i : i + 1], is_causal=causal, dropout_p=dropout_p, scale=softmax_scale
+                    q[i : i + 1],
+                    k[i : i + 1],
+                    v[i : i + 1],
+                    attn_mask=attn_bias[i : i + 1] if attn_bias is not None else None,
+                    is_causal=causal,
+                    dropout_p=dropout_p,
+                    scale=softmax_scale,
                 )
 
         del q, k, v
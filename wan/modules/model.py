@@ -9,20 +9,34 @@ from accelerate import init_empty_weights
 
 import logging
 
-from utils.safetensors_utils import MemoryEfficientSafeOpen, load_safetensors
+from utils.safetensors_utils import MemoryEfficientSafeOpen, load_safetensors, load_safetensors_mmap
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 from utils.device_utils import clean_memory_on_device
+from utils.model_utils import str_to_dtype
 
 from .attention import flash_attention
 from utils.device_utils import clean_memory_on_device
-from modules.custom_offloading_utils import ModelOffloader
-from modules.fp8_optimization_utils import apply_fp8_monkey_patch, optimize_state_dict_with_fp8
+from modules.custom_offloading_utils import ModelOffloader, OffloaderStats
+from modules.fp8_optimization_utils import apply_fp8_monkey_patch, optimize_state_dict_with_fp8, set_fp8_dequantized_weight_cache
 
 __all__ = ["WanModel"]
 
+# keys of the Linear weights to optimize with scaled fp8: `--fp8_scaled` and the pre-quantized checkpoints
+FP8_OPTIMIZATION_TARGET_KEYS = ["blocks"]
+FP8_OPTIMIZATION_EXCLUDE_KEYS = [
+    "norm",
+    "patch_embedding",
+    "text_embedding",
+    "time_embedding",
+    "time_projection",
+    "head",
+    "modulation",
+    "img_emb",
+]
+
 
 def sinusoidal_embedding_1d(dim, position):
     # preprocess
@@ -234,14 +248,38 @@ class WanSelfAttention(nn.Module):
         return x
 
 
+def get_context_pad_bias(context_lens: list[int], context_len: int, text_len: int, device: torch.device) -> torch.Tensor:
+    r"""
+    Attention bias for the context padded to context_len instead of text_len. All padding tokens have the same key and
+    value (the embedding of zeros), so the attention over n padding tokens is the attention over m of them with log(n / m)
+    added to their scores. The bias is added by the attention kernel, so no other computation is needed. The kernel adds
+    it in the dtype of the query: in bfloat16, the weight of the padding tokens differs by up to about log(n / m) * 2^-8
+    (relative) from the padded context.
+
+    Args:
+        context_lens(list[int]): lengths of the contexts, less than context_len
+        context_len(int): length of the padded context
+        text_len(int): length of the context without pad-free context
+
+    Returns:
+        Tensor: Shape [B, 1, 1, context_len], float32
+    """
+    lens = torch.tensor(context_lens, dtype=torch.float32, device=device).unsqueeze(1)  # B, 1
+    bias = torch.log((text_len - lens) / (context_len - lens))
+    positions = torch.arange(context_len, device=device).unsqueeze(0)  # 1, L
+    bias = torch.where(positions >= lens, bias, torch.zeros_like(bias))  # B, L
+    return bias[:, None, None, :]
+
+
 class WanT2VCrossAttention(WanSelfAttention):
 
-    def forward(self, x, context, context_lens):
+    def forward(self, x, context, context_lens, context_pad_bias=None):
         r"""
         Args:
             x(Tensor): Shape [B, L1, C]
             context(Tensor): Shape [B, L2, C]
             context_lens(Tensor): Shape [B]
+            context_pad_bias(Tensor): Shape [B, 1, 1, L2], see get_context_pad_bias
         """
         b, n, d = x.size(0), self.num_heads, self.head_dim
 
@@ -263,7 +301,9 @@ class WanT2VCrossAttention(WanSelfAttention):
         # compute attention
         qkv = [q, k, v]
         del q, k, v
-        x = flash_attention(qkv, k_lens=context_lens, attn_mode=self.attn_mode, split_attn=self.split_attn)
+        x = flash_attention(
+            qkv, k_lens=context_lens, attn_mode=self.attn_mode, split_attn=self.split_attn, attn_bias=context_pad_bias
+        )
 
         # output
         x = x.flatten(2)
@@ -281,12 +321,13 @@ class WanI2VCrossAttention(WanSelfAttention):
         # self.alpha = nn.Parameter(torch.zeros((1, )))
         self.norm_k_img = WanRMSNorm(dim, eps=eps) if qk_norm else nn.Identity()
 
-    def forward(self, x, context, context_lens):
+    def forward(self, x, context, context_lens, context_pad_bias=None):
         r"""
         Args:
             x(Tensor): Shape [B, L1, C]
             context(Tensor): Shape [B, L2, C]
             context_lens(Tensor): Shape [B]
+            context_pad_bias(Tensor): Shape [B, 1, 1, L2], see get_context_pad_bias
         """
         context_img = context[:, :257]
         context = context[:, 257:]
@@ -305,7 +346,9 @@ class WanI2VCrossAttention(WanSelfAttention):
         # compute attention
         qkv = [q, k, v]
         del k, v
-        x = flash_attention(qkv, k_lens=context_lens, attn_mode=self.attn_mode, split_attn=self.split_attn)
+        x = flash_attention(
+            qkv, k_lens=context_lens, attn_mode=self.attn_mode, split_attn=self.split_attn, attn_bias=context_pad_bias
+        )
 
         # compute query, key, value
         k_img = self.norm_k_img(self.k_img(context_img)).view(b, -1, n, d)
@@ -379,7 +422,7 @@ class WanAttentionBlock(nn.Module):
     def disable_gradient_checkpointing(self):
         self.gradient_checkpointing = False
 
-    def _forward(self, x, e, seq_lens, grid_sizes, freqs, context, context_lens):
+    def _forward(self, x, e, seq_lens, grid_sizes, freqs, context, context_lens, context_pad_bias=None):
         r"""
         Args:
             x(Tensor): Shape [B, L, C]
@@ -414,17 +457,19 @@ class WanAttentionBlock(nn.Module):
         # x = cross_attn_ffn(x, context, context_lens, e)
 
         # x += self.cross_attn(self.norm3(x), context, context_lens) # backward error
-        x = x + self.cross_attn(self.norm3(x), context, context_lens)
+        x = x + self.cross_attn(self.norm3(x), context, context_lens, context_pad_bias)
         del context
         y = self.ffn(self.norm2(x).float() * (1 + e[4]) + e[3])
         x = x + y.to(torch.float32) * e[5]
         del y
         return x
 
-    def forward(self, x, e, seq_lens, grid_sizes, freqs, context, context_lens):
+    def forward(self, x, e, seq_lens, grid_sizes, freqs, context, context_lens, context_pad_bias=None):
         if self.training and self.gradient_checkpointing:
-            return checkpoint(self._forward, x, e, seq_lens, grid_sizes, freqs, context, context_lens, use_reentrant=False)
-        return self._forward(x, e, seq_lens, grid_sizes, freqs, context, context_lens)
+            return checkpoint(
+                self._forward, x, e, seq_lens, grid_sizes, freqs, context, context_lens, context_pad_bias, use_reentrant=False
+            )
+        return self._forward(x, e, seq_lens, grid_sizes, freqs, context, context_lens, context_pad_bias)
 
 
 class Head(nn.Module):
@@ -605,6 +650,8 @@ class WanModel(nn.Module):  # ModelMixin, ConfigMixin):
         # offloading
         self.blocks_to_swap = None
         self.offloader = None
+        self.weights_mmapped = False  # weights are backed by the memory-mapped checkpoint, set by load_wan_model
+        self.pad_free_context = False
 
     @property
     def dtype(self):
@@ -615,7 +662,13 @@ class WanModel(nn.Module):  # ModelMixin, ConfigMixin):
         return next(self.parameters()).device
 
     def fp8_optimization(
-        self, state_dict: dict[str, torch.Tensor], device: torch.device, move_to_device: bool, use_scaled_mm: bool = False
+        self,
+        state_dict: dict[str, torch.Tensor],
+        device: torch.device,
+        move_to_device: bool,
+        use_scaled_mm: bool = False,
+        scale_mode: str = "tensor",
+        compute_dtype: Optional[torch.dtype] = None,
     ) -> int:
         """
         Optimize the model state_dict with fp8.
@@ -627,27 +680,50 @@ class WanModel(nn.Module):  # ModelMixin, ConfigMixin):
                 The device to calculate the weight.
             move_to_device (bool):
                 Whether to move the weight to the device after optimization.
+            scale_mode (str):
+                "tensor", "channel" or "block". The granularity of the scales of the weights.
+            compute_dtype (torch.dtype):
+                The dtype of the inputs of the Linear layers, to check that scaled_mm supports it.
         """
-        TARGET_KEYS = ["blocks"]
-        EXCLUDE_KEYS = [
-            "norm",
-            "patch_embedding",
-            "text_embedding",
-            "time_embedding",
-            "time_projection",
-            "head",
-            "modulation",
-            "img_emb",
-        ]
-
         # inplace optimization
-        state_dict = optimize_state_dict_with_fp8(state_dict, device, TARGET_KEYS, EXCLUDE_KEYS, move_to_device=move_to_device)
+        state_dict = optimize_state_dict_with_fp8(
+            state_dict,
+            device,
+            FP8_OPTIMIZATION_TARGET_KEYS,
+            FP8_OPTIMIZATION_EXCLUDE_KEYS,
+            move_to_device=move_to_device,
+            scale_mode=scale_mode,
+        )
 
         # apply monkey patching
-        apply_fp8_monkey_patch(self, state_dict, use_scaled_mm=use_scaled_mm)
+        apply_fp8_monkey_patch(self, state_dict, use_scaled_mm=use_scaled_mm, compute_dtype=compute_dtype)
 
         return state_dict
 
+    def enable_fp8_dequantized_weight_cache(self):
+        """
+        Cache the dequantized weights of the scaled fp8 Linear layers. Call this after enable_block_swap. Nothing is
+        cached with block swap, because all blocks are moved between the devices in turn, even in forward only offloading.
+        """
+        if self.blocks_to_swap:
+            print(f"WanModel: Dequantized fp8 weight cache is not available with block swap.")
+            return
+
+        num_layers = set_fp8_dequantized_weight_cache(self.blocks, True)
+        print(f"WanModel: Dequantized fp8 weight cache enabled for {num_layers} Linear layers.")
+
+    def enable_pad_free_context(self):
+        """
+        Do not pad the text context to text_len: pad it to the longest one in the batch + 1 padding token, and add the
+        weights of the removed padding tokens by the attention bias in the cross attention. The result is the same as the
+        padded context within the precision of the attention. SDPA only, because the other kernels do not take a bias.
+        """
+        if self.attn_mode not in ["torch", "sdpa"]:
+            print(f"WanModel: Pad-free cross attention requires SDPA, not {self.attn_mode}. Disabled.")
+            return
+        self.pad_free_context = True
+        print(f"WanModel: Pad-free cross attention enabled.")
+
     def enable_gradient_checkpointing(self):
         self.gradient_checkpointing = True
 
@@ -664,21 +740,49 @@ class WanModel(nn.Module):  # ModelMixin, ConfigMixin):
 
         print(f"WanModel: Gradient checkpointing disabled.")
 
-    def enable_block_swap(self, blocks_to_swap: int, device: torch.device, supports_backward: bool):
+    def enable_block_swap(
+        self,
+        blocks_to_swap: int,
+        device: torch.device,
+        supports_backward: bool,
+        prefetch_depth: int = 0,
+        fp8_host_weights: bool = False,
+    ):
         self.blocks_to_swap = blocks_to_swap
         self.num_blocks = len(self.blocks)
 
+        # with backward, the second last block must be swapped in before the backward of the last block
+        max_blocks_to_swap = self.num_blocks - (2 if supports_backward else 1)
         assert (
-            self.blocks_to_swap <= self.num_blocks - 1
-        ), f"Cannot swap more than {self.num_blocks - 1} blocks. Requested {self.blocks_to_swap} blocks to swap."
+            self.blocks_to_swap <= max_blocks_to_swap
+        ), f"Cannot swap more than {max_blocks_to_swap} blocks. Requested {self.blocks_to_swap} blocks to swap."
 
+        # the weights of the swapped blocks are not copied back to CPU, but the memory-mapped weights are used again
         self.offloader = ModelOffloader(
-            "wan_attn_block", self.blocks, self.num_blocks, self.blocks_to_swap, supports_backward, device  # , debug=True
+            "wan_attn_block",
+            self.blocks,
+            self.num_blocks,
+            self.blocks_to_swap,
+            supports_backward,
+            device,
+            use_host_weights=self.weights_mmapped,
+            prefetch_depth=prefetch_depth,
+            fp8_host_weights=fp8_host_weights,  # , debug=True
         )
         print(
             f"WanModel: Block swap enabled. Swapping {self.blocks_to_swap} blocks out of {self.num_blocks} blocks. Supports backward: {supports_backward}"
+            + (", weights are read from the memory-mapped checkpoint" if self.weights_mmapped else "")
         )
 
+    def enable_block_swap_stats(self):
+        if self.blocks_to_swap:
+            self.offloader.enable_stats()
+
+    def get_block_swap_stats(self) -> list[OffloaderStats]:
+        if not self.blocks_to_swap or self.offloader.stats is None:
+            return []
+        return [self.offloader.stats]
+
     def switch_block_swap_for_inference(self):
         if self.blocks_to_swap:
             self.offloader.set_forward_only(True)
@@ -766,8 +870,15 @@ class WanModel(nn.Module):  # ModelMixin, ConfigMixin):
 
         # context
         context_lens = None
+        context_pad_bias = None
         if type(context) is list:
-            context = torch.stack([torch.cat([u, u.new_zeros(self.text_len - u.size(0), u.size(1))]) for u in context])
+            context_len = self.text_len
+            if self.pad_free_context:
+                # pad to the longest context + 1 padding token, the other padding tokens are added by the attention bias
+                context_len = min(max(u.size(0) for u in context) + 1, self.text_len)
+                if context_len < self.text_len:
+                    context_pad_bias = get_context_pad_bias([u.size(0) for u in context], context_len, self.text_len, device)
+            context = torch.stack([torch.cat([u, u.new_zeros(context_len - u.size(0), u.size(1))]) for u in context])
         context = self.text_embedding(context)
 
         if clip_fea is not None:
@@ -777,7 +888,15 @@ class WanModel(nn.Module):  # ModelMixin, ConfigMixin):
             context_clip = None
 
         # arguments
-        kwargs = dict(e=e0, seq_lens=seq_lens, grid_sizes=grid_sizes, freqs=freqs_list, context=context, context_lens=context_lens)
+        kwargs = dict(
+            e=e0,
+            seq_lens=seq_lens,
+            grid_sizes=grid_sizes,
+            freqs=freqs_list,
+            context=context,
+            context_lens=context_lens,
+            context_pad_bias=context_pad_bias,
+        )
 
         if self.blocks_to_swap:
             clean_memory_on_device(device)
@@ -849,16 +968,31 @@ class WanModel(nn.Module):  # ModelMixin, ConfigMixin):
         nn.init.zeros_(self.head.head.weight)
 
 
+def is_fp8_scaled_checkpoint(path: str) -> bool:
+    """
+    Returns True if the checkpoint is pre-quantized with scaled fp8 by wan_export_fp8_scaled.py.
+    """
+    with MemoryEfficientSafeOpen(path) as f:
+        return f.metadata().get("fp8_scaled") == "true"
+
+
 def detect_wan_sd_dtype(path: str) -> torch.dtype:
     # get dtype from model weights
     with MemoryEfficientSafeOpen(path) as f:
+        source_dtype = f.metadata().get("fp8_source_dtype")
+        if f.metadata().get("fp8_scaled") == "true" and source_dtype is not None:
+            # pre-quantized checkpoint: behaves as the original weights with --fp8_scaled
+            dit_dtype = str_to_dtype(source_dtype)
+            logger.info(f"Detected DiT dtype: {dit_dtype} (pre-quantized with scaled fp8)")
+            return dit_dtype
+
         keys = set(f.keys())
         key1 = "model.diffusion_model.blocks.0.cross_attn.k.weight"  # 1.3B
         key2 = "blocks.0.cross_attn.k.weight"  # 14B
         if key1 in keys:
-            dit_dtype = f.get_tensor(key1).dtype
+            dit_dtype = f.get_tensor_view(key1).dtype  # no need to read the tensor
         elif key2 in keys:
-            dit_dtype = f.get_tensor(key2).dtype
+            dit_dtype = f.get_tensor_view(key2).dtype
         else:
             raise ValueError(f"Could not find the dtype in the model weights: {path}")
     logger.info(f"Detected DiT dtype: {dit_dtype}")
@@ -875,13 +1009,44 @@ def load_wan_model(
     loading_device: Union[str, torch.device],
     dit_weight_dtype: Optional[torch.dtype],
     fp8_scaled: bool = False,
+    use_scaled_mm: bool = False,
+    fp8_scale_mode: str = "tensor",
+    lazy_loading: bool = False,
+    compute_dtype: Optional[torch.dtype] = None,
 ) -> WanModel:
+    """
+    compute_dtype: dtype of the inputs of the scaled fp8 Linear layers, to check that scaled_mm supports it. The model is
+        created in float32 for fp8_scaled, so the dtype of the weights is not the dtype of the computation.
+    lazy_loading: keep the weights on CPU as views of the memory-mapped checkpoint, instead of reading them into the memory.
+        With block swap, the swapped blocks are read from the file when they are moved to the device, so the host memory
+        does not need to hold the whole model. Only when loading_device is CPU and dit_weight_dtype is the dtype of the
+        checkpoint, and not with fp8_scaled unless the checkpoint is pre-quantized. weights_mmapped must be cleared if the
+        weights are replaced after loading. The weights can be modified before enable_block_swap (copy-on-write), e.g. merging
+        LoRA, but the modified pages are kept in the memory.
+    """
     # dit_weight_dtype is None for fp8_scaled
     assert (not fp8_scaled and dit_weight_dtype is not None) or (fp8_scaled and dit_weight_dtype is None)
 
     device = torch.device(device)
     loading_device = torch.device(loading_device)
 
+    prequantized = is_fp8_scaled_checkpoint(dit_path)
+    if prequantized and not fp8_scaled:
+        raise ValueError(
+            f"DiT checkpoint is pre-quantized with scaled fp8, --fp8_scaled is required / DiTのチェックポイントはスケーリングされたfp8で量子化済みです。--fp8_scaledを指定してください: {dit_path}"
+        )
+
+    if lazy_loading and (
+        loading_device.type != "cpu"
+        or (fp8_scaled and not prequantized)
+        or (not prequantized and dit_weight_dtype != detect_wan_sd_dtype(dit_path))
+    ):
+        logger.warning(
+            "lazy loading is available only when the DiT is loaded to CPU (block swap) in the dtype of the checkpoint and not"
+            " quantized at loading (use the pre-quantized checkpoint for fp8_scaled), disabled"
+        )
+        lazy_loading = False
+
     with init_empty_weights():
         logger.info(f"Creating WanModel")
         model = WanModel(
@@ -901,12 +1066,29 @@ def load_wan_model(
         if dit_weight_dtype is not None:
             model.to(dit_weight_dtype)
 
+    if prequantized:
+        # load the quantized weights and the scales as is, directly to the loading device. no quantization is needed
+        logger.info(f"Loading pre-quantized fp8 DiT model from {dit_path}, device={loading_device}, lazy={lazy_loading}")
+        if lazy_loading:
+            sd = load_safetensors_mmap(dit_path)
+        else:
+            sd = load_safetensors(dit_path, loading_device, disable_mmap=True, dtype=None)
+        apply_fp8_monkey_patch(model, sd, use_scaled_mm=use_scaled_mm, compute_dtype=compute_dtype)
+
+        info = model.load_state_dict(sd, strict=True, assign=True)
+        model.weights_mmapped = lazy_loading
+        logger.info(f"Loaded DiT model from {dit_path}, info={info}")
+        return model
+
     # if fp8_scaled, load model weights to CPU to reduce VRAM usage. Otherwise, load to the specified device (CPU for block swap or CUDA for others)
     wan_loading_device = torch.device("cpu") if fp8_scaled else loading_device
-    logger.info(f"Loading DiT model from {dit_path}, device={wan_loading_device}, dtype={dit_weight_dtype}")
+    logger.info(f"Loading DiT model from {dit_path}, device={wan_loading_device}, dtype={dit_weight_dtype}, lazy={lazy_loading}")
 
     # load model weights with the specified dtype or as is
-    sd = load_safetensors(dit_path, wan_loading_device, disable_mmap=True, dtype=dit_weight_dtype)
+    if lazy_loading:
+        sd = load_safetensors_mmap(dit_path, dtype=dit_weight_dtype)
+    else:
+        sd = load_safetensors(dit_path, wan_loading_device, disable_mmap=True, dtype=dit_weight_dtype)
 
     # remove "model.diffusion_model." prefix: 1.3B model has this prefix
     for key in list(sd.keys()):
@@ -916,7 +1098,14 @@ def load_wan_model(
     if fp8_scaled:
         # fp8 optimization: calculate on CUDA, move back to CPU if loading_device is CPU (block swap)
         logger.info(f"Optimizing model weights to fp8. This may take a while.")
-        sd = model.fp8_optimization(sd, device, move_to_device=loading_device.type == "cpu")
+        sd = model.fp8_optimization(
+            sd,
+            device,
+            move_to_device=loading_device.type == "cpu",
+            use_scaled_mm=use_scaled_mm,
+            scale_mode=fp8_scale_mode,
+            compute_dtype=compute_dtype,
+        )
 
         if loading_device.type != "cpu":
             # make sure all the model weights are on the loading_device
@@ -925,6 +1114,74 @@ def load_wan_model(
                 sd[key] = sd[key].to(loading_device)
 
     info = model.load_state_dict(sd, strict=True, assign=True)
+    model.weights_mmapped = lazy_loading
     logger.info(f"Loaded DiT model from {dit_path}, info={info}")
 
     return model
+
+
+def check_pad_free_context():
+    """
+    Check that the pad-free cross attention matches the context padded to text_len, on CPU:
+    python -m wan.modules.model
+    """
+    torch.manual_seed(0)
+
+    # get_context_pad_bias: exact in float32, compared with the attention over the padded context in float64
+    b, lq, n, d, text_len = 2, 64, 4, 16, 32
+    context_lens = [5, 9]
+    context_len = max(context_lens) + 1
+    q = torch.randn(b, lq, n, d)
+    k_pad, v_pad = torch.randn(n, d), torch.randn(n, d)
+    k_packed, v_packed = torch.randn(b, context_len, n, d), torch.randn(b, context_len, n, d)
+    for i, length in enumerate(context_lens):
+        k_packed[i, length:] = k_pad
+        v_packed[i, length:] = v_pad
+    k_full = torch.cat([k_packed, k_pad.expand(b, text_len - context_len, n, d)], dim=1)
+    v_full = torch.cat([v_packed, v_pad.expand(b, text_len - context_len, n, d)], dim=1)
+
+    def attention(q, k, v, bias=None):
+        q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
+        return torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=bias).transpose(1, 2)
+
+    expected = attention(q.double(), k_full.double(), v_full.double())
+    x = attention(q, k_packed, v_packed, get_context_pad_bias(context_lens, context_len, text_len, q.device))
+    max_diff = (x.double() - expected).abs().max().item()
+    print(f"get_context_pad_bias: max diff {max_diff:.2e}")
+    assert max_diff < 1e-5, "the attention bias does not match the padded context"
+
+    # WanModel: the attention runs in bf16, so the outputs match within the bf16 precision
+    model = WanModel(
+        "t2v",
+        text_len=text_len,
+        in_dim=4,
+        dim=64,
+        ffn_dim=128,
+        freq_dim=32,
+        text_dim=32,
+        out_dim=4,
+        num_heads=4,
+        num_layers=2,
+        attn_mode="torch",
+    )
+    for param in model.parameters():
+        nn.init.normal_(param, std=0.2)  # non-zero biases: the padding tokens are not zero after the embedding
+    model.eval()
+
+    x = [torch.randn(4, 2, 8, 8) for _ in context_lens]
+    t = torch.tensor([500.0] * len(context_lens))
+    context = [torch.randn(length, 32) for length in context_lens]
+    with torch.no_grad():
+        expected = torch.stack(model(x, t, context, seq_len=32))
+        model.enable_pad_free_context()
+        actual = torch.stack(model(x, t, context, seq_len=32))
+    max_diff = (actual - expected).abs().max().item()
+    scale = expected.abs().max().item()
+    print(f"WanModel: max diff {max_diff:.2e}, max abs {scale:.2e}")
+    assert max_diff <= 2e-2 * scale, "pad-free cross attention does not match the padded context"
+
+    print("Pad-free context check passed")
+
+
+if __name__ == "__main__":
+    check_pad_free_context()
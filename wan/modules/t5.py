@@ -505,8 +505,13 @@ class T5EncoderModel:
             subfolder = None
         self.tokenizer = HuggingfaceTokenizer(name=tokenizer_path, seq_len=text_len, clean="whitespace", subfolder=subfolder)
 
-    def __call__(self, texts, device):
-        ids, mask = self.tokenizer(texts, return_mask=True, add_special_tokens=True)
+    def __call__(self, texts, device, pad_to_longest=False):
+        """
+        If pad_to_longest is True, the texts are padded to the longest text in the batch instead of text_len. The outputs
+        are the same because the padding tokens are masked, and the encoding is faster for short texts.
+        """
+        padding = {"padding": "longest"} if pad_to_longest else {}
+        ids, mask = self.tokenizer(texts, return_mask=True, add_special_tokens=True, **padding)
         ids = ids.to(device)
         mask = mask.to(device)
         seq_lens = mask.gt(0).sum(dim=1).long()
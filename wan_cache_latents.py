@@ -14,7 +14,7 @@ from PIL import Image
 import logging
 
 from dataset.image_video_dataset import ItemInfo, save_latent_cache_wan, ARCHITECTURE_WAN
-from utils.model_utils import str_to_dtype
+from utils.model_utils import get_model_identity, str_to_dtype
 from wan.configs import wan_i2v_14B
 from wan.modules.vae import WanVAE
 from wan.modules.clip import CLIPModel
@@ -24,14 +24,10 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-def encode_and_save_batch(vae: WanVAE, clip: Optional[CLIPModel], batch: list[ItemInfo]):
-    contents = torch.stack([torch.from_numpy(item.content) for item in batch])
-    if len(contents.shape) == 4:
-        contents = contents.unsqueeze(1)  # B, H, W, C -> B, F, H, W, C
-
-    contents = contents.permute(0, 4, 1, 2, 3).contiguous()  # B, C, F, H, W
-    contents = contents.to(vae.device, dtype=vae.dtype)
-    contents = contents / 127.5 - 1.0  # normalize to [-1, 1]
+def encode_and_save_batch(
+    vae: WanVAE, clip: Optional[CLIPModel], batch: list[ItemInfo], writer: Optional[cache_latents.AsyncCacheWriter] = None
+):
+    contents = cache_latents.get_batch_contents(batch, vae.device, vae.dtype)  # B, C, F, H, W, normalized to [-1, 1]
 
     h, w = contents.shape[3], contents.shape[4]
     if h < 8 or w < 8:
@@ -93,12 +89,32 @@ def encode_and_save_batch(vae: WanVAE, clip: Optional[CLIPModel], batch: list[It
     #             img = Image.fromarray(images[b, f])
     #             img.save(f"./logs/decode_{fln}_{b}_{f:03d}.jpg")
 
+    # one transfer for each tensor of the batch, the writers work on the CPU tensors
+    latent = latent.cpu()
+    if clip is not None:
+        clip_context = clip_context.cpu()
+        y = y.cpu()
+
     for i, item in enumerate(batch):
         l = latent[i]
         cctx = clip_context[i] if clip is not None else None
         y_i = y[i] if clip is not None else None
         # print(f"save latent cache: {item.latent_cache_path}, latent shape: {l.shape}")
-        save_latent_cache_wan(item, l, cctx, y_i)
+        if writer is not None:
+            writer.submit(save_latent_cache_wan, item, l, cctx, y_i)
+        else:
+            save_latent_cache_wan(item, l, cctx, y_i)
+
+        # Wan VAE is causal (the first frame, then 4 frames per latent frame), so the latents of the shorter windows with
+        # the same start frame are the leading latent frames. CLIP context of the first frame is the same
+        for prefix_item in item.prefix_items:
+            lat_f = (prefix_item.frame_count - 1) // 4 + 1
+            prefix_l = l[:, :lat_f].contiguous()
+            prefix_y = y_i[:, :lat_f].contiguous() if y_i is not None else None
+            if writer is not None:
+                writer.submit(save_latent_cache_wan, prefix_item, prefix_l, cctx, prefix_y)
+            else:
+                save_latent_cache_wan(prefix_item, prefix_l, cctx, prefix_y)
 
 
 def main(args):
@@ -134,10 +150,19 @@ def main(args):
         clip = None
 
     # Encode images
+    writer = cache_latents.AsyncCacheWriter(args.num_cache_writers)
+
     def encode(one_batch: list[ItemInfo]):
-        encode_and_save_batch(vae, clip, one_batch)
+        encode_and_save_batch(vae, clip, one_batch, writer)
 
-    cache_latents.encode_datasets(datasets, encode, args)
+    encoder_identity = {
+        "vae": get_model_identity(vae_path),
+        "vae_dtype": str(vae_dtype),
+        "clip": get_model_identity(args.clip),
+        "gpu_resize": args.gpu_resize,  # the device interpolation differs from the cv2 resize
+    }
+    cache_latents.encode_datasets(datasets, encode, args, encoder_identity, writer, args.share_window_prefix)
+    writer.close()
 
 
 def wan_setup_parser(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
@@ -148,6 +173,11 @@ def wan_setup_parser(parser: argparse.ArgumentParser) -> argparse.ArgumentParser
         default=None,
         help="text encoder (CLIP) checkpoint path, optional. If training I2V model, this is required",
     )
+    parser.add_argument(
+        "--share_window_prefix",
+        action="store_true",
+        help="encode the video windows with the same start frame once, and cache the shorter windows from the leading latents",
+    )
     return parser
 
 
@@ -10,7 +10,13 @@ from dataset import config_utils
 from dataset.config_utils import BlueprintGenerator, ConfigSanitizer
 import accelerate
 
-from dataset.image_video_dataset import ARCHITECTURE_WAN, ItemInfo, save_text_encoder_output_cache_wan
+from dataset.image_video_dataset import (
+    ARCHITECTURE_WAN,
+    ARCHITECTURE_WAN_FULL,
+    ItemInfo,
+    save_text_encoder_output_cache_link,
+    save_text_encoder_output_cache_wan,
+)
 
 # for t5 config: all Wan2.1 models have the same config for t5
 from wan.configs import wan_t2v_14B
@@ -18,32 +24,90 @@ from wan.configs import wan_t2v_14B
 import cache_text_encoder_outputs
 import logging
 
-from utils.model_utils import str_to_dtype
+from utils.model_utils import get_model_identity, str_to_dtype
 from wan.modules.t5 import T5EncoderModel
+from wan.modules.tokenizers import basic_clean, whitespace_clean
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
+def encode_prompts(
+    text_encoder: T5EncoderModel, prompts: list[str], device: torch.device, accelerator: Optional[accelerate.Accelerator]
+) -> list[torch.Tensor]:
+    # pad to the longest prompt in the batch, not to text_len. the outputs are the same
+    with torch.no_grad():
+        if accelerator is not None:
+            with accelerator.autocast():
+                return text_encoder(prompts, device, pad_to_longest=True)
+        else:
+            return text_encoder(prompts, device, pad_to_longest=True)
+
+
+def get_token_lengths(text_encoder: T5EncoderModel, prompts: list[str], chunk_size: int = 1024) -> list[int]:
+    token_lengths = []
+    for i in range(0, len(prompts), chunk_size):
+        _, mask = text_encoder.tokenizer(prompts[i : i + chunk_size], return_mask=True, add_special_tokens=True, padding="longest")
+        token_lengths.extend(mask.sum(dim=1).tolist())
+    return token_lengths
+
+
 def encode_and_save_batch(
-    text_encoder: T5EncoderModel, batch: list[ItemInfo], device: torch.device, accelerator: Optional[accelerate.Accelerator]
+    text_encoder: T5EncoderModel,
+    batch: list[ItemInfo],
+    device: torch.device,
+    accelerator: Optional[accelerate.Accelerator],
+    shared_cache: Optional[cache_text_encoder_outputs.SharedCaptionCache] = None,
 ):
+    if shared_cache is not None:
+        encode_and_save_batch_shared(text_encoder, batch, device, accelerator, shared_cache)
+        return
+
     prompts = [item.caption for item in batch]
     # print(prompts)
 
     # encode prompt
-    with torch.no_grad():
-        if accelerator is not None:
-            with accelerator.autocast():
-                context = text_encoder(prompts, device)
-        else:
-            context = text_encoder(prompts, device)
+    context = encode_prompts(text_encoder, prompts, device, accelerator)
 
     # save prompt cache
     for item, ctx in zip(batch, context):
         save_text_encoder_output_cache_wan(item, ctx)
 
 
+def encode_and_save_batch_shared(
+    text_encoder: T5EncoderModel,
+    batch: list[ItemInfo],
+    device: torch.device,
+    accelerator: Optional[accelerate.Accelerator],
+    shared_cache: cache_text_encoder_outputs.SharedCaptionCache,
+):
+    # the captions are normalized in the same way as the tokenizer (clean="whitespace"), so the captions which differ only
+    # in whitespaces share the outputs
+    shared_cache_paths = [
+        shared_cache.get_shared_cache_path(item, whitespace_clean(basic_clean(item.caption))) for item in batch
+    ]
+
+    # encode each distinct caption only once
+    captions_to_encode: dict[str, str] = {}  # shared cache path -> caption
+    for item, path in zip(batch, shared_cache_paths):
+        if path not in captions_to_encode and not shared_cache.is_saved(path):
+            captions_to_encode[path] = item.caption
+
+    if len(captions_to_encode) > 0:
+        context = encode_prompts(text_encoder, list(captions_to_encode.values()), device, accelerator)
+        for (path, caption), ctx in zip(captions_to_encode.items(), context):
+            shared_item = ItemInfo(os.path.basename(path), caption, (0, 0))
+            shared_item.text_encoder_output_cache_path = path
+            save_text_encoder_output_cache_wan(shared_item, ctx)
+            shared_cache.add_saved(path)
+
+    for item, path in zip(batch, shared_cache_paths):
+        save_text_encoder_output_cache_link(item, path, ARCHITECTURE_WAN_FULL)
+
+    shared_cache.num_items += len(batch)
+    shared_cache.num_encoded += len(captions_to_encode)
+
+
 def main(args):
     device = args.device if args.device is not None else "cuda" if torch.cuda.is_available() else "cpu"
     device = torch.device(device)
@@ -72,11 +136,22 @@ def main(args):
         text_len=config.text_len, dtype=config.t5_dtype, device=device, weight_path=args.t5, fp8=args.fp8_t5
     )
 
+    shared_cache = None
+    if args.dedup_captions:
+        encoder_identity = {
+            "t5": get_model_identity(args.t5),
+            "t5_dtype": str(config.t5_dtype),
+            "fp8_t5": args.fp8_t5,
+            "tokenizer": config.t5_tokenizer,
+            "text_len": config.text_len,
+        }
+        shared_cache = cache_text_encoder_outputs.SharedCaptionCache(encoder_identity, ARCHITECTURE_WAN, args.skip_existing)
+
     # Encode with T5
     logger.info("Encoding with T5")
 
     def encode_for_text_encoder(batch: list[ItemInfo]):
-        encode_and_save_batch(text_encoder, batch, device, accelerator)
+        encode_and_save_batch(text_encoder, batch, device, accelerator, shared_cache)
 
     cache_text_encoder_outputs.process_text_encoder_batches(
         args.num_workers,
@@ -86,16 +161,35 @@ def main(args):
         all_cache_files_for_dataset,
         all_cache_paths_for_dataset,
         encode_for_text_encoder,
+        lambda prompts: get_token_lengths(text_encoder, prompts),
+        args.token_budget,
     )
     del text_encoder
 
+    if shared_cache is not None:
+        logger.info(shared_cache.summary())
+
     # remove cache files not in dataset
-    cache_text_encoder_outputs.post_process_cache_files(datasets, all_cache_files_for_dataset, all_cache_paths_for_dataset)
+    cache_text_encoder_outputs.post_process_cache_files(
+        datasets, all_cache_files_for_dataset, all_cache_paths_for_dataset, args.keep_cache
+    )
 
 
 def wan_setup_parser(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
     parser.add_argument("--t5", type=str, default=None, required=True, help="text encoder (T5) checkpoint path")
     parser.add_argument("--fp8_t5", action="store_true", help="use fp8 for Text Encoder model")
+    parser.add_argument(
+        "--dedup_captions",
+        action="store_true",
+        help="encode and store each distinct caption once, the caches of the items with the same caption link to it",
+    )
+    parser.add_argument(
+        "--token_budget",
+        type=int,
+        default=None,
+        help="sort captions by token length and batch them by the number of tokens including padding, e.g. 8192."
+        " --batch_size is the maximum number of captions in a batch",
+    )
     return parser
 
 
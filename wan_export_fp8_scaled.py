@@ -0,0 +1,91 @@
+import argparse
+import json
+import logging
+import os
+
+import torch
+
+from modules.fp8_optimization_utils import FP8_SCALE_MODES, optimize_state_dict_with_fp8
+from utils.model_utils import dtype_to_str
+from utils.safetensors_utils import MemoryEfficientSafeOpen, load_safetensors, mem_eff_save_file
+from wan.modules.model import FP8_OPTIMIZATION_EXCLUDE_KEYS, FP8_OPTIMIZATION_TARGET_KEYS, detect_wan_sd_dtype
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(level=logging.INFO)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export Wan2.1 DiT weights pre-quantized with scaled fp8")
+
+    parser.add_argument("--dit", type=str, required=True, help="DiT checkpoint path (fp16 or bf16)")
+    parser.add_argument("--output", type=str, required=True, help="Path to save the pre-quantized model")
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="Device to use for quantization"
+    )
+    parser.add_argument(
+        "--scale_mode",
+        type=str,
+        default="tensor",
+        choices=FP8_SCALE_MODES,
+        help="scale of the quantized weights: one per weight (tensor), per output channel (channel) or per block of input"
+        " elements in each output channel (block). default is tensor, same as --fp8_scaled",
+    )
+    parser.add_argument("--block_size", type=int, default=128, help="block size for --scale_mode block")
+
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    device = torch.device(args.device)
+    logger.info(f"Using device: {device}")
+
+    with MemoryEfficientSafeOpen(args.dit) as f:
+        if f.metadata().get("fp8_scaled") == "true":
+            raise ValueError(f"DiT checkpoint is already pre-quantized: {args.dit}")
+    dit_dtype = detect_wan_sd_dtype(args.dit)
+    if dit_dtype.itemsize == 1:
+        raise ValueError(f"DiT weights are already in fp8 format, use fp16/bf16 weights: {args.dit}")
+
+    logger.info(f"Loading DiT model from {args.dit}")
+    state_dict = load_safetensors(args.dit, "cpu", disable_mmap=True, dtype=None)
+
+    # remove "model.diffusion_model." prefix: 1.3B model has this prefix
+    for key in list(state_dict.keys()):
+        if key.startswith("model.diffusion_model."):
+            state_dict[key[22:]] = state_dict.pop(key)
+
+    # same quantization as load_wan_model with --fp8_scaled
+    logger.info(f"Quantizing DiT model to scaled fp8, scale mode: {args.scale_mode}")
+    state_dict = optimize_state_dict_with_fp8(
+        state_dict,
+        device,
+        FP8_OPTIMIZATION_TARGET_KEYS,
+        FP8_OPTIMIZATION_EXCLUDE_KEYS,
+        move_to_device=False,
+        scale_mode=args.scale_mode,
+        block_size=args.block_size,
+    )
+
+    quantized_keys = sorted(key[: -len(".scale_weight")] + ".weight" for key in state_dict.keys() if key.endswith(".scale_weight"))
+    metadata = {
+        "fp8_scaled": "true",
+        "fp8_format": "float8_e4m3fn",
+        "fp8_source_dtype": dtype_to_str(dit_dtype),
+        "fp8_scale_mode": args.scale_mode,
+        "fp8_target_keys": json.dumps(FP8_OPTIMIZATION_TARGET_KEYS),
+        "fp8_exclude_keys": json.dumps(FP8_OPTIMIZATION_EXCLUDE_KEYS),
+        "fp8_quantized_keys": json.dumps(quantized_keys),
+        "fp8_source": os.path.basename(args.dit),
+    }
+    if args.scale_mode == "block":
+        metadata["fp8_block_size"] = str(args.block_size)
+
+    logger.info(f"Saving pre-quantized model to {args.output}, {len(quantized_keys)} quantized weights")
+    mem_eff_save_file(state_dict, args.output, metadata=metadata)
+    logger.info("Pre-quantized model saved")
+
+
+if __name__ == "__main__":
+    main()
@@ -22,10 +22,12 @@ from networks import lora_wan
 from utils.safetensors_utils import mem_eff_save_file, load_safetensors
 from wan.configs import WAN_CONFIGS, SUPPORTED_SIZES
 import wan
-from wan.modules.model import WanModel, load_wan_model, detect_wan_sd_dtype
+from wan.modules.model import WanModel, load_wan_model, detect_wan_sd_dtype, is_fp8_scaled_checkpoint
 from wan.modules.vae import WanVAE
 from wan.modules.t5 import T5EncoderModel
 from wan.modules.clip import CLIPModel
+from modules.block_swap_planner import get_wan_seq_len, parse_blocks_to_swap, plan_wan_blocks_to_swap
+from modules.fp8_optimization_utils import FP8_SCALE_MODES
 from modules.scheduling_flow_match_discrete import FlowMatchDiscreteScheduler
 from wan.utils.fm_solvers import FlowDPMSolverMultistepScheduler, get_sampling_sigmas, retrieve_timesteps
 from wan.utils.fm_solvers_unipc import FlowUniPCMultistepScheduler
@@ -106,6 +108,23 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--fp8", action="store_true", help="use fp8 for DiT model")
     parser.add_argument("--fp8_scaled", action="store_true", help="use scaled fp8 for DiT, only for fp8")
     parser.add_argument("--fp8_fast", action="store_true", help="Enable fast FP8 arithmetic (RTX 4XXX+), only for fp8_scaled")
+    parser.add_argument(
+        "--fp8_scale_mode",
+        type=str,
+        default="tensor",
+        choices=FP8_SCALE_MODES,
+        help="scale of the weights for fp8_scaled: per weight (tensor), per output channel (channel) or per block (block)",
+    )
+    parser.add_argument(
+        "--fp8_cache_dequantized",
+        action="store_true",
+        help="cache the dequantized weights of fp8_scaled, faster but uses more VRAM, not with blocks_to_swap",
+    )
+    parser.add_argument(
+        "--pad_free_context",
+        action="store_true",
+        help="do not pad the text context to 512 tokens in the cross attention, the result is the same",
+    )
     parser.add_argument("--fp8_t5", action="store_true", help="use fp8 for Text Encoder model")
     parser.add_argument(
         "--device", type=str, default=None, help="device to use for inference. If None, use CUDA if available, otherwise use CPU"
@@ -117,7 +136,39 @@ def parse_args() -> argparse.Namespace:
         choices=["flash", "flash2", "flash3", "torch", "sageattn", "xformers", "sdpa"],
         help="attention mode",
     )
-    parser.add_argument("--blocks_to_swap", type=int, default=0, help="number of blocks to swap in the model")
+    parser.add_argument(
+        "--blocks_to_swap",
+        type=parse_blocks_to_swap,
+        default=0,
+        help="number of blocks to swap in the model, or 'auto' to choose it from the VRAM budget",
+    )
+    parser.add_argument(
+        "--vram_budget",
+        type=float,
+        default=None,
+        help="VRAM budget in GB for blocks_to_swap auto. Default is the total memory of the device minus a reserve",
+    )
+    parser.add_argument(
+        "--block_swap_prefetch",
+        type=int,
+        default=0,
+        help="copy the swapped blocks on a CUDA stream and stage them to pinned memory up to this number of swaps ahead, e.g. 2",
+    )
+    parser.add_argument(
+        "--block_swap_fp8",
+        action="store_true",
+        help="keep the swapped blocks in FP8 with per-channel scales in the main memory, and up-convert them on the device after the transfer. halves the transfer, but the weights are quantized",
+    )
+    parser.add_argument(
+        "--block_swap_stats",
+        action="store_true",
+        help="measure the transfer, wait and compute time of the swapped blocks and show the summary after generation",
+    )
+    parser.add_argument(
+        "--lazy_loading",
+        action="store_true",
+        help="keep the DiT weights memory-mapped from the checkpoint, the swapped blocks are read when needed. for blocks_to_swap",
+    )
     parser.add_argument(
         "--output_type", type=str, default="video", choices=["video", "images", "latent", "both"], help="output type"
     )
@@ -333,6 +384,36 @@ def load_dit_model(
     Returns:
         WanModel: loaded DiT model
     """
+    lazy_loading = args.lazy_loading and args.blocks_to_swap > 0
+    prequantized = args.fp8_scaled and is_fp8_scaled_checkpoint(args.dit)
+    if lazy_loading and not prequantized and (args.fp8_scaled or dit_weight_dtype != detect_wan_sd_dtype(args.dit)):
+        # the weights are quantized or cast after loading, and they are not the views of the checkpoint any more
+        logger.warning(
+            "lazy loading is available only when the weights are used in the dtype of the checkpoint (use the pre-quantized"
+            " checkpoint for fp8_scaled), disabled"
+        )
+        lazy_loading = False
+
+    if prequantized:
+        # pre-quantized: load the fp8 weights directly. LoRA cannot be merged into the quantized weights
+        if args.lora_weight is not None and len(args.lora_weight) > 0:
+            raise ValueError("LoRA weights cannot be merged into the pre-quantized fp8 DiT, use the original weights")
+        loading_device = device if args.blocks_to_swap == 0 else "cpu"
+        return load_wan_model(
+            config,
+            is_i2v,
+            device,
+            args.dit,
+            args.attn_mode,
+            False,
+            loading_device,
+            None,
+            True,
+            use_scaled_mm=args.fp8_fast,
+            lazy_loading=lazy_loading,
+            compute_dtype=dit_dtype,
+        )
+
     loading_device = "cpu"
     if args.blocks_to_swap == 0 and args.lora_weight is None and not args.fp8_scaled:
         loading_device = device
@@ -342,7 +423,18 @@ def load_dit_model(
         loading_weight_dtype = dit_dtype  # load as-is
 
     # do not fp8 optimize because we will merge LoRA weights
-    model = load_wan_model(config, is_i2v, device, args.dit, args.attn_mode, False, loading_device, loading_weight_dtype, False)
+    model = load_wan_model(
+        config,
+        is_i2v,
+        device,
+        args.dit,
+        args.attn_mode,
+        False,
+        loading_device,
+        loading_weight_dtype,
+        False,
+        lazy_loading=lazy_loading,
+    )
 
     return model
 
@@ -403,15 +495,27 @@ def optimize_model(
         dit_dtype: dtype for the model
         dit_weight_dtype: dtype for the model weights
     """
-    if args.fp8_scaled:
+    if args.fp8_scaled and is_fp8_scaled_checkpoint(args.dit):
+        # pre-quantized weights are already loaded and patched
+        if args.blocks_to_swap == 0:
+            model.to(device)  # make sure all parameters are on the right device (e.g. RoPE etc.)
+    elif args.fp8_scaled:
         # load state dict as-is and optimize to fp8
         state_dict = model.state_dict()
 
         # if no blocks to swap, we can move the weights to GPU after optimization on GPU (omit redundant CPU->GPU copy)
         move_to_device = args.blocks_to_swap == 0  # if blocks_to_swap > 0, we will keep the model on CPU
-        state_dict = model.fp8_optimization(state_dict, device, move_to_device, use_scaled_mm=args.fp8_fast)
+        state_dict = model.fp8_optimization(
+            state_dict,
+            device,
+            move_to_device,
+            use_scaled_mm=args.fp8_fast,
+            scale_mode=args.fp8_scale_mode,
+            compute_dtype=dit_dtype,
+        )
 
         info = model.load_state_dict(state_dict, strict=True, assign=True)
+        model.weights_mmapped = False  # the weights are replaced with the quantized ones
         logger.info(f"Loaded FP8 optimized weights: {info}")
 
         if args.blocks_to_swap == 0:
@@ -424,6 +528,8 @@ def optimize_model(
         if dit_weight_dtype is not None:  # in case of args.fp8 and not args.fp8_scaled
             logger.info(f"Convert model to {dit_weight_dtype}")
             target_dtype = dit_weight_dtype
+            if any(param.dtype != target_dtype for param in model.parameters() if param.is_floating_point()):
+                model.weights_mmapped = False  # the weights are replaced with the converted ones
 
         if args.blocks_to_swap == 0:
             logger.info(f"Move model to device: {device}")
@@ -448,13 +554,24 @@ def optimize_model(
 
     if args.blocks_to_swap > 0:
         logger.info(f"Enable swap {args.blocks_to_swap} blocks to CPU from device: {device}")
-        model.enable_block_swap(args.blocks_to_swap, device, supports_backward=False)
+        model.enable_block_swap(
+            args.blocks_to_swap,
+            device,
+            supports_backward=False,
+            prefetch_depth=args.block_swap_prefetch,
+            fp8_host_weights=args.block_swap_fp8,
+        )
+        if args.block_swap_stats:
+            model.enable_block_swap_stats()
         model.move_to_device_except_swap_blocks(device)
         model.prepare_block_swap_before_forward()
     else:
         # make sure the model is on the right device
         model.to(device)
 
+    if args.fp8_scaled and args.fp8_cache_dequantized:
+        model.enable_fp8_dequantized_weight_cache()
+
     model.eval().requires_grad_(False)
     clean_memory_on_device(device)
 
@@ -818,8 +935,27 @@ def generate(args: argparse.Namespace) -> torch.Tensor:
         noise, context, context_null, inputs = prepare_t2v_inputs(args, cfg, accelerator, device)
         vae = None
 
+    # choose the number of blocks to swap before loading DiT
+    if args.blocks_to_swap == "auto":
+        height, width = args.video_size
+        args.blocks_to_swap = plan_wan_blocks_to_swap(
+            args.dit,
+            cfg,
+            is_i2v,
+            dit_weight_dtype,
+            args.fp8_scaled,
+            get_wan_seq_len(cfg, width, height, args.video_length),
+            1,
+            False,
+            False,
+            device,
+            args.vram_budget,
+        )
+
     # load DiT model
     model = load_dit_model(args, cfg, device, dit_dtype, dit_weight_dtype, is_i2v)
+    if args.pad_free_context:
+        model.enable_pad_free_context()
 
     # merge LoRA weights
     if args.lora_weight is not None and len(args.lora_weight) > 0:
@@ -842,6 +978,9 @@ def generate(args: argparse.Namespace) -> torch.Tensor:
     # run sampling
     latent = run_sampling(model, noise, scheduler, timesteps, args, inputs, device, seed_g, accelerator, is_i2v)
 
+    for block_swap_stats in model.get_block_swap_stats():
+        logger.info(block_swap_stats.format_summary())
+
     # free memory
     del model
     del scheduler
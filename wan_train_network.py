@@ -8,6 +8,7 @@ import torchvision.transforms.functional as TF
 from tqdm import tqdm
 from accelerate import Accelerator, init_empty_weights
 
+from dataset import config_utils
 from dataset.image_video_dataset import ARCHITECTURE_WAN, ARCHITECTURE_WAN_FULL
 from hv_generate_video import resize_image_to_bucket
 from hv_train_network import NetworkTrainer, load_prompts, clean_memory_on_device, setup_parser_common, read_config_from_file
@@ -17,6 +18,8 @@ import logging
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+from modules.block_swap_planner import get_wan_seq_len, plan_wan_blocks_to_swap
+from modules.fp8_optimization_utils import FP8_SCALE_MODES
 from utils import model_utils
 from utils.safetensors_utils import load_safetensors, MemoryEfficientSafeOpen
 from wan.configs import WAN_CONFIGS
@@ -325,9 +328,45 @@ class WanNetworkTrainer(NetworkTrainer):
             loading_device,
             dit_weight_dtype,
             args.fp8_scaled,
+            fp8_scale_mode=args.fp8_scale_mode,
+            lazy_loading=args.lazy_loading and bool(args.blocks_to_swap),
         )
+
+        if args.pad_free_context:
+            model.enable_pad_free_context()
+
+        if args.fp8_scaled and args.fp8_cache_dequantized:
+            if args.blocks_to_swap:
+                # all blocks are moved between the devices in turn
+                logger.warning("fp8_cache_dequantized is ignored with blocks_to_swap / fp8_cache_dequantizedはblocks_to_swapと併用できません")
+            else:
+                model.enable_fp8_dequantized_weight_cache()
         return model
 
+    def plan_blocks_to_swap(
+        self,
+        args: argparse.Namespace,
+        accelerator: Accelerator,
+        train_dataset_group: config_utils.DatasetGroup,
+        dit_weight_dtype: Optional[torch.dtype],
+    ) -> int:
+        seq_len, batch_size = self.get_largest_batch(
+            train_dataset_group, lambda width, height, frames: get_wan_seq_len(self.config, width, height, frames)
+        )
+        return plan_wan_blocks_to_swap(
+            args.dit,
+            self.config,
+            self.i2v_training,
+            dit_weight_dtype,
+            args.fp8_scaled,
+            seq_len,
+            batch_size,
+            True,
+            args.gradient_checkpointing,
+            accelerator.device,
+            args.vram_budget,
+        )
+
     def scale_shift_latents(self, latents):
         return latents
 
@@ -355,18 +394,21 @@ class WanNetworkTrainer(NetworkTrainer):
             image_latents = None
             clip_fea = None
 
-        context = [t.to(device=accelerator.device, dtype=network_dtype) for t in batch["t5"]]
+        # the contexts of the batch are packed in one tensor: transfer it at once and split it on the device
+        cu_seqlens = batch["t5_cu_seqlens"].tolist()
+        packed_context = batch["t5"].to(device=accelerator.device, dtype=network_dtype, non_blocking=True)
 
         # ensure the hidden state will require grad
         if args.gradient_checkpointing:
             noisy_model_input.requires_grad_(True)
-            for t in context:
-                t.requires_grad_(True)
+            packed_context.requires_grad_(True)
             if image_latents is not None:
                 image_latents.requires_grad_(True)
             if clip_fea is not None:
                 clip_fea.requires_grad_(True)
 
+        context = [packed_context[start:end] for start, end in zip(cu_seqlens[:-1], cu_seqlens[1:])]
+
         # call DiT
         lat_f, lat_h, lat_w = latents.shape[2:5]
         seq_len = lat_f * lat_h * lat_w // (self.config.patch_size[0] * self.config.patch_size[1] * self.config.patch_size[2])
@@ -388,6 +430,32 @@ def wan_setup_parser(parser: argparse.ArgumentParser) -> argparse.ArgumentParser
     """Wan2.1 specific parser setup"""
     parser.add_argument("--task", type=str, default="t2v-14B", choices=list(WAN_CONFIGS.keys()), help="The task to run.")
     parser.add_argument("--fp8_scaled", action="store_true", help="use scaled fp8 for DiT / DiTにスケーリングされたfp8を使う")
+    parser.add_argument(
+        "--fp8_scale_mode",
+        type=str,
+        default="tensor",
+        choices=FP8_SCALE_MODES,
+        help="scale of the weights for fp8_scaled: per weight (tensor), per output channel (channel) or per block (block)"
+        " / fp8_scaledの重みのスケール：重みごと（tensor）、出力チャネルごと（channel）、ブロックごと（block）",
+    )
+    parser.add_argument(
+        "--lazy_loading",
+        action="store_true",
+        help="keep the DiT weights memory-mapped from the checkpoint, the swapped blocks are read when needed. for blocks_to_swap"
+        " / DiTの重みをチェックポイントからメモリマップしたままにし、スワップされるブロックは必要な時に読み込む。blocks_to_swap用",
+    )
+    parser.add_argument(
+        "--fp8_cache_dequantized",
+        action="store_true",
+        help="cache the dequantized weights of fp8_scaled, faster but uses more VRAM, not with blocks_to_swap"
+        " / fp8_scaledの逆量子化した重みをキャッシュする。高速だがVRAMを多く使う。blocks_to_swapとは併用不可",
+    )
+    parser.add_argument(
+        "--pad_free_context",
+        action="store_true",
+        help="do not pad the text context to 512 tokens in the cross attention, the result is the same"
+        " / クロスアテンションでテキストのコンテキストを512トークンにパディングしない。結果は同じ",
+    )
     parser.add_argument("--t5", type=str, default=None, help="text encoder (T5) checkpoint path")
     parser.add_argument("--fp8_t5", action="store_true", help="use fp8 for Text Encoder model")
     parser.add_argument(